@@ -0,0 +1,129 @@
+# SPDX-FileCopyrightText: 2017 Scott Shawcroft, written for Adafruit Industries
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer`
+================================================================================
+
+Simple BLE Service for reading and writing files over BLE
+
+
+* Author(s): Scott Shawcroft
+"""
+
+import _bleio
+from adafruit_ble.attributes import Attribute
+from adafruit_ble.characteristics import Characteristic, ComplexCharacteristic
+from adafruit_ble.characteristics.int import Uint32Characteristic
+from adafruit_ble.services import Service
+from adafruit_ble.uuid import StandardUUID, VendorUUID
+
+__version__ = "0.0.0+auto.0"
+__repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_BLE_File_Transfer.git"
+
+# Names of adafruit_ble_file_transfer.client that are loaded from it on first use.
+_CLIENT_NAMES = (
+    "CHUNK_RETRIES",
+    "CHUNK_SIZE",
+    "MIN_POLL_INTERVAL",
+    "SPIN_POLLS",
+    "SYNC_BLOCK_SIZE",
+    "Batch",
+    "CancelToken",
+    "ChecksumError",
+    "DirectoryEntry",
+    "FileTransferClient",
+    "ProtocolError",
+    "TransferCancelled",
+    "TransferTimeout",
+)
+
+
+class FileTransferUUID(VendorUUID):
+    """UUIDs with the CircuitPython base UUID."""
+
+    def __init__(self, uuid16: int) -> None:
+        uuid128 = bytearray(b"refsnarTeliF" + b"\x00\x00\xaf\xad")
+        uuid128[-3] = uuid16 >> 8
+        uuid128[-4] = uuid16 & 0xFF
+        super().__init__(uuid128)
+
+
+class _TransferCharacteristic(ComplexCharacteristic):
+    """Endpoint for sending commands to a media player. The value read will list all available
+    commands."""
+
+    uuid = FileTransferUUID(0x0200)
+
+    def __init__(self) -> None:
+        super().__init__(
+            properties=Characteristic.WRITE_NO_RESPONSE
+            | Characteristic.READ
+            | Characteristic.NOTIFY,
+            read_perm=Attribute.ENCRYPT_NO_MITM,
+            write_perm=Attribute.ENCRYPT_NO_MITM,
+            max_length=512,
+            fixed_length=False,
+        )
+
+    def bind(self, service: "FileTransferService") -> _bleio.PacketBuffer:
+        """Binds the characteristic to the given Service."""
+        bound_characteristic = super().bind(service)
+        return _bleio.PacketBuffer(bound_characteristic, buffer_size=4, max_packet_size=512)
+
+
+class FileTransferService(Service):
+    """Simple (not necessarily fast) BLE file transfer service. It implements basic CRUD operations.
+
+    The server dictates data transfer chunk sizes so it can minimize buffer sizes on its end.
+    """
+
+    uuid = StandardUUID(0xFEBB)
+    version = Uint32Characteristic(uuid=FileTransferUUID(0x0100), initial_value=4)
+    raw = _TransferCharacteristic()
+    # _raw gets shadowed for each MIDIService instance by a PacketBuffer.
+
+    # Commands
+    INVALID = 0x00
+    READ = 0x10
+    READ_DATA = 0x11
+    READ_PACING = 0x12
+    WRITE = 0x20
+    WRITE_PACING = 0x21
+    WRITE_DATA = 0x22
+    DELETE = 0x30
+    DELETE_STATUS = 0x31
+    MKDIR = 0x40
+    MKDIR_STATUS = 0x41
+    LISTDIR = 0x50
+    LISTDIR_ENTRY = 0x51
+    LISTDIR_PAGE = 0x52
+    MOVE = 0x60
+    MOVE_STATUS = 0x61
+    TAG = 0x70
+    TAG_REPLY = 0x71
+    ABORT = 0x80
+    ABORT_STATUS = 0x81
+    HASH = 0x90
+    HASHES = 0x91
+    PATCH = 0xA0
+
+    # Responses
+    # 0x00 is INVALID
+    OK = 0x01
+    ERROR = 0x02
+    ERROR_NO_FILE = 0x03
+    ERROR_PROTOCOL = 0x04
+
+    # Flags
+    DIRECTORY = 0x01
+
+
+def __getattr__(name: str) -> object:
+    """Loads the client the first time one of its names is used."""
+    if name in _CLIENT_NAMES:
+        from adafruit_ble_file_transfer import client
+
+        return getattr(client, name)
+    raise AttributeError("module 'adafruit_ble_file_transfer' has no attribute " + repr(name))
@@ -0,0 +1,264 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer.async_client`
+================================================================================
+
+File transfer client for asyncio. Each operation is a coroutine that yields to the event loop
+while it waits for packets so one loop can talk to many devices without a thread for each.
+
+* Author(s): Scott Shawcroft
+"""
+
+import asyncio
+import time
+
+from adafruit_ble_file_transfer.client import (
+    SYNC_BLOCK_SIZE,
+    CancelToken,
+    DirectoryEntry,
+    FileTransferClient,
+)
+
+try:
+    from typing import Any, AsyncIterator, Generator, List, Optional, Tuple
+
+    from adafruit_ble.services import Service
+    from circuitpython_typing import ReadableBuffer, WriteableBuffer
+
+    from adafruit_ble_file_transfer.transport import Transport
+except ImportError:
+    pass
+
+
+class AsyncFileTransferClient(FileTransferClient):
+    """`FileTransferClient` whose operations are awaited. It runs the same protocol operations
+    and takes the same arguments. `FileTransferClient.batch` works too: await its ``run``.
+
+    One operation runs at a time. Tasks that share a client wait their turn, while clients for
+    different devices run side by side.
+
+    The transport's ``readinto`` must return 0 straight away when no packet is waiting, as a
+    PacketBuffer does. Waiting for a packet yields to the event loop between polls, backing off
+    the same way `FileTransferClient` sleeps. Writes are not awaited: they only block while the
+    other end's buffer is full.
+
+    The parameters are the same as for `FileTransferClient`. Timeouts don't count time spent
+    waiting for another task's operation to finish.
+    """
+
+    def __init__(
+        self,
+        service: Service,
+        *,
+        transport: Optional[Transport] = None,
+        preallocate: bool = False,
+        timeout: Optional[float] = None,
+        packet_timeout: Optional[float] = None,
+        max_poll_interval: float = 0.01,
+        cache: Optional["ListingCache"] = None,
+        content_cache: Optional["ContentCache"] = None,
+        checksums: bool = False,
+        progress: Optional["ProgressLog"] = None,
+    ) -> None:
+        super().__init__(
+            service,
+            transport=transport,
+            preallocate=preallocate,
+            timeout=timeout,
+            packet_timeout=packet_timeout,
+            max_poll_interval=max_poll_interval,
+            cache=cache,
+            content_cache=content_cache,
+            checksums=checksums,
+            progress=progress,
+        )
+        self._lock = asyncio.Lock()
+
+    async def _readinto(self, buffer: WriteableBuffer) -> int:
+        transport = self._transport
+        read = transport.readinto(buffer)
+        if read:
+            return read
+        started = time.monotonic()
+        empty = 1
+        try:
+            while True:
+                await asyncio.sleep(self._poll_delay(started, empty))
+                read = transport.readinto(buffer)
+                if read:
+                    return read
+                empty += 1
+        finally:
+            self.empty_polls += empty
+            self.wait_time += time.monotonic() - started
+
+    async def _run(self, operation: Generator) -> Any:
+        async with self._lock:
+            self._begin()
+            read = None
+            try:
+                while True:
+                    read = await self._readinto(operation.send(read))
+            except StopIteration as done:
+                return done.value
+
+    async def _stream(self, operation: Generator) -> AsyncIterator[tuple]:
+        """Runs operation and yields the tuples it yields between the buffers it reads into.
+        Closing the generator early tells the operation to stop by sending it True."""
+        async with self._lock:
+            self._begin()
+            reply = None
+            stop = False
+            while True:
+                try:
+                    request = operation.send(reply)
+                except StopIteration:
+                    return
+                if isinstance(request, tuple):
+                    reply = stop
+                    if not stop:
+                        try:
+                            yield request
+                        except GeneratorExit:
+                            # Finish the operation so the connection is ready for the next one.
+                            stop = reply = True
+                else:
+                    reply = await self._readinto(request)
+
+    async def read(
+        self,
+        path: str,
+        *,
+        offset: int = 0,
+        window: Optional[int] = 1,
+        cancel: Optional[CancelToken] = None,
+    ) -> bytearray:
+        """Returns the contents of the file at the given path starting at the given offset. See
+        `FileTransferClient.read`."""
+        return await self._run(self._read_contents_operation(path, offset, window, cancel))
+
+    async def iter_read(
+        self,
+        path: str,
+        *,
+        offset: int = 0,
+        chunk_size: Optional[int] = None,
+        window: Optional[int] = 1,
+        cancel: Optional[CancelToken] = None,
+    ) -> AsyncIterator[memoryview]:
+        """Yields the contents of the file at the given path one chunk at a time as each
+        arrives. See `FileTransferClient.iter_read`.
+
+        Breaking out of ``async for`` doesn't close an async generator. Await its ``aclose`` to
+        stop the transfer early and free the client for the next operation."""
+        chunk_size, window = self._read_plan(chunk_size, window)
+        chunks = self._read_chunks(path, offset, chunk_size, window, cancel)
+        try:
+            async for _, _, data in chunks:
+                if data:
+                    yield data
+        finally:
+            await chunks.aclose()
+
+    async def read_into(
+        self,
+        path: str,
+        destination,
+        *,
+        offset: int = 0,
+        chunk_size: Optional[int] = None,
+        window: Optional[int] = 1,
+        cancel: Optional[CancelToken] = None,
+    ) -> int:
+        """Reads the file at the given path into destination and returns the number of bytes
+        read. See `FileTransferClient.read_into`."""
+        return await self._run(
+            self._read_into_operation(path, destination, offset, chunk_size, window, cancel)
+        )
+
+    async def write(
+        self,
+        path: str,
+        contents: bytearray,
+        *,
+        offset: int = 0,
+        modification_time: Optional[int] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> int:
+        """Writes the given contents to the given path starting at the given offset. Returns the
+        truncated modification time. See `FileTransferClient.write`."""
+        return await super().write(
+            path, contents, offset=offset, modification_time=modification_time, cancel=cancel
+        )
+
+    async def write_from(
+        self,
+        path: str,
+        source,
+        length: int,
+        *,
+        offset: int = 0,
+        modification_time: Optional[int] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> int:
+        """Writes length bytes pulled from source to the given path. Returns the truncated
+        modification time. See `FileTransferClient.write_from`."""
+        return await super().write_from(
+            path,
+            source,
+            length,
+            offset=offset,
+            modification_time=modification_time,
+            cancel=cancel,
+        )
+
+    async def sync(
+        self,
+        path: str,
+        contents: ReadableBuffer,
+        *,
+        block_size: int = SYNC_BLOCK_SIZE,
+        modification_time: Optional[int] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> int:
+        """Makes the file at the given path hold contents, sending only the blocks that differ.
+        Returns the truncated modification time. See `FileTransferClient.sync`."""
+        return await super().sync(
+            path,
+            contents,
+            block_size=block_size,
+            modification_time=modification_time,
+            cancel=cancel,
+        )
+
+    async def mkdir(self, path: str, modification_time: Optional[int] = None) -> int:
+        """Makes the directory and any missing parents. Returns the truncated time"""
+        return await self._run(self._mkdir_operation(path, modification_time))
+
+    async def listdir(
+        self, path: str, *, start: int = 0, limit: Optional[int] = None, refresh: bool = False
+    ) -> List[DirectoryEntry]:
+        """Returns a list of `adafruit_ble_file_transfer.client.DirectoryEntry`, one for each file
+        or directory in the given path. start, limit and refresh are the same as for
+        `FileTransferClient.listdir`."""
+        return await self._run(self._listdir_operation(path, start, limit, refresh))
+
+    def iterlistdir(
+        self, path: str, *, start: int = 0, limit: Optional[int] = None
+    ) -> AsyncIterator[DirectoryEntry]:
+        """Yields each entry of the given path as soon as it arrives. See
+        `FileTransferClient.iterlistdir`.
+
+        Await the iterator's ``aclose`` to stop early and free the client for the next
+        operation."""
+        return self._stream(self._listdir_operation(path, start, limit, stream=True))
+
+    async def delete(self, path: str) -> None:
+        """Deletes the file or directory at the given path."""
+        await self._run(self._delete_operation(path))
+
+    async def move(self, old_path: str, new_path: str) -> None:
+        """Moves the file or directory from old_path to new_path."""
+        await self._run(self._move_operation(old_path, new_path))
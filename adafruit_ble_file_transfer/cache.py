@@ -0,0 +1,281 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer.cache`
+================================================================================
+
+Client-side caches of directory listings and file contents.
+
+Give a `ListingCache` to a `adafruit_ble_file_transfer.client.FileTransferClient` as ``cache=`` and
+repeated ``listdir`` calls on the same directory are answered without a transfer. The client keeps
+it in step with its own writes, mkdirs, deletes and moves. Changes made by anything else, such as
+code running on the device, are only seen once an entry expires or is refreshed.
+
+Give a `ContentCache` as ``content_cache=`` and ``read`` looks up the file's directory entry
+first. When the size and modification time listed match the cached copy, the contents come from
+the cache instead of being transferred again.
+
+* Author(s): Scott Shawcroft
+"""
+
+import os
+import time
+from binascii import crc32
+from collections import OrderedDict
+
+from adafruit_ble_file_transfer.codec import Struct
+
+try:
+    from typing import List, Optional
+
+    from circuitpython_typing import ReadableBuffer
+except ImportError:
+    pass
+
+
+# Starts each file of a ContentCache kept on disk: size, modification time and path length. The
+# path and then the contents follow.
+_FILE_HEADER = Struct("<IQH")
+
+
+def directory_key(path: str) -> str:
+    """Returns the key a directory path is cached under. Paths with and without a trailing /
+    share one key and the root is the empty string."""
+    return path.rstrip("/")
+
+
+class ListingCache:
+    """Directory listings by path, with the least recently used dropped first when full.
+
+    Use one cache per connected device.
+
+    :param int max_directories: Most listings to hold.
+    :param float ttl: Seconds a listing stays valid after it is fetched. None keeps it until it
+      is evicted or invalidated.
+    """
+
+    def __init__(self, max_directories: int = 16, ttl: Optional[float] = None) -> None:
+        if max_directories < 1:
+            raise ValueError("max_directories must be at least 1")
+        self.max_directories = max_directories
+        self.ttl = ttl
+        self.hits = 0
+        """Number of lookups answered from the cache."""
+        self.misses = 0
+        """Number of lookups that found nothing valid."""
+        # (expiry time or None, entries) by directory key, least recently used first.
+        self._listings = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._listings)
+
+    def get(self, path: str) -> Optional[List[tuple]]:
+        """Returns the cached entries of the directory at path, or None if there is no valid
+        listing. The list belongs to the cache so copy it before changing it."""
+        key = directory_key(path)
+        cached = self._listings.pop(key, None)
+        if cached is None or (cached[0] is not None and time.monotonic() >= cached[0]):
+            self.misses += 1
+            return None
+        # Reinserting moves it to the most recently used end.
+        self._listings[key] = cached
+        self.hits += 1
+        return cached[1]
+
+    def put(self, path: str, entries: List[tuple]) -> None:
+        """Stores entries as the listing of the directory at path."""
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self.restore(path, (expires, entries))
+
+    def peek(self, path: str) -> Optional[List[tuple]]:
+        """Returns the cached entries of the directory at path like `get` but without counting
+        a hit or miss or marking it as used."""
+        cached = self._listings.get(directory_key(path))
+        if cached is None or (cached[0] is not None and time.monotonic() >= cached[0]):
+            return None
+        return cached[1]
+
+    def pop(self, path: str) -> Optional[tuple]:
+        """Removes the listing of the directory at path. Returns it as an ``(expiry, entries)``
+        record for `restore`, or None if there is no valid one."""
+        cached = self._listings.pop(directory_key(path), None)
+        if cached is None or (cached[0] is not None and time.monotonic() >= cached[0]):
+            return None
+        return cached
+
+    def restore(self, path: str, record: tuple) -> None:
+        """Stores an ``(expiry, entries)`` record, such as one from `pop` whose entries have been
+        updated, as the listing of the directory at path. It expires when the original would
+        have."""
+        key = directory_key(path)
+        listings = self._listings
+        listings.pop(key, None)
+        while len(listings) >= self.max_directories:
+            listings.pop(next(iter(listings)))
+        listings[key] = record
+
+    def invalidate(self, path: str) -> None:
+        """Drops the listing of path and of every directory inside it."""
+        key = directory_key(path)
+        prefix = key + "/"
+        for cached in [k for k in self._listings if k == key or k.startswith(prefix)]:
+            del self._listings[cached]
+
+    def clear(self) -> None:
+        """Drops every listing."""
+        self._listings.clear()
+
+
+class ContentCache:
+    """File contents by path, each with the size and modification time the file had when it was
+    read or written. The least recently used are dropped first when over budget.
+
+    Use one cache per connected device.
+
+    :param int max_bytes: Most bytes of contents to hold. Larger files aren't cached.
+    :param str directory: Keep the contents in files in this existing directory instead of in
+      memory. Contents cached there earlier, such as by a previous run, are used again.
+    """
+
+    def __init__(self, max_bytes: int = 65536, directory: Optional[str] = None) -> None:
+        if max_bytes < 1:
+            raise ValueError("max_bytes must be at least 1")
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.hits = 0
+        """Number of lookups answered from the cache."""
+        self.misses = 0
+        """Number of lookups that found nothing or a different size or modification time."""
+        self.used = 0
+        """Bytes of contents held."""
+        # (size, modification time, contents or the file they are in, index in its directory's
+        # listing or None) by path, least recently used first.
+        self._files = OrderedDict()
+        if directory is not None:
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def _file_name(self, key: str) -> str:
+        return f"{self.directory}/{crc32(key.encode('utf-8')):08x}.bin"
+
+    def _load(self) -> None:
+        """Indexes the files left in the directory by an earlier cache."""
+        for name in os.listdir(self.directory):
+            if not name.endswith(".bin"):
+                continue
+            file_name = f"{self.directory}/{name}"
+            with open(file_name, "rb") as file:
+                header = file.read(_FILE_HEADER.size)
+                key = None
+                if len(header) == _FILE_HEADER.size:
+                    size, modification_time, path_length = _FILE_HEADER.unpack_from(header)
+                    try:
+                        key = str(file.read(path_length), "utf-8")
+                    except UnicodeError:
+                        pass
+            # Files that are cut short, misnamed, damaged or over the budget are dropped.
+            length = _FILE_HEADER.size + path_length + size if key is not None else None
+            if (
+                length is None
+                or os.stat(file_name)[6] != length
+                or self._file_name(key) != file_name
+                or self.used + size > self.max_bytes
+            ):
+                os.remove(file_name)
+                continue
+            self._files[key] = (size, modification_time, file_name, None)
+            self.used += size
+
+    def _drop(self, record: tuple) -> None:
+        self.used -= record[0]
+        if self.directory is not None:
+            try:
+                os.remove(record[2])
+            except OSError:
+                pass
+
+    def index(self, path: str) -> Optional[int]:
+        """Returns the index of the cached file at path in its directory's listing when it was
+        last looked up, or None if unknown. The file can be checked by listing just that entry,
+        but other changes to the directory may have moved it since."""
+        record = self._files.get(directory_key(path))
+        return None if record is None else record[3]
+
+    def get(
+        self, path: str, size: int, modification_time: int, index: Optional[int] = None
+    ) -> Optional[ReadableBuffer]:
+        """Returns the cached contents of the file at path if they were cached with the given size
+        and modification time, or None. Contents that don't match are dropped. index, when
+        given, is where the file was just listed and is remembered for `index`."""
+        key = directory_key(path)
+        record = self._files.pop(key, None)
+        if record is None or record[0] != size or record[1] != modification_time:
+            if record is not None:
+                self._drop(record)
+            self.misses += 1
+            return None
+        if index is not None and index != record[3]:
+            record = (record[0], record[1], record[2], index)
+        # Reinserting moves it to the most recently used end.
+        self._files[key] = record
+        self.hits += 1
+        if self.directory is None:
+            return record[2]
+        with open(record[2], "rb") as file:
+            file.seek(_FILE_HEADER.size + len(key.encode("utf-8")))
+            return file.read()
+
+    def put(
+        self,
+        path: str,
+        modification_time: int,
+        contents: ReadableBuffer,
+        index: Optional[int] = None,
+    ) -> None:
+        """Stores a copy of contents as those of the file at path with the given modification
+        time. index is where the file is in its directory's listing, if known. Otherwise the
+        index of contents cached before for path is kept."""
+        key = directory_key(path)
+        if index is None:
+            index = self.index(key)
+        self.invalidate(key)
+        size = len(contents)
+        if size > self.max_bytes:
+            return
+        files = self._files
+        while self.used + size > self.max_bytes:
+            self._drop(files.pop(next(iter(files))))
+        if self.directory is None:
+            stored = bytes(contents)
+        else:
+            stored = self._file_name(key)
+            # A different path that shares the file name is replaced.
+            for other, record in files.items():
+                if record[2] == stored:
+                    self._drop(files.pop(other))
+                    break
+            encoded = key.encode("utf-8")
+            header = bytearray(_FILE_HEADER.size)
+            _FILE_HEADER.pack_into(header, 0, size, modification_time, len(encoded))
+            with open(stored, "wb") as file:
+                file.write(header)
+                file.write(encoded)
+                file.write(contents)
+        files[key] = (size, modification_time, stored, index)
+        self.used += size
+
+    def invalidate(self, path: str) -> None:
+        """Drops the contents of the file at path or of every file inside the directory at
+        path."""
+        key = directory_key(path)
+        prefix = key + "/"
+        for cached in [k for k in self._files if k == key or k.startswith(prefix)]:
+            self._drop(self._files.pop(cached))
+
+    def clear(self) -> None:
+        """Drops all contents."""
+        while self._files:
+            self._drop(self._files.popitem()[1])
@@ -0,0 +1,1626 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer.client`
+================================================================================
+
+Client for the file transfer protocol, run on the central that talks to a
+`adafruit_ble_file_transfer.FileTransferService`.
+
+Its names are also available from `adafruit_ble_file_transfer` itself. This module is only
+loaded when one of them is first used, so a peripheral that serves the service doesn't load it.
+
+* Author(s): Scott Shawcroft
+"""
+
+import time
+from binascii import crc32
+from collections import namedtuple
+
+import _bleio
+
+from adafruit_ble_file_transfer import FileTransferService, codec
+from adafruit_ble_file_transfer.transport import PacketBufferTransport, Packetizer
+
+try:
+    from typing import Any, Callable, Generator, Iterator, List, Optional, Tuple
+
+    from adafruit_ble.services import Service
+    from circuitpython_typing import ReadableBuffer, WriteableBuffer
+
+    from adafruit_ble_file_transfer.transport import Transport
+except ImportError:
+    pass
+
+CHUNK_SIZE = 490
+
+# A packet wait polls this many times without sleeping, since the next packet is usually close
+# behind, and then sleeps from MIN_POLL_INTERVAL, doubling up to the client's max_poll_interval.
+SPIN_POLLS = 8
+MIN_POLL_INTERVAL = 0.0005
+
+# Times a chunk that fails its checksum is sent again before giving up.
+CHUNK_RETRIES = 3
+
+# Default block size for sync. Each block costs the server 4 bytes of hash to send.
+SYNC_BLOCK_SIZE = 1024
+
+# LISTDIR_PAGE max count for a page that runs to the end of the directory.
+_NO_LIMIT = 0xFFFFFFFF
+
+
+class ProtocolError(BaseException):
+    """Error thrown when expected bytes don't match"""
+
+
+class TransferCancelled(Exception):
+    """Raised when a transfer is stopped by its `CancelToken`. The connection is ready for the
+    next command."""
+
+
+class TransferTimeout(Exception):
+    """Raised when the other end doesn't reply within `FileTransferClient.timeout` or
+    `FileTransferClient.packet_timeout`. Replies may still be on their way so the connection
+    should be reset before the next command."""
+
+
+class ChecksumError(Exception):
+    """Raised when a chunk of file data still fails its CRC32 after being sent `CHUNK_RETRIES`
+    more times."""
+
+
+class CancelToken:
+    """Stops the transfers it is passed to. `cancel` may be called from another thread, a
+    callback or between chunks of `FileTransferClient.iter_read`."""
+
+    def __init__(self) -> None:
+        self.cancelled = False
+        """True once `cancel` has been called."""
+
+    def cancel(self) -> None:
+        """Stops the transfer at the next packet. The transfer raises `TransferCancelled`."""
+        self.cancelled = True
+
+
+DirectoryEntry = namedtuple("DirectoryEntry", ("path", "size", "flags", "modification_time"))
+"""One entry of a directory listing. ``path`` is relative to the listed directory, ``size`` is 0
+for directories and ``flags`` has `adafruit_ble_file_transfer.FileTransferService.DIRECTORY` set
+for them."""
+
+
+class _SourceReader:
+    """Pulls exact amounts of data from a file, socket or iterable of buffers."""
+
+    def __init__(self, source) -> None:
+        self._readinto = getattr(source, "readinto", None) or getattr(source, "recv_into", None)
+        self._read = None
+        self._iterator = None
+        if self._readinto is None:
+            self._read = getattr(source, "read", None)
+            if self._read is None:
+                self._iterator = iter(source)
+        self._leftover = None
+
+    def _next_piece(self, size: int) -> Optional[ReadableBuffer]:
+        if self._leftover:
+            return self._leftover
+        if self._read is not None:
+            return self._read(size)
+        for piece in self._iterator:
+            if piece:
+                return piece
+        return None
+
+    def readinto(self, buffer: WriteableBuffer) -> int:
+        """Fills buffer and returns the number of bytes stored. Fewer than ``len(buffer)`` means
+        the source has ended."""
+        size = len(buffer)
+        filled = 0
+        while filled < size:
+            if self._readinto is not None:
+                count = self._readinto(buffer[filled:])
+                if not count:
+                    break
+            else:
+                piece = self._next_piece(size - filled)
+                if not piece:
+                    break
+                piece = memoryview(piece)
+                count = min(len(piece), size - filled)
+                buffer[filled : filled + count] = piece[:count]
+                self._leftover = piece[count:]
+            filled += count
+        return filled
+
+
+def _changed_ranges(
+    contents: memoryview, block_size: int, hashes: List[int]
+) -> List[Tuple[int, int]]:
+    """Returns the start and end of each run of block_size blocks of contents whose CRC32 isn't
+    the one at the same index in hashes."""
+    ranges = []
+    length = len(contents)
+    for i, start in enumerate(range(0, length, block_size)):
+        end = min(start + block_size, length)
+        if i < len(hashes) and crc32(contents[start:end]) == hashes[i]:
+            continue
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def _split_key(path: str) -> Tuple[str, str]:
+    """Returns the cache key of the directory holding path and the final name of path. Only
+    called with a cache in use, so the cache module isn't loaded otherwise."""
+    from adafruit_ble_file_transfer.cache import directory_key
+
+    parent, _, name = directory_key(path).rpartition("/")
+    return parent, name
+
+
+class FileTransferClient:
+    """Helper class to communicating with a File Transfer server
+
+    :param Service service: The connected service or a stand-in such as
+      `adafruit_ble_file_transfer.loopback.LoopbackService`.
+    :param Transport transport: Carries the protocol packets. Defaults to ``service.raw``, wrapped
+      in a `PacketBufferTransport` when it is a `_bleio.PacketBuffer`.
+    :param bool preallocate: Allocate the scratch buffer for commands and received chunks once
+      and reuse it for every operation. Transfers then don't allocate per packet, which keeps the
+      garbage collector from running mid-transfer, at the cost of holding the buffer between
+      operations.
+    :param float timeout: Seconds each operation may take before `TransferTimeout` is raised.
+      None waits forever.
+    :param float packet_timeout: Seconds to wait for any one packet before `TransferTimeout` is
+      raised. None waits forever.
+    :param float max_poll_interval: Longest sleep between polls while waiting for a packet.
+    :param ListingCache cache: Answers repeated `listdir` calls from a
+      `adafruit_ble_file_transfer.cache.ListingCache` instead of the other end. None lists every
+      time.
+    :param bool checksums: Check a CRC32 of each chunk of file data read or written when the other
+      end has version 9 or later. Chunks that don't match are sent again.
+    :param ContentCache content_cache: Answers `read` calls from a
+      `adafruit_ble_file_transfer.cache.ContentCache` when the other end lists the file with the
+      cached size and modification time. None transfers every time.
+    :param ProgressLog progress: Records how far each `read` and `write` of a whole file gets in
+      a `adafruit_ble_file_transfer.progress.ProgressLog` so that one cut short, such as by a
+      disconnect, resumes from where it stopped when tried again with the same log. Needs
+      version 8 or later on the other end.
+    """
+
+    def __init__(
+        self,
+        service: Service,
+        *,
+        transport: Optional[Transport] = None,
+        preallocate: bool = False,
+        timeout: Optional[float] = None,
+        packet_timeout: Optional[float] = None,
+        max_poll_interval: float = 0.01,
+        cache: Optional["ListingCache"] = None,
+        content_cache: Optional["ContentCache"] = None,
+        checksums: bool = False,
+        progress: Optional["ProgressLog"] = None,
+    ) -> None:
+        self._service = service
+        if transport is None:
+            transport = service.raw
+            if isinstance(transport, _bleio.PacketBuffer):
+                transport = PacketBufferTransport(transport)
+        self._transport = transport
+        self._packetizer = Packetizer(transport)
+
+        if service.version < 3:
+            raise RuntimeError("Service on other device too old")
+
+        self._preallocate = preallocate
+        self._scratch = None
+        if preallocate:
+            self._scratch = bytearray(
+                max(transport.incoming_packet_length, codec.READ_DATA_HEADER.size + CHUNK_SIZE)
+            )
+        # READ_PACING and WRITE_DATA headers are packed into this.
+        self._header = bytearray(codec.PACING_HEADER.size)
+        # Replies without file data are read into this. WRITE_PACING is the longest.
+        self._reply = bytearray(codec.WRITE_PACING_HEADER.size)
+
+        self.timeout = timeout
+        """Seconds each operation may take. May be changed between operations."""
+        self.packet_timeout = packet_timeout
+        """Seconds to wait for any one packet. May be changed between operations."""
+        self.max_poll_interval = max_poll_interval
+        """Longest sleep between polls while waiting for a packet."""
+        self.cache = cache
+        """The `adafruit_ble_file_transfer.cache.ListingCache` listings are kept in, or None."""
+        self.content_cache = content_cache
+        """The `adafruit_ble_file_transfer.cache.ContentCache` file contents are kept in, or
+        None."""
+        self.progress = progress
+        """The `adafruit_ble_file_transfer.progress.ProgressLog` transfers are recorded in, or
+        None."""
+        self.checksums = checksums
+        """Whether reads and writes check a CRC32 of each chunk. May be changed between
+        operations."""
+        self.chunks_resent = 0
+        """Number of chunks sent again because they failed their checksum."""
+        # CHUNK_CRC trailers of written chunks are packed into this.
+        self._crc = bytearray(codec.CHUNK_CRC.size)
+        self.empty_polls = 0
+        """Number of times the transport had no packet when polled."""
+        self.wait_time = 0.0
+        """Seconds spent waiting for packets that weren't there when first polled. Compare it
+        before and after an operation with how long the operation took to see how much of it the
+        link was idle."""
+        # When the current operation times out.
+        self._deadline = None
+
+    def _buffer(self, size: int) -> bytearray:
+        """Returns a scratch buffer of at least size bytes. When preallocated, the same buffer is
+        reused so it must not be held across operations."""
+        buffer = self._scratch
+        if buffer is None or len(buffer) < size:
+            buffer = bytearray(size)
+            if self._preallocate:
+                self._scratch = buffer
+        return buffer
+
+    def _write(self, *parts: ReadableBuffer) -> None:
+        # print("write", [binascii.hexlify(part) for part in parts])
+        self._packetizer.write(*parts)
+
+    def _command_buffer(self, header_size: int, *paths: bytes) -> memoryview:
+        """Returns the scratch buffer, trimmed to the command's length, with paths copied in
+        after room for the header."""
+        size = header_size
+        for path in paths:
+            size += len(path)
+        buffer = memoryview(self._buffer(size))[:size]
+        offset = header_size
+        for path in paths:
+            buffer[offset : offset + len(path)] = path
+            offset += len(path)
+        return buffer
+
+    # Sent for every chunk so they pack with the layout directly rather than through the codec's
+    # encode functions.
+    def _send_read_pacing(self, status: int, offset: int, size: int) -> None:
+        codec.PACING_HEADER.pack_into(
+            self._header, 0, FileTransferService.READ_PACING, status, offset, size
+        )
+        self._write(self._header)
+
+    def _send_write_data(self, status: int, offset: int, size: int) -> None:
+        codec.PACING_HEADER.pack_into(
+            self._header, 0, FileTransferService.WRITE_DATA, status, offset, size
+        )
+        self._write(self._header)
+
+    def _checksum_flags(self) -> int:
+        """Returns the command flags that ask for chunk checksums, when they are wanted and the
+        server has them."""
+        if self.checksums and self._service.version >= 9:
+            return codec.CHECKSUM
+        return 0
+
+    def _send_abort(self) -> bool:
+        """Sends ABORT if the server understands it. Returns whether it was sent."""
+        if self._service.version < 6:
+            return False
+        codec.encode_abort_into(self._header)
+        self._write(self._header)
+        return True
+
+    def _begin(self) -> None:
+        """Starts the timeout for a new operation."""
+        self._deadline = None if self.timeout is None else time.monotonic() + self.timeout
+
+    def _poll_delay(self, started: float, empty: int) -> float:
+        """Returns how long to sleep before polling again for a packet that has been waited on
+        since started, after empty polls found nothing. Raises `TransferTimeout` once the packet
+        or operation is out of time."""
+        now = time.monotonic()
+        deadline = self._deadline
+        if self.packet_timeout is not None:
+            packet_deadline = started + self.packet_timeout
+            if deadline is None or packet_deadline < deadline:
+                deadline = packet_deadline
+        if deadline is not None and now >= deadline:
+            raise TransferTimeout()
+        if empty < SPIN_POLLS:
+            return 0
+        delay = min(MIN_POLL_INTERVAL * (1 << min(empty - SPIN_POLLS, 16)), self.max_poll_interval)
+        if deadline is not None:
+            delay = min(delay, deadline - now)
+        return delay
+
+    def _readinto(self, buffer: WriteableBuffer) -> int:
+        transport = self._transport
+        read = transport.readinto(buffer)
+        if read:
+            return read
+        started = time.monotonic()
+        empty = 1
+        try:
+            # Read back how much we can write
+            while True:
+                delay = self._poll_delay(started, empty)
+                if delay:
+                    time.sleep(delay)
+                read = transport.readinto(buffer)
+                if read:
+                    return read
+                empty += 1
+        finally:
+            self.empty_polls += empty
+            self.wait_time += time.monotonic() - started
+
+    def _run(self, operation: Generator) -> Any:
+        """Runs a protocol operation to completion and returns its result.
+
+        Operations are generators that send commands themselves but never read. Instead they
+        yield a buffer for the next packet and are sent back the number of bytes read into it.
+        This keeps the protocol logic the same whether packets are waited for by blocking, here,
+        or by awaiting in `adafruit_ble_file_transfer.async_client.AsyncFileTransferClient`."""
+        self._begin()
+        read = None
+        try:
+            while True:
+                read = self._readinto(operation.send(read))
+        except StopIteration as done:
+            return done.value
+
+    def _cache_before(self, operation: tuple) -> Optional[tuple]:
+        """Drops the cached listings that operation may change. Returns the cached record of
+        the listing that `_cache_after` can update once the operation succeeds, if any."""
+        name = operation[0]
+        if self.content_cache is not None and name != "mkdir":
+            self.content_cache.invalidate(operation[1])
+            if name == "move":
+                self.content_cache.invalidate(operation[2])
+        cache = self.cache
+        if cache is None:
+            return None
+        if name == "mkdir":
+            # Only listings missing one of the directories change.
+            directory = ""
+            for part in operation[1].split("/"):
+                if not part:
+                    continue
+                listing = cache.peek(directory)
+                if listing is not None and not any(
+                    entry[0] == part and entry[2] & codec.DIRECTORY for entry in listing
+                ):
+                    cache.pop(directory)
+                directory += "/" + part
+            return None
+        parent = _split_key(operation[1])[0]
+        if name == "write":
+            return cache.pop(parent)
+        if name == "delete":
+            cache.invalidate(operation[1])
+            return cache.pop(parent)
+        # Where a moved entry lands in the new listing isn't known.
+        cache.invalidate(operation[1])
+        cache.invalidate(operation[2])
+        new_parent = _split_key(operation[2])[0]
+        cache.pop(new_parent)
+        return None if new_parent == parent else cache.pop(parent)
+
+    def _cache_after(self, operation: tuple, record: Optional[tuple], result: Any = None) -> None:
+        """Puts back the listing record from `_cache_before` updated for the operation that
+        succeeded with result."""
+        if record is None:
+            return
+        parent, filename = _split_key(operation[1])
+        expires, listing = record
+        if operation[0] != "write":
+            self.cache.restore(parent, (expires, [e for e in listing if e[0] != filename]))
+            return
+        for i, entry in enumerate(listing):
+            if entry[0] == filename:
+                # result is the new size and truncated time.
+                listing[i] = DirectoryEntry(filename, result[0], 0, result[1])
+                self.cache.restore(parent, record)
+                return
+        # A new file's place in the listing isn't known so the listing stays dropped.
+
+    def _cached_contents_operation(self, path: str) -> Generator:
+        """Operation that looks up the directory entry of the file at path. Returns the entry,
+        its index in the directory's listing and the cached contents if they match the entry, or
+        None for each.
+
+        A valid listing of the directory in the `cache` is used without a transfer. Otherwise
+        servers with version 7 or later are asked for the single entry at the index the file
+        was last found at. The whole directory is listed when the index isn't known or another
+        entry is there now."""
+        parent, name = _split_key(path)
+        listing = None
+        first = 0
+        if self.cache is not None:
+            listing = self.cache.peek(parent)
+        if listing is None and self._service.version >= 7:
+            index = self.content_cache.index(path)
+            if index is not None:
+                listing = yield from self._listdir_operation(parent + "/", index, 1, True)
+                first = index
+                if not listing or listing[0].path != name:
+                    listing = None
+                    first = 0
+        if listing is None:
+            listing = yield from self._listdir_operation(parent + "/", refresh=True)
+        for i, entry in enumerate(listing):
+            if entry.path == name and not entry.flags & codec.DIRECTORY:
+                index = first + i
+                contents = self.content_cache.get(path, entry.size, entry.modification_time, index)
+                return entry, index, contents
+        return None, None, None
+
+    def _cache_contents(
+        self,
+        path: str,
+        entry: DirectoryEntry,
+        index: int,
+        offset: int,
+        contents: Optional[bytearray],
+    ) -> None:
+        """Caches contents read from offset when they are the whole file listed as entry at
+        index."""
+        if offset == 0 and contents is not None and len(contents) == entry.size:
+            self.content_cache.put(path, entry.modification_time, contents, index)
+
+    def _progress_log(self, offset: int) -> Optional["ProgressLog"]:
+        """Returns the progress log to record a transfer from offset in, if it can be resumed."""
+        if offset or self._service.version < 8:
+            return None
+        return self.progress
+
+    def _resume_operation(
+        self, progress: Optional["Progress"], contents: ReadableBuffer
+    ) -> Generator:
+        """Operation that returns how many bytes of the interrupted transfer with progress can be
+        skipped. The file must still start with the same confirmed bytes as contents, which is
+        checked with one HASH of them, and a file being read must still be as long. A write sets
+        the length itself. 0 is returned when there is no progress, the file changed or too
+        little was confirmed to be worth the check."""
+        if progress is None:
+            return 0
+        confirmed = progress.confirmed
+        # The check sends 4 bytes of hash for each confirmed sized block of the file. It must
+        # cost less than sending the confirmed bytes again.
+        if not confirmed or confirmed * confirmed < codec.BLOCK_HASH.size * progress.length:
+            return 0
+        remote = yield from self._hashes_operation(progress.path, confirmed)
+        if (
+            remote is None
+            or remote[0] < confirmed
+            or (progress.kind == "read" and remote[0] != progress.length)
+            or remote[1][0] != crc32(memoryview(contents)[:confirmed])
+        ):
+            return 0
+        self.progress.resumed += 1
+        self.progress.skipped += confirmed
+        return confirmed
+
+    def _read_plan(self, chunk_size: Optional[int], window: Optional[int]) -> Tuple[int, int]:
+        """Returns the chunk size and window to read with so that the chunks in flight fit in
+        our receive buffer. A window of None asks for two chunks that each fill half of it, or as
+        many as fit when chunk_size is given. A chunk size of None is `CHUNK_SIZE` for a window of
+        one and otherwise fills the window's share of the buffer. When both are given they
+        are used as they are."""
+        transport = self._transport
+        buffer_size = max(1, getattr(transport, "buffer_size", 1))
+        packet_length = transport.incoming_packet_length
+        overhead = codec.READ_DATA_HEADER.size
+        if self._checksum_flags():
+            overhead += codec.CHUNK_CRC.size
+        planned = window is None
+        if planned:
+            if chunk_size is None:
+                window = 2 if buffer_size > 1 else 1
+            else:
+                packets = (overhead + chunk_size + packet_length - 1) // packet_length
+                window = max(1, buffer_size // packets)
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        if chunk_size is None:
+            if window == 1 and not planned:
+                chunk_size = CHUNK_SIZE
+            else:
+                # At least one byte of data even when the header takes a whole packet.
+                packets = max(buffer_size // window, overhead // packet_length + 1)
+                chunk_size = packet_length * packets - overhead
+        return chunk_size, window
+
+    def _read_operation(
+        self,
+        path: str,
+        offset: int,
+        chunk_size: int,
+        window: int = 1,
+        cancel: Optional[CancelToken] = None,
+    ) -> Generator:
+        """Operation that yields ``(chunk_offset, content_length, data)`` for each READ_DATA
+        chunk as it arrives, in between the buffers it wants read. data is only valid until the
+        next chunk is requested because its buffer is reused. Sending back True for a chunk stops
+        the read without raising.
+
+        Up to window chunks are requested before the first of them arrives. The server answers
+        READ_PACING requests in order so the extra ones wait in its buffer until it gets to
+        them.
+
+        When cancel is set or the read is stopped early, ABORT is sent straight away and the
+        chunks already on their way are dropped until the server confirms. Servers older than
+        version 6 can't abort so the rest of the file is read and dropped instead.
+
+        With checksums, a chunk that fails its CRC32 is asked for again and the chunks requested
+        after it are dropped until it arrives, so chunks are still yielded in order."""
+        flags = self._checksum_flags()
+        trailer = codec.CHUNK_CRC.size if flags else 0
+        path = path.encode("utf-8")
+        command = self._command_buffer(codec.READ_HEADER.size, path)
+        codec.encode_read_into(command, len(path), offset, chunk_size, flags=flags)
+        self._write(command)
+        # Offset of the first byte not asked for yet and the number of chunks asked for but not
+        # received.
+        requested = offset + chunk_size
+        in_flight = 1
+        # Offset of the next chunk to yield and times it has failed its checksum.
+        expected = offset
+        retries = 0
+        data_header_size = codec.READ_DATA_HEADER.size
+        b = self._buffer(data_header_size + chunk_size + trailer)
+        view = memoryview(b)
+        data = None
+        # Once stopping, no more data is yielded. Once aborted, no more chunks are requested.
+        stopping = False
+        aborted = False
+        closed = False
+        error = None
+        while True:
+            read = yield b
+            if aborted and b[0] == FileTransferService.ABORT_STATUS:
+                if closed:
+                    return
+                raise error or TransferCancelled()
+            (
+                cmd,
+                status,
+                content_offset,
+                content_length,
+                chunk_length,
+            ) = codec.decode_read_data_from(b)
+            if cmd != FileTransferService.READ_DATA:
+                print("error:", b)
+                raise ProtocolError("Incorrect reply")
+            if status != FileTransferService.OK:
+                if aborted:
+                    continue
+                raise ValueError("Missing file")
+            chunk_end = data_header_size + chunk_length
+            if chunk_length > chunk_size:
+                raise ProtocolError("Chunk larger than requested")
+            # Read the rest of the chunk in place after the part that came with the header.
+            while read < chunk_end + trailer:
+                if not stopping and cancel is not None and cancel.cancelled:
+                    stopping = True
+                    aborted = self._send_abort()
+                read += yield view[read : chunk_end + trailer]
+            in_flight -= 1
+            if not stopping and cancel is not None and cancel.cancelled:
+                stopping = True
+                aborted = self._send_abort()
+
+            valid = True
+            if trailer and not stopping:
+                if content_offset != expected:
+                    # Asked for before an earlier chunk failed its checksum.
+                    valid = False
+                elif (
+                    crc32(view[data_header_size:chunk_end])
+                    != codec.CHUNK_CRC.unpack_from(b, chunk_end)[0]
+                ):
+                    valid = False
+                    retries += 1
+                    self.chunks_resent += 1
+                    if retries > CHUNK_RETRIES:
+                        stopping = True
+                        aborted = self._send_abort()
+                        error = ChecksumError(f"Chunk at {content_offset} failed its checksum")
+                    # Ask again from here. Chunks already asked for after it are dropped.
+                    requested = content_offset
+                else:
+                    retries = 0
+                    expected = content_offset + chunk_length
+
+            if not aborted:
+                # Ask for the next chunks first so they are on their way while this one is used.
+                while in_flight < window and requested < content_length:
+                    size = min(chunk_size, content_length - requested)
+                    self._send_read_pacing(FileTransferService.OK, requested, size)
+                    requested += size
+                    in_flight += 1
+            if trailer:
+                finished = expected >= content_length
+                if finished and not aborted:
+                    # The server waits for this in case a chunk has to be sent again.
+                    self._send_read_pacing(FileTransferService.OK, content_length, 0)
+            else:
+                finished = content_offset + chunk_length >= content_length
+            if not stopping and valid:
+                # Full chunks are all the same length so their view of the buffer can be reused.
+                if data is None or len(data) != chunk_length:
+                    data = view[data_header_size:chunk_end]
+                if (yield content_offset, content_length, data):
+                    if finished:
+                        return
+                    stopping = True
+                    closed = True
+                    aborted = self._send_abort()
+            if finished:
+                if aborted:
+                    # The server reads ABORT as its next command and confirms it.
+                    continue
+                if stopping and not closed:
+                    raise TransferCancelled()
+                return
+
+    def _stream(self, operation: Generator) -> Iterator[tuple]:
+        """Runs operation and yields the tuples it yields between the buffers it reads into.
+        Closing the generator early tells the operation to stop by sending it True."""
+        self._begin()
+        reply = None
+        stop = False
+        while True:
+            try:
+                request = operation.send(reply)
+            except StopIteration:
+                return
+            if isinstance(request, tuple):
+                reply = stop
+                if not stop:
+                    try:
+                        yield request
+                    except GeneratorExit:
+                        # Finish the operation so the connection is ready for the next one.
+                        stop = reply = True
+            else:
+                reply = self._readinto(request)
+
+    def _read_chunks(
+        self,
+        path: str,
+        offset: int,
+        chunk_size: int,
+        window: int = 1,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[Tuple[int, int, memoryview]]:
+        """Streams the chunks of `_read_operation`. Closing the generator early stops the
+        read."""
+        return self._stream(self._read_operation(path, offset, chunk_size, window, cancel))
+
+    @staticmethod
+    def _each_chunk(
+        operation: Generator, handle: Callable[[int, int, memoryview], None]
+    ) -> Generator:
+        """Operation that runs operation, passing on the buffers it wants read, and calls
+        handle with each ``(chunk_offset, content_length, data)`` it yields instead of yielding
+        it. Returns the result of operation."""
+        reply = None
+        while True:
+            try:
+                request = operation.send(reply)
+            except StopIteration as done:
+                return done.value
+            if isinstance(request, tuple):
+                handle(*request)
+                reply = None
+            else:
+                reply = yield request
+
+    def _read_contents_operation(
+        self, path: str, offset: int, window: Optional[int], cancel: Optional[CancelToken]
+    ) -> Generator:
+        """Operation that returns the contents of the file at path from offset. Checks the
+        `content_cache` first and caches what is read. A read of the whole file is recorded in
+        the `progress` log and resumes an earlier one that was cut short."""
+        entry = None
+        if self.content_cache is not None:
+            entry, index, contents = yield from self._cached_contents_operation(path)
+            if contents is not None:
+                return bytearray(contents[offset:])
+        chunk_size, window = self._read_plan(None, window)
+        log = self._progress_log(offset)
+        progress = None
+        start = offset
+        buf = None
+        if log is not None:
+            progress = log.get("read", path)
+            if progress is not None:
+                start = yield from self._resume_operation(progress, progress.contents)
+                if start:
+                    buf = progress.contents
+
+        def store(chunk_offset: int, content_length: int, data: memoryview) -> None:
+            nonlocal buf, progress
+            if buf is None:
+                buf = bytearray(max(0, content_length - offset))
+                if log is not None:
+                    progress = log.start("read", path, content_length, buf)
+            out_offset = chunk_offset - offset
+            buf[out_offset : out_offset + len(data)] = data
+            if progress is not None:
+                progress.confirmed = out_offset + len(data)
+
+        yield from self._each_chunk(
+            self._read_operation(path, start, chunk_size, window, cancel), store
+        )
+        if log is not None:
+            log.discard(path)
+        if entry is not None:
+            self._cache_contents(path, entry, index, offset, buf)
+        return buf
+
+    def read(
+        self,
+        path: str,
+        *,
+        offset: int = 0,
+        window: Optional[int] = 1,
+        cancel: Optional[CancelToken] = None,
+    ) -> bytearray:
+        """Returns the contents of the file at the given path starting at the given offset
+
+        window is the number of chunks to request ahead of the one being received. More than one
+        keeps the link busy instead of waiting a round trip for each chunk. None asks for two
+        chunks that each fill half of the transport's ``buffer_size`` in packets. A window times
+        the packets in each chunk beyond ``buffer_size`` can overrun the buffer when this end
+        falls behind, so larger windows get smaller chunks.
+
+        Setting cancel stops the read at the next packet and raises `TransferCancelled`.
+
+        With a `content_cache`, the file's directory entry is looked up first and the cached
+        contents are returned when the size and modification time match. Otherwise the file is
+        read and, when read from the start, cached. The entry comes from the `cache` when it has
+        the directory, or else is listed on its own where the file was last found, so checking
+        costs one round trip instead of a listing of the whole directory.
+
+        With a `progress` log, a read of the whole file that was cut short carries on from the
+        last chunk that arrived, if the file hasn't changed since."""
+        return self._run(self._read_contents_operation(path, offset, window, cancel))
+
+    def iter_read(
+        self,
+        path: str,
+        *,
+        offset: int = 0,
+        chunk_size: Optional[int] = None,
+        window: Optional[int] = 1,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[memoryview]:
+        """Yields the contents of the file at the given path, starting at the given offset, one
+        chunk at a time as each arrives. Peak memory depends on chunk_size instead of the file
+        size. window and cancel are the same as for `read`. chunk_size defaults to `CHUNK_SIZE`
+        or, with a window, to the window's share of the transport's ``buffer_size`` in whole
+        packets. With chunk_size, a window of None asks for as many chunks as fit in the
+        buffer. Giving both is up to the caller to keep within the buffer.
+
+        Each chunk is a memoryview into a buffer that is reused for the next one so copy it to
+        keep it. The iterator must be run to completion or closed before the next command is
+        sent. Closing it early stops the transfer like cancel does but without raising.
+
+        The `progress` log doesn't record it, so one cut short starts again from offset. Pass the
+        offset of the first chunk not received to carry on instead."""
+        chunk_size, window = self._read_plan(chunk_size, window)
+        chunks = self._read_chunks(path, offset, chunk_size, window, cancel)
+        try:
+            for _, _, data in chunks:
+                if data:
+                    yield data
+        finally:
+            chunks.close()
+
+    def _read_into_operation(
+        self,
+        path: str,
+        destination,
+        offset: int,
+        chunk_size: Optional[int],
+        window: Optional[int],
+        cancel: Optional[CancelToken],
+    ) -> Generator:
+        """Operation that stores the file at path from offset in destination, a buffer or an
+        object with ``write``, as each chunk arrives. Returns the number of bytes read."""
+        chunk_size, window = self._read_plan(chunk_size, window)
+        write = getattr(destination, "write", None)
+        total = 0
+        too_small = False
+
+        def store(chunk_offset: int, content_length: int, data: memoryview) -> None:
+            nonlocal total, too_small
+            total = max(0, content_length - offset)
+            if write is not None:
+                write(data)
+                return
+            if total > len(destination):
+                too_small = True
+            if not too_small:
+                out_offset = chunk_offset - offset
+                destination[out_offset : out_offset + len(data)] = data
+
+        yield from self._each_chunk(
+            self._read_operation(path, offset, chunk_size, window, cancel), store
+        )
+        if too_small:
+            raise ValueError(f"Buffer too small for {total} bytes")
+        return total
+
+    def read_into(
+        self,
+        path: str,
+        destination,
+        *,
+        offset: int = 0,
+        chunk_size: Optional[int] = None,
+        window: Optional[int] = 1,
+        cancel: Optional[CancelToken] = None,
+    ) -> int:
+        """Reads the file at the given path, starting at the given offset, into destination.
+        Returns the number of bytes read. chunk_size, window and cancel are the same as for
+        `iter_read`.
+
+        destination may be a writable buffer or an object with a ``write`` method such as an open
+        file. Data is stored as each chunk arrives so peak memory depends on chunk_size.
+
+        A buffer that is too small for the contents raises `ValueError` after the transfer
+        finishes so that the connection is ready for the next command.
+
+        The `progress` log doesn't record it, so one cut short starts again from offset. Use
+        `read` to resume a whole file."""
+        return self._run(
+            self._read_into_operation(path, destination, offset, chunk_size, window, cancel)
+        )
+
+    def _write_operation(
+        self,
+        path: str,
+        length: int,
+        offset: int,
+        modification_time: Optional[int],
+        next_data: Callable[[int, int], ReadableBuffer],
+        cancel: Optional[CancelToken] = None,
+        contents: Optional[ReadableBuffer] = None,
+        file_length: Optional[int] = None,
+        progress: Optional["Progress"] = None,
+    ) -> Generator:
+        """Operation that writes length bytes to the given path starting at the given offset.
+        next_data(written, size) is called for each chunk the server asks for and returns the
+        next size bytes. Returns the truncated modification time. cancel is checked before each
+        chunk. contents, when given, is everything written and is put in the `content_cache`
+        once the write succeeds.
+
+        With a file_length, the bytes are patched into the existing file, which is resized to
+        file_length, with PATCH instead of WRITE. None is returned if the server can't patch
+        it.
+
+        With checksums, the server asks for a chunk that fails its CRC32 again before the next
+        one, so only the last chunk is kept to send again.
+
+        progress, when given, is updated with the offset the server has stored up to each time it
+        asks for more."""
+        flags = self._checksum_flags()
+        operation = ("write", path)
+        cached = self._cache_before(operation)
+        path = path.encode("utf-8")
+        total_length = length + offset
+        if modification_time is None:
+            modification_time = int(time.time() * 1_000_000_000)
+        if file_length is None:
+            command = self._command_buffer(codec.WRITE_HEADER.size, path)
+            codec.encode_write_into(
+                command, len(path), offset, modification_time, total_length, flags=flags
+            )
+        else:
+            command = self._command_buffer(codec.PATCH_HEADER.size, path)
+            codec.encode_patch_into(
+                command, len(path), offset, modification_time, file_length, length, flags=flags
+            )
+        self._write(command)
+        b = self._reply
+        written = 0
+        # The last chunk sent and the times the server has asked for it again.
+        data = None
+        retries = 0
+        while True:
+            yield b
+            cmd, status, current_offset, truncated_time, free_space = (
+                codec.decode_write_pacing_from(b)
+            )
+            if status != FileTransferService.OK:
+                if file_length is not None:
+                    return None
+                print("write error", status)
+                raise RuntimeError()
+            if (
+                flags
+                and data is not None
+                and cmd == FileTransferService.WRITE_PACING
+                and current_offset == written + offset - len(data)
+            ):
+                retries += 1
+                self.chunks_resent += 1
+                if retries > CHUNK_RETRIES:
+                    self._send_write_data(FileTransferService.ERROR, current_offset, 0)
+                    raise ChecksumError(f"Chunk at {current_offset} failed its checksum")
+                written -= len(data)
+            elif cmd != FileTransferService.WRITE_PACING or current_offset != written + offset:
+                self._send_write_data(FileTransferService.ERROR_PROTOCOL, 0, 0)
+                raise ProtocolError()
+            elif written >= length:
+                # Confirmation that everything was written ok.
+                break
+            else:
+                data = None
+                retries = 0
+                if progress is not None:
+                    progress.confirmed = current_offset
+
+            if cancel is not None and cancel.cancelled:
+                if self._send_abort():
+                    yield b
+                    if codec.decode_abort_status_from(b)[0] != FileTransferService.ABORT_STATUS:
+                        raise ProtocolError()
+                else:
+                    # Older servers drop the write without a reply.
+                    self._send_write_data(FileTransferService.ERROR, current_offset, 0)
+                raise TransferCancelled()
+
+            if data is None:
+                free_space = min(free_space, length - written)
+                data = next_data(written, free_space)
+                if len(data) < free_space:
+                    self._send_write_data(FileTransferService.ERROR, current_offset, 0)
+                    raise ValueError(f"Source ended after {written + len(data)} bytes")
+            self._send_write_data(FileTransferService.OK, current_offset, len(data))
+            if flags:
+                codec.CHUNK_CRC.pack_into(self._crc, 0, crc32(data))
+                self._write(data, self._crc)
+            else:
+                self._write(data)
+            written += len(data)
+
+        if file_length is not None:
+            total_length = file_length
+        self._cache_after(operation, cached, (total_length, truncated_time))
+        if contents is not None and total_length == length and self.content_cache is not None:
+            self.content_cache.put(operation[1], truncated_time, contents)
+        return truncated_time
+
+    def _write_contents_operation(
+        self,
+        path: str,
+        contents: memoryview,
+        offset: int,
+        modification_time: Optional[int],
+        cancel: Optional[CancelToken],
+    ) -> Generator:
+        """Operation that writes contents to path starting at offset. A whole file write is
+        recorded in the `progress` log and resumes an earlier one of the same length that was
+        cut short, by patching in the rest after the server's copy is checked. Returns the
+        truncated modification time."""
+        length = len(contents)
+        log = self._progress_log(offset)
+        if log is None:
+            return (
+                yield from self._write_operation(
+                    path,
+                    length,
+                    offset,
+                    modification_time,
+                    lambda written, size: contents[written : written + size],
+                    cancel,
+                    contents,
+                )
+            )
+        progress = log.get("write", path)
+        start = 0
+        if progress is not None and progress.length == length:
+            start = yield from self._resume_operation(progress, contents)
+        progress = log.start("write", path, length)
+        progress.confirmed = start
+        truncated_time = None
+        if start:
+            truncated_time = yield from self._write_operation(
+                path,
+                length - start,
+                start,
+                modification_time,
+                lambda written, size: contents[start + written : start + written + size],
+                cancel,
+                file_length=length,
+                progress=progress,
+            )
+            if truncated_time is not None and self.content_cache is not None:
+                self.content_cache.put(path, truncated_time, contents)
+        if truncated_time is None:
+            # Nothing to resume or the server couldn't patch the file.
+            truncated_time = yield from self._write_operation(
+                path,
+                length,
+                0,
+                modification_time,
+                lambda written, size: contents[written : written + size],
+                cancel,
+                contents,
+                progress=progress,
+            )
+        log.discard(path)
+        return truncated_time
+
+    def write(
+        self,
+        path: str,
+        contents: bytearray,
+        *,
+        offset: int = 0,
+        modification_time: Optional[int] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> int:
+        """Writes the given contents to the given path starting at the given offset.
+        Returns the trunctated modification time.
+
+        If the file is shorter than the offset, zeros will be added in the gap.
+
+        Setting cancel stops the write before the next chunk and raises `TransferCancelled`. The
+        file is left with the chunks written so far.
+
+        With a `content_cache`, contents written from the start are cached once the write
+        succeeds.
+
+        With a `progress` log, a write of the whole file that was cut short carries on from the
+        last chunk the other end stored, if the file still starts with the same bytes."""
+        return self._run(
+            self._write_contents_operation(
+                path, memoryview(contents), offset, modification_time, cancel
+            )
+        )
+
+    def write_from(
+        self,
+        path: str,
+        source,
+        length: int,
+        *,
+        offset: int = 0,
+        modification_time: Optional[int] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> int:
+        """Writes length bytes pulled from source to the given path starting at the given offset.
+        Returns the truncated modification time. cancel is the same as for `write`.
+
+        source may be a file or socket (anything with ``readinto``, ``recv_into`` or ``read``) or
+        an iterable of buffers such as a generator. Only as much as the server has room for is
+        pulled at a time, into one reused buffer, so the payload is never held in memory whole.
+        `ValueError` is raised if source runs out before length bytes.
+
+        The `progress` log doesn't record it because the bytes already sent can't be checked
+        against a source that has moved past them, so one cut short starts again. Use `write` to
+        resume a whole file."""
+        reader = _SourceReader(source)
+        # The scratch buffer is free once the WRITE command has been sent. Without preallocation
+        # it is only replaced when the server asks for a larger chunk.
+        chunk = None
+
+        def next_data(_, size):
+            nonlocal chunk
+            if chunk is None or len(chunk) < size:
+                chunk = memoryview(self._buffer(size))
+            return chunk[: reader.readinto(chunk[:size])]
+
+        return self._run(
+            self._write_operation(path, length, offset, modification_time, next_data, cancel)
+        )
+
+    def _hashes_operation(self, path: str, block_size: int) -> Generator:
+        """Operation that returns the length of the file at path and the CRC32 of each of its
+        block_size blocks, or None if the file is missing."""
+        path = path.encode("utf-8")
+        command = self._command_buffer(codec.HASH_HEADER.size, path)
+        codec.encode_hash_into(command, len(path), block_size)
+        self._write(command)
+        b = self._buffer(self._transport.incoming_packet_length)
+        read = yield b
+        while read < codec.HASHES_HEADER.size:
+            read += yield memoryview(b)[read:]
+        cmd, status, file_length, count = codec.decode_hashes_from(b)
+        if cmd != FileTransferService.HASHES:
+            raise ProtocolError("Incorrect reply")
+        if status != FileTransferService.OK:
+            return None
+        hash_size = codec.BLOCK_HASH.size
+        hashes = bytearray(count * hash_size)
+        # Hashes may start in the packet with the header and may be split between packets.
+        filled = min(len(hashes), read - codec.HASHES_HEADER.size)
+        hashes[:filled] = b[codec.HASHES_HEADER.size : codec.HASHES_HEADER.size + filled]
+        view = memoryview(hashes)
+        while filled < len(hashes):
+            filled += yield view[filled:]
+        return file_length, [
+            codec.BLOCK_HASH.unpack_from(hashes, i * hash_size)[0] for i in range(count)
+        ]
+
+    def _sync_operation(
+        self,
+        path: str,
+        contents: ReadableBuffer,
+        block_size: int,
+        modification_time: Optional[int],
+        cancel: Optional[CancelToken],
+    ) -> Generator:
+        """Operation that makes the file at path hold contents by patching the blocks whose
+        hashes differ. Falls back to writing the whole file. Returns the truncated modification
+        time."""
+        if block_size < 1:
+            raise ValueError("block_size must be at least 1")
+        length = len(contents)
+        if modification_time is None:
+            modification_time = int(time.time() * 1_000_000_000)
+        remote = None
+        if self._service.version >= 8:
+            remote = yield from self._hashes_operation(path, block_size)
+        if remote is not None:
+            truncated_time = None
+            ranges = _changed_ranges(contents, block_size, remote[1])
+            # A file that only changed length, or not at all, still gets its new length and
+            # modification time.
+            for start, end in ranges or ((length, length),):
+                truncated_time = yield from self._write_operation(
+                    path,
+                    end - start,
+                    start,
+                    modification_time,
+                    lambda written, size, start=start: contents[
+                        start + written : start + written + size
+                    ],
+                    cancel,
+                    file_length=length,
+                )
+                if truncated_time is None:
+                    break
+            if truncated_time is not None:
+                if self.content_cache is not None:
+                    self.content_cache.put(path, truncated_time, contents)
+                return truncated_time
+        return (
+            yield from self._write_operation(
+                path,
+                length,
+                0,
+                modification_time,
+                lambda written, size: contents[written : written + size],
+                cancel,
+                contents,
+            )
+        )
+
+    def sync(
+        self,
+        path: str,
+        contents: ReadableBuffer,
+        *,
+        block_size: int = SYNC_BLOCK_SIZE,
+        modification_time: Optional[int] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> int:
+        """Makes the file at the given path hold contents, sending only the block_size blocks
+        that differ from it. Returns the truncated modification time.
+
+        The server sends the CRC32 of each block of its copy. Runs of blocks whose hashes don't
+        match are patched in place and the file is cut or extended to the new length. A file
+        that is missing, or a server older than version 8 or that can't patch the file, is
+        written whole as by `write`. Smaller blocks send less data around each change but more
+        hashes. cancel is the same as for `write`."""
+        contents = memoryview(contents)
+        return self._run(
+            self._sync_operation(path, contents, block_size, modification_time, cancel)
+        )
+
+    def _command(
+        self, header_size: int, *paths: bytes, tag: Optional[int] = None
+    ) -> Tuple[memoryview, int]:
+        """Returns a command buffer with room for the header and where the header starts in it.
+        A tagged command starts with a TAG header."""
+        if tag is None:
+            return self._command_buffer(header_size, *paths), 0
+        command = self._command_buffer(codec.TAG_HEADER.size + header_size, *paths)
+        return command, codec.encode_tag_into(command, tag)
+
+    def _mkdir_command(
+        self, path: str, modification_time: Optional[int], tag: Optional[int] = None
+    ) -> memoryview:
+        path = path.encode("utf-8")
+        if modification_time is None:
+            modification_time = int(time.time() * 1_000_000_000)
+        command, start = self._command(codec.MKDIR_HEADER.size, path, tag=tag)
+        codec.encode_mkdir_into(command, len(path), modification_time, start)
+        return command
+
+    @staticmethod
+    def _mkdir_result(b: ReadableBuffer, offset: int) -> int:
+        cmd, status, truncated_time = codec.decode_mkdir_status_from(b, offset)
+        if cmd != FileTransferService.MKDIR_STATUS:
+            raise ProtocolError()
+        if status != FileTransferService.OK:
+            raise ValueError("Invalid path")
+        return truncated_time
+
+    def _mkdir_operation(self, path: str, modification_time: Optional[int]) -> Generator:
+        self._cache_before(("mkdir", path))
+        self._write(self._mkdir_command(path, modification_time))
+        b = self._reply
+        yield b
+        return self._mkdir_result(b, 0)
+
+    def mkdir(self, path: str, modification_time: Optional[int] = None) -> int:
+        """Makes the directory and any missing parents. Returns the truncated time"""
+        return self._run(self._mkdir_operation(path, modification_time))
+
+    def _pages(self, start: int, limit: Optional[int]) -> bool:
+        """True when the listing is only part of the directory and the server sends pages."""
+        return (start != 0 or limit is not None) and self._service.version >= 7
+
+    def _listdir_command(
+        self, path: str, start: int, limit: Optional[int], tag: Optional[int] = None
+    ) -> memoryview:
+        path = path.encode("utf-8")
+        if not self._pages(start, limit):
+            command, offset = self._command(codec.PATH_HEADER.size, path, tag=tag)
+            codec.encode_listdir_into(command, len(path), offset)
+            return command
+        command, offset = self._command(codec.LISTDIR_PAGE_HEADER.size, path, tag=tag)
+        count = _NO_LIMIT if limit is None else limit
+        codec.encode_listdir_page_into(command, len(path), start, count, offset)
+        return command
+
+    def _listdir_result(
+        self,
+        b: WriteableBuffer,
+        read: int,
+        offset: int,
+        start: int = 0,
+        limit: Optional[int] = None,
+        stream: bool = False,
+    ) -> Generator:
+        """Parses LISTDIR_ENTRY replies starting at offset in the read bytes of b and yields b
+        to have the rest read into it. Returns the list of `DirectoryEntry` from index start, up
+        to limit of them. When streaming, each entry is yielded as soon as it is complete instead
+        and the list is empty.
+
+        Headers and names are decoded from b where they are whole. Only those split between
+        packets are gathered into a buffer first, so each byte is copied at most once."""
+        paged = self._pages(start, limit)
+        # A page ends early with the entry numbered just after it.
+        end = start + limit if paged and limit is not None else None
+        # Entries outside these numbers are dropped when the server sends the whole directory.
+        first = 0 if paged else start
+        last = None if paged or limit is None else start + limit
+        entries = []
+        header_size = codec.LISTDIR_ENTRY_HEADER.size
+        header = None
+        header_read = 0
+        name = None
+        # The path length of the entry whose name is being read, or None between entries.
+        name_length = None
+        name_read = 0
+        while True:
+            while offset < read:
+                if name_length is None:
+                    if header_read == 0 and read - offset >= header_size:
+                        fields = codec.decode_listdir_entry_from(b, offset)
+                        offset += header_size
+                    else:
+                        if header is None:
+                            header = bytearray(header_size)
+                        count = min(header_size - header_read, read - offset)
+                        header[header_read : header_read + count] = b[offset : offset + count]
+                        header_read += count
+                        offset += count
+                        if header_read < header_size:
+                            break
+                        header_read = 0
+                        fields = codec.decode_listdir_entry_from(header)
+                    cmd, status, name_length, i, total, flags, modification_time, size = fields
+                    if cmd != FileTransferService.LISTDIR_ENTRY:
+                        raise ProtocolError()
+                    if status != FileTransferService.OK or i >= total or i == end:
+                        return entries
+                    name_read = 0
+                    continue
+
+                count = min(name_length - name_read, read - offset)
+                if count == name_length:
+                    path = str(b[offset : offset + count], "utf-8")
+                else:
+                    if name is None or len(name) < name_length:
+                        name = bytearray(name_length)
+                    name[name_read : name_read + count] = b[offset : offset + count]
+                    name_read += count
+                    if name_read < name_length:
+                        offset += count
+                        break
+                    path = str(name[:name_length], "utf-8")
+                offset += count
+                name_length = None
+                if first <= i and (last is None or i < last):
+                    entry = DirectoryEntry(path, size, flags, modification_time)
+                    if not stream:
+                        entries.append(entry)
+                    elif (yield entry):
+                        # Read and drop the rest of the listing.
+                        first = total
+            read = yield b
+            offset = 0
+
+    def _cached_listing(
+        self, path: str, start: int = 0, limit: Optional[int] = None, refresh: bool = False
+    ) -> Optional[List[DirectoryEntry]]:
+        """Returns the entries asked for from the cache, or None when they must be listed."""
+        if self.cache is None or refresh:
+            return None
+        listing = self.cache.get(path)
+        if listing is None:
+            return None
+        return listing[start : None if limit is None else start + limit]
+
+    def _cache_listing(
+        self, path: str, start: int, limit: Optional[int], entries: List[DirectoryEntry]
+    ) -> List[DirectoryEntry]:
+        """Caches entries when they are the whole directory and returns them."""
+        if self.cache is not None and start == 0 and limit is None:
+            # The caller gets a copy so changing it doesn't change the cache.
+            self.cache.put(path, entries)
+            return list(entries)
+        return entries
+
+    def _listdir_operation(
+        self,
+        path: str,
+        start: int = 0,
+        limit: Optional[int] = None,
+        refresh: bool = False,
+        stream: bool = False,
+    ) -> Generator:
+        if not stream:
+            cached = self._cached_listing(path, start, limit, refresh)
+            if cached is not None:
+                return cached
+        self._write(self._listdir_command(path, start, limit))
+        b = self._buffer(self._transport.incoming_packet_length)
+        read = yield b
+        entries = yield from self._listdir_result(b, read, 0, start, limit, stream)
+        if stream:
+            return entries
+        return self._cache_listing(path, start, limit, entries)
+
+    def listdir(
+        self, path: str, *, start: int = 0, limit: Optional[int] = None, refresh: bool = False
+    ) -> List[DirectoryEntry]:
+        """Returns a list of `DirectoryEntry`, one for each file or directory in the given path.
+
+        To page through a large directory, pass the index of the first entry wanted as start and
+        the most entries to return as limit. A page shorter than limit is the last one. Servers
+        before version 7 send the whole directory and the page is cut from it.
+
+        With a `cache`, a cached listing is used when there is one, pages included, and whole
+        listings are cached. refresh lists the directory again regardless and caches the new
+        listing."""
+        return self._run(self._listdir_operation(path, start, limit, refresh))
+
+    def iterlistdir(
+        self, path: str, *, start: int = 0, limit: Optional[int] = None
+    ) -> Iterator[DirectoryEntry]:
+        """Yields a `DirectoryEntry` for each file or directory in the given path as soon as it
+        arrives, without holding the whole listing. start and limit are the same as for
+        `listdir`. The `cache` isn't used.
+
+        The iterator must be run to completion or closed before the next command is sent.
+        Closing it early reads and drops the rest of the listing."""
+        return self._stream(self._listdir_operation(path, start, limit, stream=True))
+
+    def _delete_command(self, path: str, tag: Optional[int] = None) -> memoryview:
+        path = path.encode("utf-8")
+        command, start = self._command(codec.PATH_HEADER.size, path, tag=tag)
+        codec.encode_delete_into(command, len(path), start)
+        return command
+
+    @staticmethod
+    def _delete_result(b: ReadableBuffer, offset: int) -> None:
+        cmd, status = codec.decode_delete_status_from(b, offset)
+        if cmd != FileTransferService.DELETE_STATUS:
+            raise ProtocolError()
+        if status != FileTransferService.OK:
+            raise ValueError("Missing file")
+
+    def _delete_operation(self, path: str) -> Generator:
+        operation = ("delete", path)
+        cached = self._cache_before(operation)
+        self._write(self._delete_command(path))
+        b = self._reply
+        yield b
+        self._delete_result(b, 0)
+        self._cache_after(operation, cached)
+
+    def delete(self, path: str) -> None:
+        """Deletes the file or directory at the given path."""
+        self._run(self._delete_operation(path))
+
+    def _move_command(self, old_path: str, new_path: str, tag: Optional[int] = None) -> memoryview:
+        old_path = old_path.encode("utf-8")
+        new_path = new_path.encode("utf-8")
+        command, start = self._command(codec.MOVE_HEADER.size, old_path, b" ", new_path, tag=tag)
+        codec.encode_move_into(command, len(old_path), len(new_path), start)
+        return command
+
+    @staticmethod
+    def _move_result(b: ReadableBuffer, offset: int) -> None:
+        cmd, status = codec.decode_move_status_from(b, offset)
+        if cmd != FileTransferService.MOVE_STATUS:
+            raise ProtocolError()
+        if status != FileTransferService.OK:
+            raise ValueError("Missing file")
+
+    def _move_operation(self, old_path: str, new_path: str) -> Generator:
+        if self._service.version < 4:
+            raise RuntimeError("Service on other device too old")
+        operation = ("move", old_path, new_path)
+        cached = self._cache_before(operation)
+        self._write(self._move_command(old_path, new_path))
+        b = self._reply
+        yield b
+        self._move_result(b, 0)
+        self._cache_after(operation, cached)
+
+    def move(self, old_path: str, new_path: str) -> None:
+        """Moves the file or directory from old_path to new_path."""
+        self._run(self._move_operation(old_path, new_path))
+
+    def batch(self) -> "Batch":
+        """Returns a new `Batch` of commands to send together."""
+        return Batch(self)
+
+    def _tagged_command(self, operation: tuple, tag: int) -> memoryview:
+        name = operation[0]
+        if name == "mkdir":
+            return self._mkdir_command(operation[1], operation[2], tag)
+        if name == "listdir":
+            return self._listdir_command(operation[1], operation[2], operation[3], tag)
+        if name == "delete":
+            return self._delete_command(operation[1], tag)
+        return self._move_command(operation[1], operation[2], tag)
+
+    def _tagged_result(
+        self, operation: tuple, b: WriteableBuffer, read: int, offset: int
+    ) -> Generator:
+        name = operation[0]
+        if name == "listdir":
+            return (yield from self._listdir_result(b, read, offset, operation[2], operation[3]))
+        if name == "mkdir":
+            return self._mkdir_result(b, offset)
+        if name == "delete":
+            return self._delete_result(b, offset)
+        return self._move_result(b, offset)
+
+    def _batch_operation(self, operations: List[tuple]) -> Generator:
+        """Operation that runs the operations and returns their results in the same order."""
+        results = [None] * len(operations)
+        if self._service.version < 5:
+            # No request IDs so send them one at a time.
+            for i, operation in enumerate(operations):
+                run = getattr(self, "_" + operation[0] + "_operation")
+                try:
+                    results[i] = yield from run(*operation[1:])
+                except ValueError as error:
+                    results[i] = error
+            return results
+
+        # Only send as many commands as the other end can hold so that it can always take the
+        # next one while its replies wait for us.
+        window = max(1, getattr(self._transport, "buffer_size", 1))
+        in_flight = {}
+        # Changes sent so far, and how many had been sent when each listing was asked for. Other
+        # commands in flight may change the same directories, so changes drop the listings they
+        # touch instead of updating them, and a listing is only cached if nothing was changed
+        # after it was asked for.
+        changes = 0
+        changes_before = [0] * len(operations)
+        sent = 0
+        b = self._buffer(self._transport.incoming_packet_length)
+        while sent < len(operations) or in_flight:
+            while sent < len(operations) and len(in_flight) < window:
+                operation = operations[sent]
+                if operation[0] == "listdir":
+                    cached = self._cached_listing(*operation[1:])
+                    if cached is not None:
+                        results[sent] = cached
+                        sent += 1
+                        continue
+                    changes_before[sent] = changes
+                else:
+                    self._cache_before(operation)
+                    changes += 1
+                tag = sent & 0xFFFF
+                self._write(self._tagged_command(operation, tag))
+                in_flight[tag] = sent
+                sent += 1
+            if not in_flight:
+                break
+
+            read = yield b
+            cmd, status, tag = codec.decode_tag_reply_from(b)
+            if cmd != FileTransferService.TAG_REPLY or tag not in in_flight:
+                raise ProtocolError("Incorrect reply")
+            i = in_flight.pop(tag)
+            if status != FileTransferService.OK:
+                raise ProtocolError("Command can't be tagged")
+            operation = operations[i]
+            try:
+                result = yield from self._tagged_result(
+                    operation, b, read, codec.TAG_REPLY_HEADER.size
+                )
+            except ValueError as error:
+                results[i] = error
+                continue
+            if operation[0] == "listdir" and changes == changes_before[i]:
+                result = self._cache_listing(operation[1], operation[2], operation[3], result)
+            results[i] = result
+        return results
+
+    def _run_batch(self, operations: List[tuple]) -> list:
+        """Runs the operations and returns their results in the same order."""
+        return self._run(self._batch_operation(operations))
+
+
+class Batch:
+    """Commands that are sent together, created by `FileTransferClient.batch`.
+
+    Servers with version 5 or later take each command tagged with a request ID so that the next
+    ones can be sent before the reply to the first arrives. Older servers are sent one command at
+    a time. Nothing is sent until `run` is called.
+
+    Cached listings of the directories that its commands change are dropped rather than updated.
+    """
+
+    def __init__(self, client: FileTransferClient) -> None:
+        self._client = client
+        self._operations = []
+
+    def __len__(self) -> int:
+        return len(self._operations)
+
+    def mkdir(self, path: str, modification_time: Optional[int] = None) -> None:
+        """Adds `FileTransferClient.mkdir`. Its result is the truncated time."""
+        self._operations.append(("mkdir", path, modification_time))
+
+    def listdir(
+        self, path: str, *, start: int = 0, limit: Optional[int] = None, refresh: bool = False
+    ) -> None:
+        """Adds `FileTransferClient.listdir`. Its result is the list of entries."""
+        self._operations.append(("listdir", path, start, limit, refresh))
+
+    def delete(self, path: str) -> None:
+        """Adds `FileTransferClient.delete`. Its result is None."""
+        self._operations.append(("delete", path))
+
+    def move(self, old_path: str, new_path: str) -> None:
+        """Adds `FileTransferClient.move`. Its result is None."""
+        self._operations.append(("move", old_path, new_path))
+
+    def run(self) -> list:
+        """Sends the commands and returns one result for each in the order they were added. A
+        command that fails has the `ValueError` it would have raised as its result instead.
+        The batch is empty afterwards."""
+        operations = self._operations
+        self._operations = []
+        return self._client._run_batch(operations)
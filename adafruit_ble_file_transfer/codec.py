@@ -0,0 +1,450 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer.codec`
+================================================================================
+
+Binary layouts of every file transfer message, shared by the client and servers.
+
+Each layout is defined once. ``encode_*_into`` functions pack a header into a buffer and return
+its size. ``decode_*_from(buffer, offset=0)`` return the header's fields, starting with the
+command byte. They are the layout's bound ``unpack_from`` so decoding costs no extra call.
+Variable length paths and file data follow the header and are not included.
+
+Headers sent for every packet or chunk of a transfer are packed with the layout's own
+``pack_into(buffer, offset, command, ...)`` instead, which is `struct.Struct`'s on CPython, to
+skip the extra call of the encode function.
+
+* Author(s): Scott Shawcroft
+"""
+
+import struct
+
+try:
+    from circuitpython_typing import ReadableBuffer, WriteableBuffer
+except ImportError:
+    pass
+
+# Commands
+INVALID = 0x00
+READ = 0x10
+READ_DATA = 0x11
+READ_PACING = 0x12
+WRITE = 0x20
+WRITE_PACING = 0x21
+WRITE_DATA = 0x22
+DELETE = 0x30
+DELETE_STATUS = 0x31
+MKDIR = 0x40
+MKDIR_STATUS = 0x41
+LISTDIR = 0x50
+LISTDIR_ENTRY = 0x51
+LISTDIR_PAGE = 0x52
+MOVE = 0x60
+MOVE_STATUS = 0x61
+TAG = 0x70
+TAG_REPLY = 0x71
+ABORT = 0x80
+ABORT_STATUS = 0x81
+HASH = 0x90
+HASHES = 0x91
+PATCH = 0xA0
+
+# Responses
+# 0x00 is INVALID
+OK = 0x01
+ERROR = 0x02
+ERROR_NO_FILE = 0x03
+ERROR_PROTOCOL = 0x04
+
+# Flags
+DIRECTORY = 0x01
+
+# Command flags, sent in the byte after the command of READ, WRITE and PATCH that earlier versions
+# leave as padding.
+CHECKSUM = 0x01
+"""Asks for a CHUNK_CRC after the data of each READ_DATA and WRITE_DATA chunk."""
+
+
+class _Struct:
+    """Stand-in for `struct.Struct` where it isn't available, such as on CircuitPython."""
+
+    def __init__(self, fmt: str) -> None:
+        self.format = fmt
+        self.size = struct.calcsize(fmt)
+
+    def pack_into(self, buffer: WriteableBuffer, offset: int, *values) -> None:
+        """Packs values into buffer at offset."""
+        struct.pack_into(self.format, buffer, offset, *values)
+
+    def unpack_from(self, buffer: ReadableBuffer, offset: int = 0) -> tuple:
+        """Unpacks values from buffer at offset."""
+        return struct.unpack_from(self.format, buffer, offset)
+
+
+Struct = getattr(struct, "Struct", _Struct)
+
+READ_HEADER = Struct("<BxHII")
+"""Command, path length, chunk offset, chunk size."""
+READ_DATA_HEADER = Struct("<BBxxIII")
+"""Command, status, chunk offset, total length, chunk length."""
+PACING_HEADER = Struct("<BBxxII")
+"""Command, status, offset, size. Used by READ_PACING and WRITE_DATA."""
+WRITE_HEADER = Struct("<BxHIQI")
+"""Command, path length, offset, modification time, total length."""
+WRITE_PACING_HEADER = Struct("<BBxxIQI")
+"""Command, status, offset, truncated time, free space."""
+PATH_HEADER = Struct("<BxH")
+"""Command, path length. Used by DELETE and LISTDIR."""
+STATUS_HEADER = Struct("<BB")
+"""Command, status. Used by DELETE_STATUS, MOVE_STATUS and ABORT_STATUS."""
+ABORT_HEADER = Struct("<Bxxxxxxxxxxx")
+"""Command. Padded to the size of READ_PACING and WRITE_DATA so a server waiting for one of them
+reads it whole."""
+MKDIR_HEADER = Struct("<BxHxxxxQ")
+"""Command, path length, modification time."""
+MKDIR_STATUS_HEADER = Struct("<BBxxxxxxQ")
+"""Command, status, truncated time."""
+LISTDIR_ENTRY_HEADER = Struct("<BBHIIIQI")
+"""Command, status, path length, entry number, total entries, flags, modification time, file
+size."""
+LISTDIR_PAGE_HEADER = Struct("<BxHII")
+"""Command, path length, start index, max count."""
+MOVE_HEADER = Struct("<BxHH")
+"""Command, old path length, new path length."""
+TAG_HEADER = Struct("<BxH")
+"""Command, request ID. The tagged command follows in the same packet."""
+TAG_REPLY_HEADER = Struct("<BBH")
+"""Command, status, request ID. The tagged command's reply follows when the status is OK."""
+HASH_HEADER = Struct("<BxHI")
+"""Command, path length, block size."""
+HASHES_HEADER = Struct("<BBxxII")
+"""Command, status, file length, block count. A BLOCK_HASH for each block follows."""
+BLOCK_HASH = Struct("<I")
+"""CRC32 of one block."""
+PATCH_HEADER = Struct("<BxHIQII")
+"""Command, path length, offset, modification time, file length, data length."""
+CHUNK_CRC = Struct("<I")
+"""CRC32 of a chunk's data. Follows the data when the command asked for checksums."""
+
+
+def decode_flags_from(buffer: ReadableBuffer, offset: int = 0) -> int:
+    """Returns the command flags of a READ, WRITE or PATCH header."""
+    return buffer[offset + 1]
+
+
+def encode_read_into(
+    buffer: WriteableBuffer,
+    path_length: int,
+    chunk_offset: int,
+    chunk_size: int,
+    offset: int = 0,
+    flags: int = 0,
+) -> int:
+    """Packs a READ header."""
+    READ_HEADER.pack_into(buffer, offset, READ, path_length, chunk_offset, chunk_size)
+    buffer[offset + 1] = flags
+    return READ_HEADER.size
+
+
+decode_read_from = READ_HEADER.unpack_from
+"""Returns command, path length, chunk offset and chunk size."""
+
+
+def encode_read_data_into(
+    buffer: WriteableBuffer,
+    status: int,
+    chunk_offset: int,
+    total_length: int,
+    chunk_length: int,
+    offset: int = 0,
+) -> int:
+    """Packs a READ_DATA header."""
+    READ_DATA_HEADER.pack_into(
+        buffer, offset, READ_DATA, status, chunk_offset, total_length, chunk_length
+    )
+    return READ_DATA_HEADER.size
+
+
+decode_read_data_from = READ_DATA_HEADER.unpack_from
+"""Returns command, status, chunk offset, total length and chunk length."""
+
+
+def encode_read_pacing_into(
+    buffer: WriteableBuffer, status: int, chunk_offset: int, chunk_size: int, offset: int = 0
+) -> int:
+    """Packs a READ_PACING header."""
+    PACING_HEADER.pack_into(buffer, offset, READ_PACING, status, chunk_offset, chunk_size)
+    return PACING_HEADER.size
+
+
+decode_read_pacing_from = PACING_HEADER.unpack_from
+"""Returns command, status, chunk offset and chunk size."""
+
+
+def encode_write_into(
+    buffer: WriteableBuffer,
+    path_length: int,
+    write_offset: int,
+    modification_time: int,
+    total_length: int,
+    offset: int = 0,
+    flags: int = 0,
+) -> int:
+    """Packs a WRITE header."""
+    WRITE_HEADER.pack_into(
+        buffer, offset, WRITE, path_length, write_offset, modification_time, total_length
+    )
+    buffer[offset + 1] = flags
+    return WRITE_HEADER.size
+
+
+decode_write_from = WRITE_HEADER.unpack_from
+"""Returns command, path length, offset, modification time and total length."""
+
+
+def encode_write_pacing_into(
+    buffer: WriteableBuffer,
+    status: int,
+    write_offset: int,
+    truncated_time: int,
+    free_space: int,
+    offset: int = 0,
+) -> int:
+    """Packs a WRITE_PACING header."""
+    WRITE_PACING_HEADER.pack_into(
+        buffer, offset, WRITE_PACING, status, write_offset, truncated_time, free_space
+    )
+    return WRITE_PACING_HEADER.size
+
+
+decode_write_pacing_from = WRITE_PACING_HEADER.unpack_from
+"""Returns command, status, offset, truncated time and free space."""
+
+
+def encode_write_data_into(
+    buffer: WriteableBuffer, status: int, write_offset: int, data_size: int, offset: int = 0
+) -> int:
+    """Packs a WRITE_DATA header."""
+    PACING_HEADER.pack_into(buffer, offset, WRITE_DATA, status, write_offset, data_size)
+    return PACING_HEADER.size
+
+
+decode_write_data_from = PACING_HEADER.unpack_from
+"""Returns command, status, offset and data size."""
+
+
+def encode_delete_into(buffer: WriteableBuffer, path_length: int, offset: int = 0) -> int:
+    """Packs a DELETE header."""
+    PATH_HEADER.pack_into(buffer, offset, DELETE, path_length)
+    return PATH_HEADER.size
+
+
+decode_delete_from = PATH_HEADER.unpack_from
+"""Returns command and path length."""
+
+
+def encode_delete_status_into(buffer: WriteableBuffer, status: int, offset: int = 0) -> int:
+    """Packs a DELETE_STATUS reply."""
+    STATUS_HEADER.pack_into(buffer, offset, DELETE_STATUS, status)
+    return STATUS_HEADER.size
+
+
+decode_delete_status_from = STATUS_HEADER.unpack_from
+"""Returns command and status."""
+
+
+def encode_mkdir_into(
+    buffer: WriteableBuffer, path_length: int, modification_time: int, offset: int = 0
+) -> int:
+    """Packs a MKDIR header."""
+    MKDIR_HEADER.pack_into(buffer, offset, MKDIR, path_length, modification_time)
+    return MKDIR_HEADER.size
+
+
+decode_mkdir_from = MKDIR_HEADER.unpack_from
+"""Returns command, path length and modification time."""
+
+
+def encode_mkdir_status_into(
+    buffer: WriteableBuffer, status: int, truncated_time: int, offset: int = 0
+) -> int:
+    """Packs a MKDIR_STATUS reply."""
+    MKDIR_STATUS_HEADER.pack_into(buffer, offset, MKDIR_STATUS, status, truncated_time)
+    return MKDIR_STATUS_HEADER.size
+
+
+decode_mkdir_status_from = MKDIR_STATUS_HEADER.unpack_from
+"""Returns command, status and truncated time."""
+
+
+def encode_listdir_into(buffer: WriteableBuffer, path_length: int, offset: int = 0) -> int:
+    """Packs a LISTDIR header."""
+    PATH_HEADER.pack_into(buffer, offset, LISTDIR, path_length)
+    return PATH_HEADER.size
+
+
+decode_listdir_from = PATH_HEADER.unpack_from
+"""Returns command and path length."""
+
+
+def encode_listdir_entry_into(
+    buffer: WriteableBuffer,
+    status: int,
+    path_length: int,
+    entry_number: int,
+    total_entries: int,
+    flags: int,
+    modification_time: int,
+    file_size: int,
+    offset: int = 0,
+) -> int:
+    """Packs a LISTDIR_ENTRY header."""
+    LISTDIR_ENTRY_HEADER.pack_into(
+        buffer,
+        offset,
+        LISTDIR_ENTRY,
+        status,
+        path_length,
+        entry_number,
+        total_entries,
+        flags,
+        modification_time,
+        file_size,
+    )
+    return LISTDIR_ENTRY_HEADER.size
+
+
+decode_listdir_entry_from = LISTDIR_ENTRY_HEADER.unpack_from
+"""Returns command, status, path length, entry number, total entries, flags, modification
+time and file size."""
+
+
+def encode_listdir_page_into(
+    buffer: WriteableBuffer, path_length: int, start: int, count: int, offset: int = 0
+) -> int:
+    """Packs a LISTDIR_PAGE header."""
+    LISTDIR_PAGE_HEADER.pack_into(buffer, offset, LISTDIR_PAGE, path_length, start, count)
+    return LISTDIR_PAGE_HEADER.size
+
+
+decode_listdir_page_from = LISTDIR_PAGE_HEADER.unpack_from
+"""Returns command, path length, start index and max count."""
+
+
+def encode_move_into(
+    buffer: WriteableBuffer, old_path_length: int, new_path_length: int, offset: int = 0
+) -> int:
+    """Packs a MOVE header."""
+    MOVE_HEADER.pack_into(buffer, offset, MOVE, old_path_length, new_path_length)
+    return MOVE_HEADER.size
+
+
+decode_move_from = MOVE_HEADER.unpack_from
+"""Returns command, old path length and new path length."""
+
+
+def encode_move_status_into(buffer: WriteableBuffer, status: int, offset: int = 0) -> int:
+    """Packs a MOVE_STATUS reply."""
+    STATUS_HEADER.pack_into(buffer, offset, MOVE_STATUS, status)
+    return STATUS_HEADER.size
+
+
+decode_move_status_from = STATUS_HEADER.unpack_from
+"""Returns command and status."""
+
+
+def encode_tag_into(buffer: WriteableBuffer, request_id: int, offset: int = 0) -> int:
+    """Packs a TAG header."""
+    TAG_HEADER.pack_into(buffer, offset, TAG, request_id)
+    return TAG_HEADER.size
+
+
+decode_tag_from = TAG_HEADER.unpack_from
+"""Returns command and request ID."""
+
+
+def encode_tag_reply_into(
+    buffer: WriteableBuffer, status: int, request_id: int, offset: int = 0
+) -> int:
+    """Packs a TAG_REPLY header."""
+    TAG_REPLY_HEADER.pack_into(buffer, offset, TAG_REPLY, status, request_id)
+    return TAG_REPLY_HEADER.size
+
+
+decode_tag_reply_from = TAG_REPLY_HEADER.unpack_from
+"""Returns command, status and request ID."""
+
+
+def encode_abort_into(buffer: WriteableBuffer, offset: int = 0) -> int:
+    """Packs an ABORT command."""
+    ABORT_HEADER.pack_into(buffer, offset, ABORT)
+    return ABORT_HEADER.size
+
+
+decode_abort_from = ABORT_HEADER.unpack_from
+"""Returns command."""
+
+
+def encode_abort_status_into(buffer: WriteableBuffer, status: int, offset: int = 0) -> int:
+    """Packs an ABORT_STATUS reply."""
+    STATUS_HEADER.pack_into(buffer, offset, ABORT_STATUS, status)
+    return STATUS_HEADER.size
+
+
+decode_abort_status_from = STATUS_HEADER.unpack_from
+"""Returns command and status."""
+
+
+def encode_hash_into(
+    buffer: WriteableBuffer, path_length: int, block_size: int, offset: int = 0
+) -> int:
+    """Packs a HASH header."""
+    HASH_HEADER.pack_into(buffer, offset, HASH, path_length, block_size)
+    return HASH_HEADER.size
+
+
+decode_hash_from = HASH_HEADER.unpack_from
+"""Returns command, path length and block size."""
+
+
+def encode_hashes_into(
+    buffer: WriteableBuffer, status: int, file_length: int, block_count: int, offset: int = 0
+) -> int:
+    """Packs a HASHES header."""
+    HASHES_HEADER.pack_into(buffer, offset, HASHES, status, file_length, block_count)
+    return HASHES_HEADER.size
+
+
+decode_hashes_from = HASHES_HEADER.unpack_from
+"""Returns command, status, file length and block count."""
+
+
+def encode_patch_into(
+    buffer: WriteableBuffer,
+    path_length: int,
+    write_offset: int,
+    modification_time: int,
+    file_length: int,
+    data_length: int,
+    offset: int = 0,
+    flags: int = 0,
+) -> int:
+    """Packs a PATCH header."""
+    PATCH_HEADER.pack_into(
+        buffer,
+        offset,
+        PATCH,
+        path_length,
+        write_offset,
+        modification_time,
+        file_length,
+        data_length,
+    )
+    buffer[offset + 1] = flags
+    return PATCH_HEADER.size
+
+
+decode_patch_from = PATCH_HEADER.unpack_from
+"""Returns command, path length, offset, modification time, file length and data length."""
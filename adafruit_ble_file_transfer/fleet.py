@@ -0,0 +1,211 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer.fleet`
+================================================================================
+
+Runs the same file operations on many connected devices at once. Each device gets an
+`adafruit_ble_file_transfer.async_client.AsyncFileTransferClient` and a bounded number of them
+are worked on concurrently from one event loop.
+
+.. code-block:: python
+
+    plan = Plan()
+    plan.write("/code.py", code)
+    plan.read("/log.txt")
+    result = asyncio.run(Fleet(ble.connections).run(plan))
+    for device in result.failures:
+        print(device.device, device.error)
+
+* Author(s): Scott Shawcroft
+"""
+
+import asyncio
+import time
+
+from adafruit_ble_file_transfer import FileTransferService
+from adafruit_ble_file_transfer.async_client import AsyncFileTransferClient
+from adafruit_ble_file_transfer.client import SYNC_BLOCK_SIZE, ProtocolError
+
+try:
+    from typing import Iterable, List, Optional
+
+    from circuitpython_typing import ReadableBuffer
+except ImportError:
+    pass
+
+
+class Plan:
+    """Operations to run, in order, on every device of a `Fleet`. The methods take the same
+    arguments as `adafruit_ble_file_transfer.client.FileTransferClient`'s and nothing is sent until
+    `Fleet.run`."""
+
+    def __init__(self) -> None:
+        self.steps = []
+        """``(name, args, kwargs)`` for each operation."""
+
+    def __len__(self) -> int:
+        return len(self.steps)
+
+    def _add(self, name: str, *args, **kwargs) -> None:
+        self.steps.append((name, args, kwargs))
+
+    def read(self, path: str, *, offset: int = 0, window: Optional[int] = None) -> None:
+        """Adds a read. Its result is the file's contents. window defaults to filling the
+        device's buffer."""
+        self._add("read", path, offset=offset, window=window)
+
+    def write(
+        self,
+        path: str,
+        contents: ReadableBuffer,
+        *,
+        offset: int = 0,
+        modification_time: Optional[int] = None,
+    ) -> None:
+        """Adds a write of the same contents to each device. Its result is the truncated
+        modification time."""
+        self._add("write", path, contents, offset=offset, modification_time=modification_time)
+
+    def sync(
+        self,
+        path: str,
+        contents: ReadableBuffer,
+        *,
+        block_size: int = SYNC_BLOCK_SIZE,
+        modification_time: Optional[int] = None,
+    ) -> None:
+        """Adds a sync of the same contents to each device, sending only the blocks that differ
+        on it. Its result is the truncated modification time."""
+        self._add(
+            "sync", path, contents, block_size=block_size, modification_time=modification_time
+        )
+
+    def mkdir(self, path: str, modification_time: Optional[int] = None) -> None:
+        """Adds a mkdir. Its result is the truncated time."""
+        self._add("mkdir", path, modification_time)
+
+    def listdir(self, path: str, *, start: int = 0, limit: Optional[int] = None) -> None:
+        """Adds a listdir. Its result is the list of entries."""
+        self._add("listdir", path, start=start, limit=limit)
+
+    def delete(self, path: str) -> None:
+        """Adds a delete. Its result is None."""
+        self._add("delete", path)
+
+    def move(self, old_path: str, new_path: str) -> None:
+        """Adds a move. Its result is None."""
+        self._add("move", old_path, new_path)
+
+
+class DeviceResult:
+    """What a `Plan` did on one device."""
+
+    def __init__(self, device) -> None:
+        self.device = device
+        """The connection or service the plan ran on."""
+        self.results = []
+        """The result of each operation that finished, in plan order."""
+        self.error = None
+        """The exception that stopped the plan, or None if every operation finished."""
+        self.bytes = 0
+        """File bytes read and written."""
+        self.elapsed = 0.0
+        """Seconds from the first operation starting to the plan stopping."""
+
+    @property
+    def ok(self) -> bool:
+        """True when every operation finished."""
+        return self.error is None
+
+
+class FleetResult:
+    """What a `Plan` did across a `Fleet`."""
+
+    def __init__(self, devices: List[DeviceResult], elapsed: float) -> None:
+        self.devices = devices
+        """One `DeviceResult` per device, in the order the fleet was given them."""
+        self.elapsed = elapsed
+        """Seconds the whole run took."""
+
+    @property
+    def bytes(self) -> int:
+        """File bytes read and written across all devices."""
+        return sum(device.bytes for device in self.devices)
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second across all devices."""
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def failures(self) -> List[DeviceResult]:
+        """Devices whose plan stopped with an error."""
+        return [device for device in self.devices if device.error is not None]
+
+
+class Fleet:
+    """Runs plans on many devices at once.
+
+    :param devices: Connections with a `FileTransferService`, or the services themselves, such as
+      `adafruit_ble_file_transfer.loopback.LoopbackService`.
+    :param int workers: Most devices to work on at once. Each connection shares the radio so
+      more isn't always faster.
+    :param client_options: Passed to each device's
+      `adafruit_ble_file_transfer.async_client.AsyncFileTransferClient`, such as ``timeout``.
+    """
+
+    def __init__(self, devices: Iterable, *, workers: int = 4, **client_options) -> None:
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.devices = list(devices)
+        self.workers = workers
+        self._client_options = client_options
+        self._clients = [None] * len(self.devices)
+
+    def _client(self, index: int) -> AsyncFileTransferClient:
+        client = self._clients[index]
+        if client is None:
+            device = self.devices[index]
+            # A BLEConnection holds the service rather than being one.
+            service = device[FileTransferService] if hasattr(device, "connected") else device
+            client = AsyncFileTransferClient(service, **self._client_options)
+            self._clients[index] = client
+        return client
+
+    async def _run_plan(self, index: int, plan: Plan, result: DeviceResult) -> None:
+        client = self._client(index)
+        for name, args, kwargs in plan.steps:
+            value = await getattr(client, name)(*args, **kwargs)
+            if name == "read":
+                result.bytes += len(value)
+            elif name in {"write", "sync"}:
+                result.bytes += len(args[1])
+            result.results.append(value)
+
+    async def _run_device(self, index: int, plan: Plan) -> DeviceResult:
+        result = DeviceResult(self.devices[index])
+        start = time.monotonic()
+        try:
+            await self._run_plan(index, plan, result)
+        except (Exception, ProtocolError) as error:
+            result.error = error
+        result.elapsed = time.monotonic() - start
+        return result
+
+    async def run(self, plan: Plan) -> FleetResult:
+        """Runs plan on every device and returns what happened on each. A device that fails
+        stops at the failed operation without affecting the others."""
+        results = [None] * len(self.devices)
+        # Taken from the end by whichever worker is free next.
+        pending = list(range(len(self.devices) - 1, -1, -1))
+
+        async def worker():
+            while pending:
+                index = pending.pop()
+                results[index] = await self._run_device(index, plan)
+
+        start = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, len(pending)))))
+        return FleetResult(results, time.monotonic() - start)
@@ -0,0 +1,129 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer.link`
+================================================================================
+
+Timing model of a BLE connection for loopback transports. Packets are stamped with the virtual
+time they would be delivered at instead of actually being delayed so a transfer can be simulated
+much faster than it would run on a radio.
+
+* Author(s): Scott Shawcroft
+"""
+
+import random
+
+try:
+    from typing import Optional
+except ImportError:
+    pass
+
+# ATT header bytes taken out of each packet by the notification or write without response.
+_ATT_OVERHEAD = 3
+
+
+class _Direction:
+    """Scheduling state for one direction of the link."""
+
+    def __init__(self) -> None:
+        self.event = 0
+        self.used = 0
+
+
+class EmulatedLink:
+    """Models the parts of a BLE connection that limit file transfer speed.
+
+    Data only moves during connection events that happen once per connection interval. Each event
+    carries up to ``packets_per_event`` packets in each direction. A packet that is lost over the
+    air is sent again by the link layer in the next event, so loss delays packets but never drops
+    them. The receiving PacketBuffer holds ``buffer_size`` packets.
+
+    By default the sender waits while the receiving buffer is full. That is optimistic: a real
+    PacketBuffer doesn't hold back the other end, it drops its oldest packet to make room. Pass
+    overflow to drop packets that arrive while the buffer is full instead and count them in
+    `packets_overrun`, to check that nothing sends more than the other end can hold.
+
+    :param float connection_interval: Seconds between connection events.
+    :param int mtu: Negotiated ATT MTU. Packets carry up to ``mtu - 3`` bytes, capped at the
+      512 byte ``max_packet_size`` of the service's PacketBuffer.
+    :param int packets_per_event: Packets that fit in one connection event in each direction.
+    :param int buffer_size: Packets held by the receiving PacketBuffer.
+    :param float loss: Probability that each attempt to send a packet is lost and has to be sent
+      again.
+    :param float disconnect_after: Virtual time in seconds after which the link drops, like the
+      stub server's ``disconnect_after``.
+    :param int seed: Seed for packet loss so that runs are reproducible.
+    :param bool overflow: Drop packets that arrive while the receiving buffer is full instead of
+      making the sender wait.
+    :param float handling_time: Seconds each end spends on a packet it has read before it reads
+      the next one. Without it packets are read as soon as they arrive and buffers never fill.
+    """
+
+    def __init__(
+        self,
+        *,
+        connection_interval: float = 0.015,
+        mtu: int = 247,
+        packets_per_event: int = 4,
+        buffer_size: int = 4,
+        loss: float = 0.0,
+        disconnect_after: Optional[float] = None,
+        seed: int = 0,
+        overflow: bool = False,
+        handling_time: float = 0.0,
+    ) -> None:
+        self.connection_interval = connection_interval
+        self.mtu = mtu
+        self.packets_per_event = packets_per_event
+        self.buffer_size = buffer_size
+        self.loss = loss
+        self.disconnect_after = disconnect_after
+        self.overflow = overflow
+        self.handling_time = handling_time
+        self.retransmissions = 0
+        """Number of times a packet was lost and sent again."""
+        self.packets_overrun = 0
+        """Number of packets dropped because the receiving buffer was full, with overflow."""
+        self.elapsed = 0.0
+        """Latest virtual time seen by either end in seconds."""
+        self._random = random.Random(seed)
+
+    @property
+    def packet_length(self) -> int:
+        """Largest packet payload the link carries."""
+        return min(self.mtu - _ATT_OVERHEAD, 512)
+
+    def direction(self) -> _Direction:
+        """Returns new scheduling state for one direction of the link."""
+        return _Direction()
+
+    def schedule(self, direction: _Direction, send_time: float) -> float:
+        """Returns the virtual time at which a packet queued at send_time is delivered."""
+        interval = self.connection_interval
+        # First connection event after the send time. A packet that arrives during an event can't
+        # be answered until the next one. The small offset keeps rounding from moving a send
+        # that happened exactly at an event back into the previous one.
+        event = int(send_time / interval + 1e-9) + 1
+        if event > direction.event:
+            direction.event = event
+            direction.used = 0
+        elif direction.used >= self.packets_per_event:
+            direction.event += 1
+            direction.used = 0
+        direction.used += 1
+        # A lost packet isn't acknowledged so it goes first in the next event. Packets after it
+        # wait behind it because the link delivers in order.
+        while self.loss and self._random.random() < self.loss:
+            self.retransmissions += 1
+            direction.event += 1
+            direction.used = 1
+        return direction.event * interval
+
+    def disconnected(self, now: float) -> bool:
+        """Returns True if the link has dropped by the virtual time now."""
+        return self.disconnect_after is not None and now >= self.disconnect_after
+
+    def advance(self, now: float) -> None:
+        """Records that an end has reached the virtual time now."""
+        self.elapsed = max(self.elapsed, now)
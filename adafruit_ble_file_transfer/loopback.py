@@ -0,0 +1,238 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer.loopback`
+================================================================================
+
+In-process transport that connects a `FileTransferClient` directly to a `FileTransferServer`.
+It lets the protocol run, and be measured, on a host without a radio. Requires CPython threads.
+
+* Author(s): Scott Shawcroft
+"""
+
+import threading
+from collections import deque
+
+from adafruit_ble_file_transfer.link import EmulatedLink
+from adafruit_ble_file_transfer.transport import Transport
+
+try:
+    from typing import Optional, Tuple
+
+    from circuitpython_typing import ReadableBuffer, WriteableBuffer
+
+    from adafruit_ble_file_transfer.server import FileTransferServer
+except ImportError:
+    pass
+
+# How long an empty readinto() waits for a packet before returning 0. Waiting briefly keeps
+# polling loops from spinning a core while the other end works.
+POLL_INTERVAL = 0.01
+
+
+class _Pipe:
+    """One direction of a loopback link. Holds at most buffer_size packets like the receiving
+    PacketBuffer does."""
+
+    def __init__(self, buffer_size: int, link: Optional[EmulatedLink] = None) -> None:
+        self.buffer_size = buffer_size
+        self.link = link
+        self.direction = link.direction() if link else None
+        self.packets = deque()
+        self.written = 0
+        self.popped = 0
+        # Virtual times at which the most recent packets were read.
+        self.pop_times = deque((), buffer_size)
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def close(self) -> None:
+        """Drops all queued packets and wakes anyone waiting."""
+        with self.condition:
+            self.closed = True
+            self.packets.clear()
+            self.condition.notify_all()
+
+
+class LoopbackTransport(Transport):
+    """One end of an in-process link. Create connected ends with `loopback_pair`."""
+
+    def __init__(self, incoming: _Pipe, outgoing: _Pipe, packet_length: int) -> None:
+        self._incoming = incoming
+        self._outgoing = outgoing
+        self._packet_length = packet_length
+        self.clock = 0.0
+        """Virtual time in seconds this end has reached. Only advances with an `EmulatedLink`."""
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.round_trips = 0
+        """Number of times this end sent after waiting on the other. Counts the first send too."""
+        self.poll_interval = POLL_INTERVAL
+        """Seconds an empty `readinto` waits for a packet. 0 never blocks, for use from an event
+        loop."""
+        self._awaiting_reply = False
+
+    @property
+    def incoming_packet_length(self) -> int:
+        """Maximum length in bytes of a packet that can be received."""
+        return self._packet_length
+
+    @property
+    def outgoing_packet_length(self) -> int:
+        """Maximum length in bytes of a packet that can be sent."""
+        return self._packet_length
+
+    @property
+    def buffer_size(self) -> int:
+        """Number of packets the other end can hold before it has read them."""
+        return self._outgoing.buffer_size
+
+    def readinto(self, buffer: WriteableBuffer) -> int:
+        """Reads a single packet into buffer, truncating it if needed. Waits up to
+        `poll_interval` for one to arrive and returns 0 if none did."""
+        pipe = self._incoming
+        with pipe.condition:
+            if not pipe.packets and not pipe.closed and self.poll_interval:
+                pipe.condition.wait(self.poll_interval)
+            if pipe.closed:
+                raise ConnectionError("Disconnected")
+            if not pipe.packets:
+                return 0
+            delivered, packet = pipe.packets.popleft()
+            self.clock = max(self.clock, delivered)
+            pipe.popped += 1
+            pipe.pop_times.append(self.clock)
+            pipe.condition.notify_all()
+        if pipe.link:
+            pipe.link.advance(self.clock)
+            self.clock += pipe.link.handling_time
+        self.packets_received += 1
+        self.bytes_received += len(packet)
+        self._awaiting_reply = False
+        read = min(len(packet), len(buffer))
+        buffer[:read] = packet[:read]
+        return read
+
+    def write(self, packet: ReadableBuffer) -> int:
+        """Queues packet for the other end. Blocks while the other end's buffer is full. With an
+        `EmulatedLink` that has overflow, a packet that would arrive while the buffer is full in
+        virtual time is dropped instead of waiting, though this still blocks until the other end
+        has read far enough to tell."""
+        if len(packet) > self._packet_length:
+            raise ValueError("Packet too long")
+        if not self._awaiting_reply:
+            self.round_trips += 1
+            self._awaiting_reply = True
+        self.packets_sent += 1
+        self.bytes_sent += len(packet)
+        pipe = self._outgoing
+        with pipe.condition:
+            while len(pipe.packets) >= pipe.buffer_size and not pipe.closed:
+                pipe.condition.wait()
+            if pipe.closed:
+                raise ConnectionError("Disconnected")
+            link = pipe.link
+            if link is None:
+                pipe.packets.append((0.0, bytes(packet)))
+                pipe.condition.notify_all()
+                return len(packet)
+            # When room for this packet was made, by reading the packet buffer_size ahead of it.
+            room = None
+            if pipe.written >= pipe.buffer_size:
+                room = pipe.pop_times[pipe.written - pipe.buffer_size - pipe.popped]
+                if not link.overflow:
+                    # Wait for it. The other end may not have reached that time yet.
+                    self.clock = max(self.clock, room)
+            pipe.written += 1
+            delivered = link.schedule(pipe.direction, self.clock)
+        if link.disconnected(delivered):
+            self.close()
+        if pipe.closed:
+            raise ConnectionError("Disconnected")
+        with pipe.condition:
+            if room is not None and delivered < room:
+                # It arrived while the buffer was full. A PacketBuffer drops its oldest packet
+                # but that one has been read already, so this one is dropped instead.
+                link.packets_overrun += 1
+                pipe.popped += 1
+                pipe.pop_times.append(delivered)
+            else:
+                pipe.packets.append((delivered, bytes(packet)))
+            pipe.condition.notify_all()
+        link.advance(self.clock)
+        return len(packet)
+
+    def close(self) -> None:
+        """Disconnects both ends. Any further use raises `ConnectionError`."""
+        self._incoming.close()
+        self._outgoing.close()
+
+
+def loopback_pair(
+    *, packet_length: int = 512, buffer_size: int = 4, link: Optional[EmulatedLink] = None
+) -> Tuple[LoopbackTransport, LoopbackTransport]:
+    """Returns two connected `LoopbackTransport` ends.
+
+    :param int packet_length: Maximum packet length in each direction. Matches the
+      ``max_packet_size`` of the service's PacketBuffer by default.
+    :param int buffer_size: Number of packets each end can hold before the sender blocks. A real
+      PacketBuffer drops packets instead, which `EmulatedLink` can model with overflow.
+    :param EmulatedLink link: Timing model for the link. Overrides packet_length and buffer_size.
+    """
+    if link is not None:
+        packet_length = link.packet_length
+        buffer_size = link.buffer_size
+    a_to_b = _Pipe(buffer_size, link)
+    b_to_a = _Pipe(buffer_size, link)
+    return (
+        LoopbackTransport(b_to_a, a_to_b, packet_length),
+        LoopbackTransport(a_to_b, b_to_a, packet_length),
+    )
+
+
+class LoopbackService:
+    """Stand-in for a connected `FileTransferService` whose server runs in a background thread.
+    Pass it to `FileTransferClient` in place of the BLE service.
+
+    :param FileTransferServer server: The server to talk to.
+    :param int packet_length: Maximum packet length in each direction.
+    :param int buffer_size: Number of packets each end can hold before the sender blocks. A real
+      PacketBuffer drops packets instead, which `EmulatedLink` can model with overflow.
+    :param EmulatedLink link: Timing model for the link. Its ``elapsed`` time tells how long the
+      traffic so far would have taken over the air.
+    :param float poll_interval: Seconds the client end waits for a packet before returning 0. Use
+      0 with `adafruit_ble_file_transfer.async_client.AsyncFileTransferClient` so the event loop
+      is never blocked.
+    """
+
+    def __init__(
+        self,
+        server: FileTransferServer,
+        *,
+        packet_length: int = 512,
+        buffer_size: int = 4,
+        link: Optional[EmulatedLink] = None,
+        poll_interval: float = POLL_INTERVAL,
+    ) -> None:
+        self.version = server.version
+        self.link = link
+        self.raw, server_end = loopback_pair(
+            packet_length=packet_length, buffer_size=buffer_size, link=link
+        )
+        self.raw.poll_interval = poll_interval
+        self._thread = threading.Thread(target=server.serve, args=(server_end,), daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """Disconnects the client and waits for the server to stop."""
+        self.raw.close()
+        self._thread.join()
+
+    def __enter__(self) -> "LoopbackService":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
@@ -0,0 +1,90 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer.progress`
+================================================================================
+
+Records how far reads and writes got so that ones cut short by a disconnect can be resumed.
+
+Give a `ProgressLog` to a `adafruit_ble_file_transfer.client.FileTransferClient` as
+``progress=`` and pass the same log to the client made after reconnecting. Reading or writing the
+same path again then carries on from where the other end last confirmed, instead of from the
+start, as long as the file still has the length and the starting bytes it had when the transfer
+stopped.
+
+* Author(s): Scott Shawcroft
+"""
+
+try:
+    from typing import Optional
+
+    from circuitpython_typing import WriteableBuffer
+except ImportError:
+    pass
+
+
+class Progress:
+    """How far one read or write of a whole file got.
+
+    :param str kind: ``"read"`` or ``"write"``.
+    :param str path: The file's path.
+    :param int length: Length of the whole file.
+    :param bytearray contents: The buffer a read stores the file in.
+    """
+
+    def __init__(
+        self, kind: str, path: str, length: int, contents: Optional[WriteableBuffer] = None
+    ) -> None:
+        self.kind = kind
+        self.path = path
+        self.length = length
+        self.contents = contents
+        self.confirmed = 0
+        """Bytes from the start of the file that the other end has confirmed storing, for a
+        write, or that have arrived in order, for a read."""
+
+
+class ProgressLog:
+    """The `Progress` of the reads and writes that haven't finished, by path.
+
+    A transfer's progress is dropped once it finishes. A read's progress holds the contents
+    received so far, so `discard` the ones that won't be tried again.
+
+    Use one log per device.
+    """
+
+    def __init__(self) -> None:
+        self.resumed = 0
+        """Number of transfers that carried on from where an earlier one stopped."""
+        self.skipped = 0
+        """Bytes not sent again because their transfer was resumed."""
+        self._transfers = {}
+
+    def __len__(self) -> int:
+        return len(self._transfers)
+
+    def get(self, kind: str, path: str) -> Optional[Progress]:
+        """Returns the progress of the unfinished transfer of kind at path, or None."""
+        progress = self._transfers.get(path)
+        if progress is None or progress.kind != kind:
+            return None
+        return progress
+
+    def start(
+        self, kind: str, path: str, length: int, contents: Optional[WriteableBuffer] = None
+    ) -> Progress:
+        """Records a new transfer of kind at path, replacing any earlier one of the path, and
+        returns its `Progress` to be updated as it goes."""
+        progress = Progress(kind, path, length, contents)
+        self._transfers[path] = progress
+        return progress
+
+    def discard(self, path: str) -> None:
+        """Drops the progress of the transfer at path, such as once it finishes, so that the
+        next transfer of it starts from the beginning."""
+        self._transfers.pop(path, None)
+
+    def clear(self) -> None:
+        """Drops all progress."""
+        self._transfers.clear()
@@ -0,0 +1,64 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer.replay`
+================================================================================
+
+Transport that feeds a `adafruit_ble_file_transfer.client.FileTransferClient` canned server
+packets, so that the client's own work can be measured without a server or a radio. Runs on
+CircuitPython or a host.
+
+.. code-block:: python
+
+    client = FileTransferClient(ReplayService(4), transport=ReplayTransport(packets))
+
+* Author(s): Scott Shawcroft
+"""
+
+from adafruit_ble_file_transfer.transport import Transport
+
+try:
+    from typing import List
+
+    from circuitpython_typing import ReadableBuffer, WriteableBuffer
+except ImportError:
+    pass
+
+
+class ReplayTransport(Transport):
+    """Returns the given packets in order from `readinto` and drops everything written.
+
+    :param list packets: Server packets to replay, each at most packet_length long.
+    :param int packet_length: Incoming and outgoing packet length.
+    """
+
+    def __init__(self, packets: List[ReadableBuffer], packet_length: int = 512) -> None:
+        self.incoming_packet_length = packet_length
+        self.outgoing_packet_length = packet_length
+        self._packets = packets
+        self.packets_read = 0
+        """Number of packets replayed so far."""
+
+    def readinto(self, buffer: WriteableBuffer) -> int:
+        """Copies the next packet into buffer and returns its length."""
+        packet = self._packets[self.packets_read]
+        self.packets_read += 1
+        length = len(packet)
+        buffer[:length] = packet
+        return length
+
+    def write(self, packet: ReadableBuffer) -> int:
+        """Drops packet."""
+        return len(packet)
+
+
+class ReplayService:
+    """Stands in for a connected `adafruit_ble_file_transfer.FileTransferService` so the client
+    knows which protocol version the replayed packets follow.
+
+    :param int version: Protocol version of the server that sent the packets.
+    """
+
+    def __init__(self, version: int) -> None:
+        self.version = version
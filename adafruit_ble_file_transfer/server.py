@@ -0,0 +1,535 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer.server`
+================================================================================
+
+File transfer server that serves a `adafruit_ble_file_transfer.storage.Storage` over any
+`Transport`.
+
+* Author(s): Scott Shawcroft
+"""
+
+from binascii import crc32
+
+from adafruit_ble_file_transfer import FileTransferService, codec
+from adafruit_ble_file_transfer.storage import MemoryStorage, Storage
+from adafruit_ble_file_transfer.transport import Packetizer
+
+try:
+    from typing import Optional
+
+    from circuitpython_typing import ReadableBuffer, WriteableBuffer
+
+    from adafruit_ble_file_transfer.transport import Transport
+except ImportError:
+    pass
+
+CHUNK_SIZE = 4000
+
+# Trucate to the nearest 3 seconds.
+_TIME_TRUNCATION = 3 * 1_000_000_000
+
+# Reads and writes go back and forth with the client so only commands answered by the server alone
+# can be tagged.
+_TAGGABLE = (
+    FileTransferService.MKDIR,
+    FileTransferService.LISTDIR,
+    FileTransferService.LISTDIR_PAGE,
+    FileTransferService.DELETE,
+    FileTransferService.MOVE,
+)
+
+
+class FileTransferServer:
+    """Serves the file transfer protocol from a `Storage`.
+
+    Commands are handled by looking up their command byte in `handlers`. A subclass or user can
+    add or replace entries to handle other commands.
+
+    :param Storage storage: Where files are kept. Defaults to an empty
+      `adafruit_ble_file_transfer.storage.MemoryStorage`.
+    :param int chunk_size: The most file data to accept in one write chunk.
+    """
+
+    version = 9
+
+    def __init__(self, storage: Optional[Storage] = None, *, chunk_size: int = CHUNK_SIZE) -> None:
+        self.storage = MemoryStorage() if storage is None else storage
+        """Where files are kept."""
+        self.chunk_size = chunk_size
+        self.handlers = {
+            FileTransferService.WRITE: self._write,
+            FileTransferService.READ: self._read,
+            FileTransferService.MKDIR: self._mkdir,
+            FileTransferService.LISTDIR: self._listdir,
+            FileTransferService.LISTDIR_PAGE: self._listdir_page,
+            FileTransferService.DELETE: self._delete,
+            FileTransferService.MOVE: self._move,
+            FileTransferService.TAG: self._tagged,
+            FileTransferService.ABORT: self._abort,
+            FileTransferService.HASH: self._hash,
+            FileTransferService.PATCH: self._patch,
+        }
+        """Command handlers by command byte. Each is called with the packet that starts the
+        command."""
+        self._transport = None
+        self._packetizer = None
+        self._packet_buffer = bytearray(chunk_size + 20)
+        self._packet_view = memoryview(self._packet_buffer)
+        # Reply headers are packed into this. LISTDIR_ENTRY is the longest.
+        self._reply = bytearray(codec.LISTDIR_ENTRY_HEADER.size)
+        self._reply_view = memoryview(self._reply)
+        self._tag_reply = bytearray(codec.TAG_REPLY_HEADER.size)
+        # READ_DATA replies are read from storage into this after their header. It grows to the
+        # largest chunk asked for.
+        self._data = bytearray(codec.READ_DATA_HEADER.size + 512)
+        self._data_view = memoryview(self._data)
+        # Request ID of the tagged command being handled. Its first reply packet is tagged.
+        self._tag = None
+
+    def serve(self, transport: Transport) -> None:
+        """Handles commands from transport until it disconnects."""
+        self._transport = transport
+        self._packetizer = Packetizer(transport)
+        try:
+            while True:
+                read = transport.readinto(self._packet_buffer)
+                if read == 0:
+                    continue
+                self.handle_command(self._packet_view[:read])
+        except ConnectionError:
+            pass
+        finally:
+            self._transport = None
+            self._packetizer = None
+
+    def handle_command(self, p: memoryview) -> None:
+        """Handles the single command that starts at the beginning of p."""
+        handler = self.handlers.get(p[0])
+        if handler is None:
+            print("unknown command", hex(p[0]))
+            return
+        handler(p)
+
+    def _tagged(self, p: memoryview) -> None:
+        request_id = codec.decode_tag_from(p)[1]
+        p = p[codec.TAG_HEADER.size :]
+        if len(p) == 0 or p[0] not in _TAGGABLE:
+            self._send_reply(
+                codec.encode_tag_reply_into(
+                    self._reply, FileTransferService.ERROR_PROTOCOL, request_id
+                )
+            )
+            return
+        self._tag = request_id
+        try:
+            self.handle_command(p)
+        finally:
+            self._tag = None
+
+    def _abort(self, p: memoryview) -> None:
+        # Nothing is in progress so there is nothing to stop.
+        self._send_abort_status()
+
+    def _read_packets(self, buf: WriteableBuffer, *, target_size: Optional[int] = None) -> int:
+        if target_size is None:
+            target_size = len(buf)
+        total_read = 0
+        buf = memoryview(buf)
+        while total_read < target_size:
+            total_read += self._transport.readinto(buf[total_read:])
+        return total_read
+
+    def _append_packets(self, *parts: ReadableBuffer) -> None:
+        """Adds parts to the packet being filled, after a TAG_REPLY header when they start the
+        first reply to a tagged command. Full packets are sent as they fill."""
+        if self._tag is not None:
+            codec.TAG_REPLY_HEADER.pack_into(
+                self._tag_reply, 0, FileTransferService.TAG_REPLY, FileTransferService.OK, self._tag
+            )
+            self._tag = None
+            self._packetizer.append(self._tag_reply, *parts)
+            return
+        self._packetizer.append(*parts)
+
+    def _write_packets(self, *parts: ReadableBuffer) -> None:
+        """Sends parts back to back as one reply, after a TAG_REPLY header when it is the first
+        reply to a tagged command."""
+        self._append_packets(*parts)
+        self._packetizer.flush()
+
+    def _send_reply(self, size: int) -> None:
+        self._write_packets(self._reply_view[:size])
+
+    def _send_abort_status(self) -> None:
+        self._send_reply(codec.encode_abort_status_into(self._reply, FileTransferService.OK))
+
+    def _read_complete_path(self, starting_path: memoryview, total_length: int) -> str:
+        return str(self._read_complete_path_bytes(starting_path, total_length), "utf-8")
+
+    def _read_complete_path_bytes(self, starting_path: memoryview, total_length: int) -> bytearray:
+        complete_path = bytearray(total_length)
+        current_path_length = min(len(starting_path), total_length)
+        remaining_path = total_length - current_path_length
+        complete_path[:current_path_length] = starting_path[:current_path_length]
+        if remaining_path > 0:
+            self._read_packets(
+                memoryview(complete_path)[current_path_length:], target_size=remaining_path
+            )
+        return complete_path
+
+    def _write(self, p: memoryview) -> None:
+        (
+            _,
+            path_length,
+            start_offset,
+            modification_time,
+            content_length,
+        ) = codec.decode_write_from(p)
+        path_start = codec.WRITE_HEADER.size
+        path = self._read_complete_path(p[path_start:], path_length)
+        truncated_time = (modification_time // _TIME_TRUNCATION) * _TIME_TRUNCATION
+        file = self.storage.open_write(path, content_length)
+        checksum = codec.decode_flags_from(p) & codec.CHECKSUM
+        self._store(path, file, start_offset, content_length, truncated_time, checksum)
+
+    def _patch(self, p: memoryview) -> None:
+        (
+            _,
+            path_length,
+            start_offset,
+            modification_time,
+            file_length,
+            data_length,
+        ) = codec.decode_patch_from(p)
+        path_start = codec.PATCH_HEADER.size
+        path = self._read_complete_path(p[path_start:], path_length)
+        truncated_time = (modification_time // _TIME_TRUNCATION) * _TIME_TRUNCATION
+        end = start_offset + data_length
+        file = self.storage.open_patch(path, file_length) if end <= file_length else None
+        checksum = codec.decode_flags_from(p) & codec.CHECKSUM
+        self._store(path, file, start_offset, end, truncated_time, checksum)
+
+    def _store(
+        self,
+        path: str,
+        file: Optional[object],
+        start_offset: int,
+        end: int,
+        truncated_time: int,
+        checksum: bool,
+    ) -> None:
+        """Receives the bytes from start_offset up to end into file, which is None if it
+        couldn't be opened, and closes it. The write is confirmed once they are stored."""
+        if file is None:
+            self._send_reply(
+                codec.encode_write_pacing_into(
+                    self._reply, FileTransferService.ERROR, 0, truncated_time, 0
+                )
+            )
+            return
+        try:
+            finished = self._receive(file, start_offset, end, truncated_time, checksum)
+        finally:
+            file.close()
+        if not finished:
+            return
+
+        self.storage.set_modification_time(path, truncated_time)
+        self._send_reply(
+            codec.encode_write_pacing_into(
+                self._reply, FileTransferService.OK, end, truncated_time, 0
+            )
+        )
+
+    def _receive(
+        self,
+        file,
+        start_offset: int,
+        content_length: int,
+        truncated_time: int,
+        checksum: bool = False,
+    ) -> bool:
+        """Asks for and stores the chunks of a write. Returns whether they all arrived. With
+        checksum, a chunk whose CRC32 doesn't match is asked for again."""
+        file.seek(start_offset)
+        contents_read = start_offset
+        write_data_header_size = codec.PACING_HEADER.size
+        trailer = codec.CHUNK_CRC.size if checksum else 0
+        while contents_read < content_length:
+            next_amount = min(self.chunk_size, content_length - contents_read)
+            codec.WRITE_PACING_HEADER.pack_into(
+                self._reply,
+                0,
+                FileTransferService.WRITE_PACING,
+                FileTransferService.OK,
+                contents_read,
+                truncated_time,
+                next_amount,
+            )
+            self._send_reply(codec.WRITE_PACING_HEADER.size)
+            read = self._read_packets(self._packet_buffer, target_size=write_data_header_size)
+            cmd, status, offset, data_size = codec.decode_write_data_from(self._packet_buffer)
+            if cmd == FileTransferService.ABORT:
+                self._send_abort_status()
+                return False
+            if (
+                cmd != FileTransferService.WRITE_DATA
+                or offset != contents_read
+                or data_size > next_amount
+            ):
+                self._send_reply(
+                    codec.encode_write_pacing_into(
+                        self._reply, FileTransferService.ERROR_PROTOCOL, 0, truncated_time, 0
+                    )
+                )
+                print("protocol error, resetting")
+                return False
+            if status != FileTransferService.OK:
+                print("bad status, resetting")
+                return False
+            data_end = write_data_header_size + data_size
+            remaining = data_end + trailer - read
+            if remaining > 0:
+                self._read_packets(self._packet_view[read:], target_size=remaining)
+
+            data = self._packet_view[write_data_header_size:data_end]
+            if (
+                checksum
+                and crc32(data) != codec.CHUNK_CRC.unpack_from(self._packet_buffer, data_end)[0]
+            ):
+                # Asking for the same offset again gets the chunk resent.
+                continue
+            file.write(data)
+            contents_read += data_size
+        return True
+
+    def _data_buffer(self, size: int) -> memoryview:
+        """Returns the READ_DATA buffer, grown to at least size bytes."""
+        if len(self._data) < size:
+            self._data = bytearray(size)
+            self._data_view = memoryview(self._data)
+        return self._data_view
+
+    def _read(self, p: memoryview) -> None:
+        _, path_length, offset, free_space = codec.decode_read_from(p)
+        path_start = codec.READ_HEADER.size
+        path = self._read_complete_path(p[path_start:], path_length)
+        opened = self.storage.open_read(path)
+        if opened is None:
+            self._send_reply(
+                codec.encode_read_data_into(self._reply, FileTransferService.ERROR_NO_FILE, 0, 0, 0)
+            )
+            return
+        file, length = opened
+        checksum = codec.decode_flags_from(p) & codec.CHECKSUM
+        try:
+            self._send_file(file, length, offset, free_space, checksum)
+        finally:
+            file.close()
+
+    def _send_file(
+        self, file, length: int, contents_sent: int, free_space: int, checksum: bool = False
+    ) -> None:
+        """Sends READ_DATA chunks read straight from file as the client asks for them.
+
+        With checksum, each chunk's CRC32 follows its data. The client may then ask for any
+        offset again and ends the read with a READ_PACING of size 0 once it has every chunk."""
+        header_size = codec.READ_DATA_HEADER.size
+        trailer = codec.CHUNK_CRC.size if checksum else 0
+        file.seek(contents_sent)
+        while True:
+            next_amount = max(0, min(length - contents_sent, free_space))
+            end = header_size + next_amount
+            buffer = self._data_buffer(end + trailer)
+            codec.READ_DATA_HEADER.pack_into(
+                buffer,
+                0,
+                FileTransferService.READ_DATA,
+                FileTransferService.OK,
+                contents_sent,
+                length,
+                next_amount,
+            )
+            filled = header_size
+            while filled < end:
+                count = file.readinto(buffer[filled:end])
+                if not count:
+                    # The file shrank while being read.
+                    buffer[filled:end] = bytes(end - filled)
+                    break
+                filled += count
+            if checksum:
+                codec.CHUNK_CRC.pack_into(buffer, end, crc32(buffer[header_size:end]))
+            self._write_packets(buffer[: end + trailer])
+            contents_sent += next_amount
+
+            if contents_sent >= length and not checksum:
+                return
+
+            self._read_packets(self._packet_buffer, target_size=codec.PACING_HEADER.size)
+            cmd, _, offset, free_space = codec.decode_read_pacing_from(self._packet_buffer)
+            if cmd == FileTransferService.ABORT:
+                self._send_abort_status()
+                return
+            if checksum and cmd == FileTransferService.READ_PACING:
+                if free_space == 0:
+                    return
+                if offset != contents_sent:
+                    # A chunk that failed its checksum is sent again.
+                    file.seek(offset)
+                    contents_sent = offset
+            if cmd != FileTransferService.READ_PACING or offset != contents_sent:
+                self._send_reply(
+                    codec.encode_read_data_into(
+                        self._reply, FileTransferService.ERROR_PROTOCOL, 0, 0, 0
+                    )
+                )
+                print("protocol error")
+                return
+
+    def _mkdir(self, p: memoryview) -> None:
+        _, path_length, modification_time = codec.decode_mkdir_from(p)
+        truncated_time = (modification_time // _TIME_TRUNCATION) * _TIME_TRUNCATION
+        path_start = codec.MKDIR_HEADER.size
+        path = self._read_complete_path(p[path_start:], path_length)
+
+        if self.storage.mkdir(path, truncated_time):
+            size = codec.encode_mkdir_status_into(
+                self._reply, FileTransferService.OK, truncated_time
+            )
+        else:
+            size = codec.encode_mkdir_status_into(self._reply, FileTransferService.ERROR, 0)
+        self._send_reply(size)
+
+    def _listdir(self, p: memoryview) -> None:
+        path_length = codec.decode_listdir_from(p)[1]
+        path_start = codec.PATH_HEADER.size
+        path = self._read_complete_path(p[path_start:], path_length)
+        self._send_listing(path, 0, None)
+
+    def _listdir_page(self, p: memoryview) -> None:
+        _, path_length, start, count = codec.decode_listdir_page_from(p)
+        path_start = codec.LISTDIR_PAGE_HEADER.size
+        path = self._read_complete_path(p[path_start:], path_length)
+        self._send_listing(path, start, count)
+
+    def _send_listing(self, path: str, start: int, count: Optional[int]) -> None:
+        """Sends the entries of the directory at path from index start, up to count of them, and
+        then the entry that ends the listing."""
+        entries = self.storage.listdir(path)
+        if entries is None:
+            self._send_reply(
+                codec.encode_listdir_entry_into(
+                    self._reply, FileTransferService.ERROR, 0, 0, 0, 0, 0, 0
+                )
+            )
+            return
+
+        total_files = len(entries)
+        end = total_files if count is None else min(start + count, total_files)
+        # Entries are packed into as few packets as possible. Names may be split between packets
+        # but headers never are, since older clients decode each header where it starts.
+        packet_length = self._transport.outgoing_packet_length
+        header_size = codec.LISTDIR_ENTRY_HEADER.size
+        packetizer = self._packetizer
+        for i in range(start, end):
+            filename, flags, modification_time, content_length = entries[i]
+            encoded_filename = filename.encode("utf-8")
+            pending = packetizer.pending
+            if pending and pending + header_size > packet_length:
+                packetizer.flush()
+            codec.LISTDIR_ENTRY_HEADER.pack_into(
+                self._reply,
+                0,
+                FileTransferService.LISTDIR_ENTRY,
+                FileTransferService.OK,
+                len(encoded_filename),
+                i,
+                total_files,
+                flags,
+                modification_time,
+                content_length,
+            )
+            self._append_packets(self._reply_view[:header_size], encoded_filename)
+
+        if packetizer.pending + header_size > packet_length:
+            packetizer.flush()
+        self._send_reply(
+            codec.encode_listdir_entry_into(
+                self._reply, FileTransferService.OK, 0, end, total_files, 0, 0, 0
+            )
+        )
+
+    def _hash(self, p: memoryview) -> None:
+        _, path_length, block_size = codec.decode_hash_from(p)
+        path_start = codec.HASH_HEADER.size
+        path = self._read_complete_path(p[path_start:], path_length)
+        opened = self.storage.open_read(path) if block_size else None
+        if opened is None:
+            self._send_reply(
+                codec.encode_hashes_into(self._reply, FileTransferService.ERROR_NO_FILE, 0, 0)
+            )
+            return
+        file, length = opened
+        try:
+            self._send_hashes(file, length, block_size)
+        finally:
+            file.close()
+
+    def _send_hashes(self, file, length: int, block_size: int) -> None:
+        """Sends the CRC32 of each block of file, reading it through the READ_DATA buffer so
+        blocks of any size take no extra memory."""
+        count = (length + block_size - 1) // block_size
+        self._append_packets(
+            self._reply_view[
+                : codec.encode_hashes_into(self._reply, FileTransferService.OK, length, count)
+            ]
+        )
+        buffer = self._data_view
+        hash_view = self._reply_view[: codec.BLOCK_HASH.size]
+        for i in range(count):
+            remaining = min(block_size, length - i * block_size)
+            value = 0
+            while remaining:
+                read = file.readinto(buffer[: min(len(buffer), remaining)])
+                if not read:
+                    # The file shrank while being read.
+                    break
+                value = crc32(buffer[:read], value)
+                remaining -= read
+            codec.BLOCK_HASH.pack_into(hash_view, 0, value)
+            self._append_packets(hash_view)
+        self._packetizer.flush()
+
+    def _delete(self, p: memoryview) -> None:
+        path_length = codec.decode_delete_from(p)[1]
+        path_start = codec.PATH_HEADER.size
+        path = self._read_complete_path(p[path_start:], path_length)
+
+        if not self.storage.delete(path):
+            print("missing path", path)
+            self._send_reply(
+                codec.encode_delete_status_into(self._reply, FileTransferService.ERROR)
+            )
+            return
+        self._send_reply(codec.encode_delete_status_into(self._reply, FileTransferService.OK))
+
+    def _move(self, p: memoryview) -> None:
+        _, old_path_length, new_path_length = codec.decode_move_from(p)
+        path_start = codec.MOVE_HEADER.size
+        # We read in one extra character and then discard it. We don't need it. (C does.)
+        # The lengths are in bytes so split before decoding.
+        both_paths = self._read_complete_path_bytes(
+            p[path_start:], old_path_length + 1 + new_path_length
+        )
+        old_path = str(both_paths[:old_path_length], "utf-8")
+        new_path = str(both_paths[old_path_length + 1 :], "utf-8")
+
+        if not self.storage.move(old_path, new_path):
+            print("bad move", old_path, new_path)
+            self._send_reply(codec.encode_move_status_into(self._reply, FileTransferService.ERROR))
+            return
+        self._send_reply(codec.encode_move_status_into(self._reply, FileTransferService.OK))
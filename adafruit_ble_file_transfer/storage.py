@@ -0,0 +1,478 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer.storage`
+================================================================================
+
+Where a `adafruit_ble_file_transfer.server.FileTransferServer` keeps its files.
+
+Paths are full protocol paths that start with ``/``. Directory paths may end with ``/``. File
+contents are read and written through open file objects so a backend never has to hold a whole
+file in memory.
+
+* Author(s): Scott Shawcroft
+"""
+
+import os
+
+from adafruit_ble_file_transfer import codec
+
+try:
+    from bisect import bisect_left
+except ImportError:
+
+    def bisect_left(items: list, item: str) -> int:
+        """Returns where item goes in the sorted list items, before any equal item."""
+        low = 0
+        high = len(items)
+        while low < high:
+            middle = (low + high) // 2
+            if items[middle] < item:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+try:
+    from typing import List, Optional, Tuple
+
+    from circuitpython_typing import ReadableBuffer, WriteableBuffer
+except ImportError:
+    pass
+
+# Mode bit of a directory in os.stat results.
+_S_IFDIR = 0x4000
+
+
+def split_path(path: str) -> Tuple[str, str]:
+    """Splits path into its parent directory path and final name, ignoring a trailing /."""
+    if path.endswith("/"):
+        path = path[:-1]
+    parent, _, name = path.rpartition("/")
+    return parent, name
+
+
+class Storage:
+    """Base for a filesystem served by `adafruit_ble_file_transfer.server.FileTransferServer`.
+    On its own it is an empty, read-only filesystem. Backends override the methods for what they
+    hold and can change, and anything with the same methods can be served without subclassing.
+
+    Entries returned by `listdir` are ``(name, flags, modification_time, size)`` tuples where
+    flags is `adafruit_ble_file_transfer.FileTransferService.DIRECTORY` for directories."""
+
+    def open_read(self, path: str) -> Optional[Tuple[object, int]]:
+        """Opens the file at path for reading. Returns the open file and its length, or None if
+        it is missing or a directory, which is the default. The file needs ``seek``,
+        ``readinto`` and ``close``."""
+        return None
+
+    def open_write(self, path: str, length: int) -> Optional[object]:
+        """Opens the file at path for writing, creating it if needed, and sets its length to
+        length. Returns None if it can't be written, such as when its directory is missing,
+        which is the default. The file needs ``seek``, ``write`` and ``close``."""
+        return None
+
+    def open_patch(self, path: str, length: int) -> Optional[object]:
+        """Opens the existing file at path for writing parts of it and sets its length to length
+        while keeping its contents. Returns None if it is missing or its contents can't be kept,
+        which is the default, so that clients write the whole file instead. The file needs
+        ``seek``, ``write`` and ``close``."""
+        return None
+
+    def set_modification_time(self, path: str, modification_time: int) -> None:
+        """Records the modification time in nanoseconds of a file that has been written. Does
+        nothing by default so the filesystem's own times are listed."""
+
+    def mkdir(self, path: str, modification_time: int) -> bool:
+        """Makes the directory and any missing parents. Returns False if a file is in the way
+        or directories can't be made, which is the default."""
+        return False
+
+    def listdir(self, path: str) -> Optional[List[Tuple[str, int, int, int]]]:
+        """Returns the entries of the directory at path or None if it isn't a directory. By
+        default the root is the only directory and it is empty."""
+        if path.strip("/"):
+            return None
+        return []
+
+    def delete(self, path: str) -> bool:
+        """Deletes the file or directory, with its contents, at path. Returns False if it is
+        missing or can't be deleted, which is the default."""
+        return False
+
+    def move(self, old_path: str, new_path: str) -> bool:
+        """Moves the file or directory at old_path to new_path. Returns False if old_path is
+        missing, new_path already exists or has no parent directory, new_path is inside
+        old_path or nothing can be moved, which is the default."""
+        return False
+
+
+class _MemoryFile:
+    """Open file over a bytearray of `MemoryStorage`."""
+
+    def __init__(self, contents: bytearray) -> None:
+        self._contents = contents
+        self._position = 0
+
+    def seek(self, position: int) -> None:
+        """Moves to position."""
+        self._position = position
+
+    def readinto(self, buffer: WriteableBuffer) -> int:
+        """Reads into buffer and returns the number of bytes read."""
+        position = self._position
+        count = max(0, min(len(buffer), len(self._contents) - position))
+        buffer[:count] = memoryview(self._contents)[position : position + count]
+        self._position = position + count
+        return count
+
+    def write(self, data: ReadableBuffer) -> int:
+        """Writes data over the contents without changing their length."""
+        position = self._position
+        count = min(len(data), len(self._contents) - position)
+        self._contents[position : position + count] = data[:count]
+        self._position = position + count
+        return count
+
+    def close(self) -> None:
+        """Does nothing. The contents stay in the storage."""
+
+
+class _Node:
+    """File or directory of `MemoryStorage`. Directories have children and files have
+    contents."""
+
+    def __init__(
+        self, name: str, modification_time: int, contents: Optional[bytearray] = None
+    ) -> None:
+        self.name = name
+        self.parent = None
+        self.modification_time = modification_time
+        self.contents = contents
+        self.children = {} if contents is None else None
+        # Child names in sorted order, kept sorted as children come and go.
+        self.names = [] if contents is None else None
+        # listdir entries in the same order as names once listed, kept up to date after that.
+        self.listing = None
+
+    def entry(self) -> Tuple[str, int, int, int]:
+        """Returns this node's listdir entry."""
+        if self.contents is None:
+            return (self.name, codec.DIRECTORY, self.modification_time, 0)
+        return (self.name, 0, self.modification_time, len(self.contents))
+
+    def add(self, node: "_Node") -> None:
+        """Adds node as a child."""
+        index = bisect_left(self.names, node.name)
+        self.names.insert(index, node.name)
+        if self.listing is not None:
+            self.listing.insert(index, node.entry())
+        self.children[node.name] = node
+        node.parent = self
+
+    def remove(self, name: str) -> "_Node":
+        """Removes and returns the child called name."""
+        index = bisect_left(self.names, name)
+        del self.names[index]
+        if self.listing is not None:
+            del self.listing[index]
+        node = self.children.pop(name)
+        node.parent = None
+        return node
+
+    def update(self, node: "_Node") -> None:
+        """Updates the listdir entry of child node after its size or time changed."""
+        if self.listing is not None:
+            self.listing[bisect_left(self.names, node.name)] = node.entry()
+
+
+class MemoryStorage(Storage):
+    """Keeps files in RAM as a tree of nodes. Each node holds its own modification time and each
+    directory keeps its children both by name and in sorted order, so finding a path walks one
+    node per part and moving relinks a single node. A directory's listing is built once and then
+    updated entry by entry as its children change, so it is never sorted or rebuilt."""
+
+    def __init__(self) -> None:
+        self._root = _Node("", 0)
+
+    def _find(self, path: str) -> Optional[_Node]:
+        """Returns the node at path or None if it is missing."""
+        node = self._root
+        for part in path.split("/"):
+            if not part:
+                continue
+            children = node.children
+            if children is None:
+                return None
+            node = children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def _find_dir(self, path: str) -> Optional[_Node]:
+        """Returns the directory at path or None if it is missing or a file."""
+        node = self._find(path)
+        if node is None or node.children is None:
+            return None
+        return node
+
+    def open_read(self, path: str) -> Optional[Tuple[_MemoryFile, int]]:
+        """Opens the file at path for reading."""
+        node = self._find(path)
+        if node is None or node.contents is None:
+            return None
+        return _MemoryFile(node.contents), len(node.contents)
+
+    def open_write(self, path: str, length: int) -> Optional[_MemoryFile]:
+        """Opens the file at path for writing."""
+        parent_path, filename = split_path(path)
+        parent = self._find_dir(parent_path)
+        if parent is None or not filename:
+            return None
+        node = parent.children.get(filename)
+        if node is None:
+            node = _Node(filename, 0, bytearray(length))
+            parent.add(node)
+            return _MemoryFile(node.contents)
+        contents = node.contents
+        if contents is None:
+            return None
+        current_len = len(contents)
+        if current_len < length:
+            contents.extend(bytearray(length - current_len))
+        elif current_len > length:
+            del contents[length:]
+        parent.update(node)
+        return _MemoryFile(contents)
+
+    def open_patch(self, path: str, length: int) -> Optional[_MemoryFile]:
+        """Opens the existing file at path for writing parts of it."""
+        node = self._find(path)
+        if node is None or node.contents is None:
+            return None
+        return self.open_write(path, length)
+
+    def set_modification_time(self, path: str, modification_time: int) -> None:
+        """Records the modification time of a written file."""
+        node = self._find(path)
+        if node is not None and node.parent is not None:
+            node.modification_time = modification_time
+            node.parent.update(node)
+
+    def mkdir(self, path: str, modification_time: int) -> bool:
+        """Makes the directory and any missing parents."""
+        node = self._root
+        for part in path.split("/"):
+            if not part:
+                continue
+            child = node.children.get(part)
+            if child is None:
+                child = _Node(part, modification_time)
+                node.add(child)
+            elif child.children is None:
+                return False
+            node = child
+        return True
+
+    def listdir(self, path: str) -> Optional[List[Tuple[str, int, int, int]]]:
+        """Returns the entries of the directory at path sorted by name. The list is kept up to
+        date as the directory changes so it must not be modified."""
+        node = self._find_dir(path)
+        if node is None:
+            return None
+        if node.listing is None:
+            children = node.children
+            node.listing = [children[name].entry() for name in node.names]
+        return node.listing
+
+    def delete(self, path: str) -> bool:
+        """Deletes the file or directory at path."""
+        node = self._find(path)
+        if node is None or node.parent is None:
+            return False
+        node.parent.remove(node.name)
+        return True
+
+    def move(self, old_path: str, new_path: str) -> bool:
+        """Moves the file or directory at old_path to new_path. Returns False if new_path is
+        inside old_path too."""
+        node = self._find(old_path)
+        new_parent_path, new_filename = split_path(new_path)
+        new_parent = self._find_dir(new_parent_path)
+        if (
+            node is None
+            or node.parent is None
+            or new_parent is None
+            or not new_filename
+            or new_filename in new_parent.children
+        ):
+            return False
+        ancestor = new_parent
+        while ancestor is not None:
+            if ancestor is node:
+                return False
+            ancestor = ancestor.parent
+        node.parent.remove(node.name)
+        node.name = new_filename
+        new_parent.add(node)
+        return True
+
+
+class OSStorage(Storage):
+    """Serves the files under root on the local filesystem with `os`. File contents are streamed
+    to and from open files in chunks so files of any size can be served.
+
+    Paths with ``.`` or ``..`` parts are refused so nothing outside root is reachable.
+    Modification times are set where ``os.utime`` exists. Without it, such as on CircuitPython,
+    the filesystem's own times are listed.
+
+    :param str root: Local directory that the protocol's ``/`` maps to.
+    """
+
+    def __init__(self, root: str = "/") -> None:
+        self.root = root.rstrip("/")
+
+    def _local(self, path: str) -> Optional[str]:
+        """Returns the local path for path or None if it would leave root."""
+        local = self.root
+        for part in path.split("/"):
+            if not part:
+                continue
+            if part in {".", ".."}:
+                return None
+            local += "/" + part
+        return local or "/"
+
+    @staticmethod
+    def _stat(local: str) -> Optional[tuple]:
+        try:
+            return os.stat(local)
+        except OSError:
+            return None
+
+    def _is_dir(self, local: Optional[str]) -> bool:
+        stat = self._stat(local) if local is not None else None
+        return stat is not None and stat[0] & _S_IFDIR != 0
+
+    @staticmethod
+    def _set_time(local: str, modification_time: int) -> None:
+        utime = getattr(os, "utime", None)
+        if utime is not None:
+            utime(local, ns=(modification_time, modification_time))
+
+    def open_read(self, path: str) -> Optional[Tuple[object, int]]:
+        """Opens the file at path for reading."""
+        local = self._local(path)
+        stat = self._stat(local) if local is not None else None
+        if stat is None or stat[0] & _S_IFDIR:
+            return None
+        return open(local, "rb"), stat[6]
+
+    def open_write(self, path: str, length: int) -> Optional[object]:
+        """Opens the file at path for writing. Where files can't be truncated, such as on
+        CircuitPython, an existing file is emptied first so data before a write's offset is
+        lost."""
+        local = self._local(path)
+        if local is None or local == self.root or not self._is_dir(split_path(local)[0] or "/"):
+            return None
+        stat = self._stat(local)
+        if stat is not None and stat[0] & _S_IFDIR:
+            return None
+        file = open(local, "r+b" if stat is not None else "w+b")
+        truncate = getattr(file, "truncate", None)
+        if truncate is not None:
+            truncate(length)
+        elif stat is not None and stat[6] != 0:
+            file.close()
+            file = open(local, "w+b")
+        return file
+
+    def open_patch(self, path: str, length: int) -> Optional[object]:
+        """Opens the existing file at path for writing parts of it. Where files can't be
+        truncated, such as on CircuitPython, only files that are already length long can be
+        patched."""
+        local = self._local(path)
+        stat = self._stat(local) if local is not None else None
+        if stat is None or stat[0] & _S_IFDIR:
+            return None
+        file = open(local, "r+b")
+        truncate = getattr(file, "truncate", None)
+        if truncate is not None:
+            truncate(length)
+        elif stat[6] != length:
+            file.close()
+            return None
+        return file
+
+    def set_modification_time(self, path: str, modification_time: int) -> None:
+        """Sets the modification time of a written file where supported."""
+        self._set_time(self._local(path), modification_time)
+
+    def mkdir(self, path: str, modification_time: int) -> bool:
+        """Makes the directory and any missing parents."""
+        local = self._local(path)
+        if local is None:
+            return False
+        current = self.root
+        for part in local[len(self.root) :].split("/"):
+            if not part:
+                continue
+            current += "/" + part
+            stat = self._stat(current)
+            if stat is None:
+                os.mkdir(current)
+                self._set_time(current, modification_time)
+            elif not stat[0] & _S_IFDIR:
+                return False
+        return True
+
+    def listdir(self, path: str) -> Optional[List[Tuple[str, int, int, int]]]:
+        """Returns the entries of the directory at path sorted by name."""
+        local = self._local(path)
+        if not self._is_dir(local):
+            return None
+        base = local.rstrip("/") + "/"
+        entries = []
+        for name in sorted(os.listdir(local)):
+            stat = os.stat(base + name)
+            if stat[0] & _S_IFDIR:
+                entries.append((name, codec.DIRECTORY, stat[8] * 1_000_000_000, 0))
+            else:
+                entries.append((name, 0, stat[8] * 1_000_000_000, stat[6]))
+        return entries
+
+    def _remove(self, local: str) -> None:
+        if self._is_dir(local):
+            for name in os.listdir(local):
+                self._remove(local + "/" + name)
+            os.rmdir(local)
+        else:
+            os.remove(local)
+
+    def delete(self, path: str) -> bool:
+        """Deletes the file or directory at path along with its contents."""
+        local = self._local(path)
+        if local is None or local in {self.root, "/"} or self._stat(local) is None:
+            return False
+        self._remove(local)
+        return True
+
+    def move(self, old_path: str, new_path: str) -> bool:
+        """Moves the file or directory at old_path to new_path. Returns False if new_path is
+        inside old_path too."""
+        old_local = self._local(old_path)
+        new_local = self._local(new_path)
+        if (
+            old_local is None
+            or new_local is None
+            or old_local in {self.root, "/"}
+            or new_local.startswith(old_local + "/")
+            or self._stat(old_local) is None
+            or self._stat(new_local) is not None
+            or not self._is_dir(split_path(new_local)[0] or "/")
+        ):
+            return False
+        os.rename(old_local, new_local)
+        return True
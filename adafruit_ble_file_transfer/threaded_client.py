@@ -0,0 +1,270 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer.threaded_client`
+================================================================================
+
+Thread-safe file transfer client. Operations may be submitted from any thread and return
+`concurrent.futures.Future` objects. One worker thread per connection sends them in order so the
+packets of different operations never interleave. Requires CPython threads.
+
+* Author(s): Scott Shawcroft
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from adafruit_ble_file_transfer.client import SYNC_BLOCK_SIZE, FileTransferClient, ProtocolError
+
+try:
+    from typing import Optional
+
+    from adafruit_ble.services import Service
+    from circuitpython_typing import ReadableBuffer
+
+    from adafruit_ble_file_transfer.client import CancelToken
+except ImportError:
+    pass
+
+# Operations without file data. Queued runs of them are sent together as one batch.
+_METADATA = ("mkdir", "listdir", "delete", "move")
+# Metadata operations that change what listdir returns.
+_MUTATIONS = ("mkdir", "delete", "move")
+
+
+class ThreadedFileTransferClient:
+    """Shares one connection between threads. Each method queues the operation of the same name
+    on `adafruit_ble_file_transfer.client.FileTransferClient` and returns a `Future` for its result.
+
+    Operations run one at a time in the order they were submitted. Metadata operations that are
+    queued back to back are sent as one `adafruit_ble_file_transfer.client.Batch` when the server
+    has version 5 or later, and a listdir of a path already listed in the batch, with nothing
+    changed in between, shares the earlier result.
+
+    A future cancelled before its operation starts is skipped. A running transfer can be stopped
+    with a `adafruit_ble_file_transfer.client.CancelToken` from any thread.
+
+    :param Service service: The connected service. Other keyword arguments are passed to
+      `adafruit_ble_file_transfer.client.FileTransferClient`.
+    """
+
+    def __init__(self, service: Service, **client_options) -> None:
+        self.client = FileTransferClient(service, **client_options)
+        """The client the worker runs operations with. Only use it from the worker."""
+        self.coalesced = 0
+        """Number of operations that were sent in a batch with others or shared a result."""
+        self._coalesce = service.version >= 5
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._work, name="FileTransferClient worker", daemon=True
+        )
+        self._thread.start()
+
+    def _submit(self, name: str, *args, **kwargs) -> Future:
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Client is closed")
+            self._queue.append((name, args, kwargs, future))
+            self._condition.notify()
+        return future
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                request = self._queue.popleft()
+                if request is None:
+                    return
+                group = [request]
+                if self._coalesce and request[0] in _METADATA:
+                    queue = self._queue
+                    while queue and queue[0] is not None and queue[0][0] in _METADATA:
+                        group.append(queue.popleft())
+            group = [request for request in group if request[3].set_running_or_notify_cancel()]
+            if len(group) == 1:
+                self._run(group[0])
+            elif group:
+                self._run_batch(group)
+
+    def _run(self, request: tuple) -> None:
+        name, args, kwargs, future = request
+        try:
+            result = getattr(self.client, name)(*args, **kwargs)
+        except (Exception, ProtocolError) as error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _run_batch(self, group: list) -> None:
+        batch = self.client.batch()
+        # Index into the batch results for each request and the latest listing of each path and
+        # page.
+        indices = []
+        listed = {}
+        for name, args, kwargs, _ in group:
+            if name == "listdir":
+                key = (args[0], kwargs["start"], kwargs["limit"], kwargs["refresh"])
+                if key in listed:
+                    indices.append(listed[key])
+                    continue
+                listed[key] = len(batch)
+            elif name in _MUTATIONS:
+                listed.clear()
+            indices.append(len(batch))
+            getattr(batch, name)(*args, **kwargs)
+        self.coalesced += len(group)
+        try:
+            results = batch.run()
+        except (Exception, ProtocolError) as error:
+            for request in group:
+                request[3].set_exception(error)
+            return
+        given = set()
+        for request, index in zip(group, indices):
+            result = results[index]
+            if isinstance(result, ValueError):
+                request[3].set_exception(result)
+                continue
+            if index in given:
+                # Coalesced listings each get their own list to change.
+                result = list(result)
+            given.add(index)
+            request[3].set_result(result)
+
+    def read(
+        self,
+        path: str,
+        *,
+        offset: int = 0,
+        window: Optional[int] = 1,
+        cancel: Optional[CancelToken] = None,
+    ) -> Future:
+        """Queues `adafruit_ble_file_transfer.client.FileTransferClient.read`."""
+        return self._submit("read", path, offset=offset, window=window, cancel=cancel)
+
+    def read_into(
+        self,
+        path: str,
+        destination,
+        *,
+        offset: int = 0,
+        chunk_size: Optional[int] = None,
+        window: Optional[int] = 1,
+        cancel: Optional[CancelToken] = None,
+    ) -> Future:
+        """Queues `adafruit_ble_file_transfer.client.FileTransferClient.read_into`. destination is
+        written to from the worker thread."""
+        return self._submit(
+            "read_into",
+            path,
+            destination,
+            offset=offset,
+            chunk_size=chunk_size,
+            window=window,
+            cancel=cancel,
+        )
+
+    def write(
+        self,
+        path: str,
+        contents: ReadableBuffer,
+        *,
+        offset: int = 0,
+        modification_time: Optional[int] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> Future:
+        """Queues `adafruit_ble_file_transfer.client.FileTransferClient.write`. contents must not
+        change until the future is done."""
+        return self._submit(
+            "write",
+            path,
+            contents,
+            offset=offset,
+            modification_time=modification_time,
+            cancel=cancel,
+        )
+
+    def write_from(
+        self,
+        path: str,
+        source,
+        length: int,
+        *,
+        offset: int = 0,
+        modification_time: Optional[int] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> Future:
+        """Queues `adafruit_ble_file_transfer.client.FileTransferClient.write_from`. source is read
+        from the worker thread."""
+        return self._submit(
+            "write_from",
+            path,
+            source,
+            length,
+            offset=offset,
+            modification_time=modification_time,
+            cancel=cancel,
+        )
+
+    def sync(
+        self,
+        path: str,
+        contents: ReadableBuffer,
+        *,
+        block_size: int = SYNC_BLOCK_SIZE,
+        modification_time: Optional[int] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> Future:
+        """Queues `adafruit_ble_file_transfer.client.FileTransferClient.sync`. contents must not
+        change until the future is done."""
+        return self._submit(
+            "sync",
+            path,
+            contents,
+            block_size=block_size,
+            modification_time=modification_time,
+            cancel=cancel,
+        )
+
+    def mkdir(self, path: str, modification_time: Optional[int] = None) -> Future:
+        """Queues `adafruit_ble_file_transfer.client.FileTransferClient.mkdir`."""
+        return self._submit("mkdir", path, modification_time)
+
+    def listdir(
+        self, path: str, *, start: int = 0, limit: Optional[int] = None, refresh: bool = False
+    ) -> Future:
+        """Queues `adafruit_ble_file_transfer.client.FileTransferClient.listdir`."""
+        return self._submit("listdir", path, start=start, limit=limit, refresh=refresh)
+
+    def delete(self, path: str) -> Future:
+        """Queues `adafruit_ble_file_transfer.client.FileTransferClient.delete`."""
+        return self._submit("delete", path)
+
+    def move(self, old_path: str, new_path: str) -> Future:
+        """Queues `adafruit_ble_file_transfer.client.FileTransferClient.move`."""
+        return self._submit("move", old_path, new_path)
+
+    def close(self, *, cancel_pending: bool = False) -> None:
+        """Stops taking operations and waits for the worker to finish the queued ones. With
+        cancel_pending, queued operations that haven't started are cancelled instead."""
+        with self._condition:
+            if not self._closed:
+                self._closed = True
+                if cancel_pending:
+                    for request in self._queue:
+                        request[3].cancel()
+                self._queue.append(None)
+                self._condition.notify()
+        self._thread.join()
+
+    def __enter__(self) -> "ThreadedFileTransferClient":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
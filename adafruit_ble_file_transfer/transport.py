@@ -0,0 +1,152 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+"""
+`adafruit_ble_file_transfer.transport`
+================================================================================
+
+Packet transports that carry the file transfer protocol.
+
+A transport moves whole packets between a client and a server. The client and server only use
+a few members of it so anything that provides them can stand in for the BLE link.
+
+* Author(s): Scott Shawcroft
+"""
+
+try:
+    from circuitpython_typing import ReadableBuffer, WriteableBuffer
+except ImportError:
+    pass
+
+
+class Transport:
+    """Moves protocol packets. A transport is anything with the parts of `_bleio.PacketBuffer`
+    that the file transfer code uses:
+
+    * ``incoming_packet_length``: Maximum length in bytes of a packet that can be received.
+    * ``outgoing_packet_length``: Maximum length in bytes of a packet that can be sent.
+    * ``readinto(buffer)``: Reads a single packet into buffer and returns its length, or 0 when
+      no packet is available.
+    * ``write(packet)``: Sends packet, which is at most ``outgoing_packet_length`` long, as a
+      single packet.
+
+    Both methods raise `ConnectionError` once the link is gone. Subclassing isn't required. This
+    class only supplies the default `buffer_size`."""
+
+    buffer_size = 1
+    """Number of packets the other end can hold before it has read them. Limits how many requests
+    are sent ahead of replies. Defaults to 1 so nothing is sent ahead."""
+
+
+class Packetizer:
+    """Sends buffers over a transport in packets of at most its ``outgoing_packet_length``.
+
+    The parts given to one `write` are sent as though they were joined, without joining them.
+    Whole packets within a part are sent as slices of it. Only a packet that straddles two parts
+    is assembled, in a packet buffer that is reused.
+
+    `append` packs several small messages into shared packets. It holds back the last partly
+    filled packet until more is appended or `flush` sends it."""
+
+    def __init__(self, transport: Transport) -> None:
+        self._transport = transport
+        self._packet = memoryview(bytearray(0))
+        self._filled = 0
+
+    @property
+    def pending(self) -> int:
+        """Number of appended bytes that haven't been sent yet."""
+        return self._filled
+
+    def write(self, *parts: ReadableBuffer) -> None:
+        """Sends parts back to back, after any appended bytes, split into packets."""
+        if not self._filled and len(parts) == 1:
+            transport = self._transport
+            if len(parts[0]) <= transport.outgoing_packet_length:
+                transport.write(parts[0])
+                return
+        self.append(*parts)
+        self.flush()
+
+    def append(self, *parts: ReadableBuffer) -> None:
+        """Adds parts after any bytes appended before. Full packets are sent straight away."""
+        transport = self._transport
+        length = transport.outgoing_packet_length
+        packet = self._packet
+        filled = self._filled
+        if len(packet) != length and not filled:
+            packet = memoryview(bytearray(length))
+            self._packet = packet
+        for part in parts:
+            view = memoryview(part)
+            size = len(view)
+            start = 0
+            if filled:
+                # Finish the packet that earlier parts started.
+                start = min(length - filled, size)
+                packet[filled : filled + start] = view[:start]
+                filled += start
+                if filled < length:
+                    continue
+                transport.write(packet)
+                filled = 0
+            whole = size - (size - start) % length
+            for offset in range(start, whole, length):
+                transport.write(view[offset : offset + length])
+            if whole < size:
+                filled = size - whole
+                packet[:filled] = view[whole:]
+        self._filled = filled
+
+    def flush(self) -> None:
+        """Sends the partly filled packet, if any."""
+        if self._filled:
+            filled = self._filled
+            self._filled = 0
+            self._transport.write(self._packet[:filled])
+
+
+class PacketBufferTransport(Transport):
+    """Transport over a `_bleio.PacketBuffer` such as the ``raw`` attribute of a connected
+    `FileTransferService`.
+
+    :param int buffer_size: Number of packets the other end's PacketBuffer holds. PacketBuffers
+      don't report it. `FileTransferService` binds its characteristic with 4.
+    """
+
+    def __init__(self, packet_buffer, *, buffer_size: int = 4) -> None:
+        self._packet_buffer = packet_buffer
+        self._buffer_size = buffer_size
+        self._long_buffer = None
+
+    @property
+    def incoming_packet_length(self) -> int:
+        """Maximum length in bytes of a packet that can be received."""
+        return self._packet_buffer.incoming_packet_length
+
+    @property
+    def outgoing_packet_length(self) -> int:
+        """Maximum length in bytes of a packet that can be sent."""
+        return self._packet_buffer.outgoing_packet_length
+
+    @property
+    def buffer_size(self) -> int:
+        """Number of packets the other end can hold before it has read them."""
+        return self._buffer_size
+
+    def readinto(self, buffer: WriteableBuffer) -> int:
+        """Reads a single packet into buffer. Packets longer than buffer are truncated to fit."""
+        try:
+            return self._packet_buffer.readinto(buffer)
+        except ValueError:
+            # The packet is larger than the given buffer so read it into one that fits.
+            if self._long_buffer is None:
+                self._long_buffer = bytearray(512)
+            read = self._packet_buffer.readinto(self._long_buffer)
+            read = min(read, len(buffer))
+            buffer[:read] = self._long_buffer[:read]
+            return read
+
+    def write(self, packet: ReadableBuffer) -> int:
+        """Sends packet as a single packet."""
+        return self._packet_buffer.write(packet)
@@ -0,0 +1,228 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Checks that a preallocated FileTransferClient doesn't allocate buffers per packet once a transfer
+is underway. Runs without a radio on CircuitPython or a host.
+
+The client is fed canned server packets so that only its own allocations are measured. On
+CircuitPython the garbage collector is disabled so ``gc.mem_free()`` drops by exactly what is
+allocated between two packets. Unpacked header tuples account for a few dozen bytes; a per-packet
+buffer, slice copy or header concatenation is the size of a packet.
+
+CPython has no allocation counter. Instead ``tracemalloc`` snapshots the memory allocated by the
+library's own files each time a packet is read or sent. Its peak over the second half of the
+transfer must not be half a packet above its peak over the first half, and no block allocated
+since the client was idle may be as large as a packet. The second check catches a buffer made
+for each packet even when it is freed before the next one, as long as it is still alive while
+the packet is read or sent. One used and freed entirely between two packets isn't seen.
+"""
+
+import gc
+import struct
+import sys
+
+import adafruit_ble_file_transfer
+from adafruit_ble_file_transfer import CHUNK_SIZE, FileTransferClient, FileTransferService
+from adafruit_ble_file_transfer.replay import ReplayService, ReplayTransport
+
+try:
+    from gc import mem_free
+
+    tracemalloc = None
+    LIMIT = 128
+except ImportError:
+    import os
+    import tracemalloc
+
+    mem_free = None
+    LIMIT = 256
+    # Only memory allocated by the library's own files counts.
+    LIBRARY = (
+        tracemalloc.Filter(
+            True, os.path.join(os.path.dirname(adafruit_ble_file_transfer.__file__), "*")
+        ),
+    )
+
+PACKET_LENGTH = 512
+WARM_UP = 4
+FILE_SIZE = 20_000
+WRITE_FREE_SPACE = 490
+
+
+class MemFreeMeter:
+    """Records the largest drop in free memory between two packets read."""
+
+    def __init__(self):
+        self._used = None
+        self.failures = []
+        self.largest = 0
+
+    def start(self):
+        pass
+
+    def sample(self, reading):
+        if not reading:
+            return
+        used = -mem_free()
+        if self._used is not None:
+            rise = used - self._used
+            self.largest = max(self.largest, rise)
+            if rise >= LIMIT:
+                self.failures.append(f"{rise} bytes allocated before a packet")
+        self._used = used
+
+    def summary(self):
+        return f"rose at most {self.largest} bytes between packets"
+
+
+def library_blocks():
+    """Returns the blocks the library has allocated as a dict of trace to count and their total
+    size."""
+    blocks = {}
+    total = 0
+    for trace in tracemalloc.take_snapshot().filter_traces(LIBRARY).traces:
+        blocks[trace] = blocks.get(trace, 0) + 1
+        total += trace.size
+    return blocks, total
+
+
+class SnapshotMeter:
+    """Records the library's memory at each packet and any packet sized blocks it allocates once
+    the client is idle."""
+
+    def __init__(self):
+        self._idle = None
+        self._totals = []
+        self.failures = []
+
+    def start(self):
+        self._idle = library_blocks()[0]
+
+    def sample(self, reading):
+        blocks, total = library_blocks()
+        self._totals.append(total)
+        for trace, count in blocks.items():
+            if trace.size >= PACKET_LENGTH and count > self._idle.get(trace, 0):
+                frame = trace.traceback[0]
+                self.failures.append(
+                    f"{trace.size} byte block from {os.path.basename(frame.filename)}:"
+                    f"{frame.lineno} while a packet was {'read' if reading else 'sent'}"
+                )
+
+    def growth(self):
+        """Returns how much higher the library's memory peaked in the second half of the
+        transfer than in the first. Comparing peaks ignores the small amounts that come and go
+        within each packet."""
+        half = len(self._totals) // 2
+        return max(self._totals[half:]) - max(self._totals[:half])
+
+    def summary(self):
+        growth = self.growth()
+        if growth >= LIMIT:
+            self.failures.append(f"library memory grew by {growth} bytes")
+        return f"library memory grew by {growth} bytes over the transfer"
+
+
+class MeasuredTransport(ReplayTransport):
+    """Replays packets and samples memory as each is read or sent after the warm up."""
+
+    def __init__(self, packets, meter):
+        super().__init__([memoryview(packet) for packet in packets], PACKET_LENGTH)
+        self._meter = meter
+
+    def readinto(self, buffer):
+        if self.packets_read > WARM_UP:
+            self._meter.sample(True)
+        return super().readinto(buffer)
+
+    def write(self, packet):
+        if self.packets_read > WARM_UP:
+            self._meter.sample(False)
+        return super().write(packet)
+
+
+def read_packets():
+    packets = []
+    for offset in range(0, FILE_SIZE, CHUNK_SIZE):
+        length = min(CHUNK_SIZE, FILE_SIZE - offset)
+        header = struct.pack(
+            "<BBxxIII",
+            FileTransferService.READ_DATA,
+            FileTransferService.OK,
+            offset,
+            FILE_SIZE,
+            length,
+        )
+        packets.append(header + bytes(length))
+    return packets
+
+
+def write_packets():
+    offsets = list(range(0, FILE_SIZE, WRITE_FREE_SPACE)) + [FILE_SIZE]
+    return [
+        struct.pack(
+            "<BBxxIQI",
+            FileTransferService.WRITE_PACING,
+            FileTransferService.OK,
+            offset,
+            0,
+            min(WRITE_FREE_SPACE, FILE_SIZE - offset),
+        )
+        for offset in offsets
+    ]
+
+
+def check(name, packets, operation):
+    meter = MemFreeMeter() if mem_free is not None else SnapshotMeter()
+    transport = MeasuredTransport(packets, meter)
+    client = FileTransferClient(ReplayService(4), transport=transport, preallocate=True)
+    if tracemalloc:
+        tracemalloc.start()
+    gc.collect()
+    gc.disable()
+    try:
+        meter.start()
+        operation(client)
+    finally:
+        gc.enable()
+        if tracemalloc:
+            tracemalloc.stop()
+    summary = meter.summary()
+    if meter.failures:
+        print(name, meter.failures[0], "and", len(meter.failures) - 1, "more")
+    ok = not meter.failures
+    print(name, summary, "ok" if ok else "FAIL")
+    return ok
+
+
+def iter_read(client):
+    for _ in client.iter_read("/data.bin"):
+        pass
+
+
+def iter_read_windowed(client):
+    for _ in client.iter_read("/data.bin", chunk_size=CHUNK_SIZE, window=4):
+        pass
+
+
+def read_into(client):
+    client.read_into("/data.bin", DESTINATION)
+
+
+def write(client):
+    client.write("/data.bin", SOURCE)
+
+
+DESTINATION = bytearray(FILE_SIZE)
+SOURCE = bytes(FILE_SIZE)
+
+results = [
+    check("iter_read", read_packets(), iter_read),
+    check("iter_read windowed", read_packets(), iter_read_windowed),
+    check("read_into", read_packets(), read_into),
+    check("write", write_packets(), write),
+]
+if not all(results):
+    sys.exit(1)
@@ -0,0 +1,283 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Benchmarks every file transfer command over an emulated BLE link. Runs on a host without a radio.
+
+Throughput and latency are in the link's virtual time so they are reproducible. CPU time covers
+the client and the in-process server together and is shown in milliseconds.
+
+    python examples/ble_file_transfer_benchmark.py --output results.json
+    python examples/ble_file_transfer_benchmark.py --baseline results.json
+
+The run fails when a case takes longer, or needs more round trips or packets, than the baseline
+by more than the tolerance. CPU time isn't compared since it depends on the machine.
+``examples/ble_file_transfer_benchmark_baseline.json`` holds the results of the current code with
+the default link. Compare against it before a change and update it with ``--output`` when a
+change is meant to move the numbers.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from adafruit_ble_file_transfer import CancelToken, FileTransferClient, TransferCancelled
+from adafruit_ble_file_transfer.cache import ContentCache, ListingCache
+from adafruit_ble_file_transfer.link import EmulatedLink
+from adafruit_ble_file_transfer.loopback import LoopbackService
+from adafruit_ble_file_transfer.server import FileTransferServer
+from adafruit_ble_file_transfer.storage import OSStorage
+
+FILE_SIZES = (10, 100, 1_000, 10_000, 100_000, 1_000_000)
+DIRECTORY_SIZES = (10, 100, 1_000, 10_000)
+# Number of small commands run one at a time and then as a batch.
+BATCH_SIZE = 100
+# Entries in the first page of each directory listed by page.
+PAGE_SIZE = 20
+# Size of the file whose read is cancelled.
+CANCELLED_SIZE = 100_000
+# Metrics that the link emulation makes deterministic and that get worse as they grow.
+COMPARED = ("seconds", "round_trips", "packets")
+
+
+def measure(service, operation, size=0):
+    """Runs operation over service and returns its metrics. size is the number of file bytes it
+    moves."""
+    raw = service.raw
+    link = service.link
+    start_time = link.elapsed
+    start_round_trips = raw.round_trips
+    start_packets = raw.packets_sent + raw.packets_received
+    start_cpu = time.process_time()
+    operation()
+    cpu_time = time.process_time() - start_cpu
+    seconds = link.elapsed - start_time
+    result = {
+        "seconds": seconds,
+        "round_trips": raw.round_trips - start_round_trips,
+        "packets": raw.packets_sent + raw.packets_received - start_packets,
+        "cpu_time": cpu_time,
+    }
+    if size:
+        result["bytes_per_second"] = size / seconds if seconds else None
+    return result
+
+
+def populate(server, setup):
+    """Runs setup against server over an unthrottled loopback so it doesn't count."""
+    with LoopbackService(server) as service:
+        setup(FileTransferClient(service))
+
+
+def file_cases(link_args, results, max_size, root=None):
+    server = FileTransferServer(OSStorage(root) if root else None)
+    with LoopbackService(server, link=EmulatedLink(**link_args)) as service:
+        client = FileTransferClient(service)
+        for size in FILE_SIZES:
+            if size > max_size:
+                continue
+            contents = os.urandom(size)
+            path = f"/file{size}.bin"
+
+            def read(path=path, contents=contents):
+                if client.read(path) != contents:
+                    raise RuntimeError("read back different contents for " + path)
+
+            results[f"write_{size}"] = measure(
+                service, lambda path=path, contents=contents: client.write(path, contents), size
+            )
+            results[f"read_{size}"] = measure(service, read, size)
+
+            def read_windowed(path=path, contents=contents):
+                if client.read(path, window=None) != contents:
+                    raise RuntimeError("read back different contents for " + path)
+
+            results[f"read_windowed_{size}"] = measure(service, read_windowed, size)
+
+            checked = FileTransferClient(service, checksums=True)
+            results[f"write_checksum_{size}"] = measure(
+                service, lambda path=path, contents=contents: checked.write(path, contents), size
+            )
+
+            def read_checksum(path=path, contents=contents):
+                if checked.read(path) != contents:
+                    raise RuntimeError("read back different contents for " + path)
+
+            results[f"read_checksum_{size}"] = measure(service, read_checksum, size)
+
+            cached = FileTransferClient(service, content_cache=ContentCache(max_bytes=max_size))
+            cached.read(path)
+
+            def read_cached(path=path, contents=contents):
+                if cached.read(path) != contents:
+                    raise RuntimeError("read back different cached contents for " + path)
+
+            results[f"read_cached_{size}"] = measure(service, read_cached, size)
+
+            # One byte in the middle changes so the sync patches a single block.
+            changed = bytearray(contents)
+            changed[size // 2] ^= 0xFF
+            results[f"sync_{size}"] = measure(
+                service, lambda path=path, changed=changed: client.sync(path, changed), size
+            )
+
+
+def listdir_cases(link_args, results, max_entries):
+    for count in DIRECTORY_SIZES:
+        if count > max_entries:
+            continue
+        server = FileTransferServer()
+        path = f"/dir{count}/"
+
+        def setup(client, path=path, count=count):
+            client.mkdir(path)
+            for i in range(count):
+                client.write(f"{path}log{i:05}.txt", b"x")
+
+        populate(server, setup)
+        with LoopbackService(server, link=EmulatedLink(**link_args)) as service:
+            client = FileTransferClient(service)
+
+            def listdir(path=path, count=count):
+                if len(client.listdir(path)) != count:
+                    raise RuntimeError("wrong entry count for " + path)
+
+            results[f"listdir_{count}"] = measure(service, listdir)
+
+            def first_page(path=path, count=count):
+                if len(client.listdir(path, limit=PAGE_SIZE)) != min(count, PAGE_SIZE):
+                    raise RuntimeError("wrong page length for " + path)
+
+            results[f"listdir_page_{count}"] = measure(service, first_page)
+
+            cached = FileTransferClient(service, cache=ListingCache())
+            cached.listdir(path)
+
+            def listdir_cached(path=path, count=count):
+                if len(cached.listdir(path)) != count:
+                    raise RuntimeError("wrong cached entry count for " + path)
+
+            results[f"listdir_cached_{count}"] = measure(service, listdir_cached)
+
+
+def metadata_cases(link_args, results):
+    server = FileTransferServer()
+    populate(server, lambda client: client.write("/old.txt", b"hello"))
+    with LoopbackService(server, link=EmulatedLink(**link_args)) as service:
+        client = FileTransferClient(service)
+        results["mkdir"] = measure(service, lambda: client.mkdir("/new/dir/"))
+        results["move"] = measure(service, lambda: client.move("/old.txt", "/new/dir/new.txt"))
+        results["delete"] = measure(service, lambda: client.delete("/new/"))
+
+        def mkdirs():
+            for i in range(BATCH_SIZE):
+                client.mkdir(f"/serial/{i}/")
+
+        def batch_mkdirs():
+            batch = client.batch()
+            for i in range(BATCH_SIZE):
+                batch.mkdir(f"/batch/{i}/")
+            if any(isinstance(result, ValueError) for result in batch.run()):
+                raise RuntimeError("batch mkdir failed")
+
+        results[f"mkdir_{BATCH_SIZE}"] = measure(service, mkdirs)
+        results[f"mkdir_batch_{BATCH_SIZE}"] = measure(service, batch_mkdirs)
+
+        # Stop a long download after its first chunk to make room for a small write.
+        client.write("/log.bin", bytes(CANCELLED_SIZE))
+
+        def cancel_read():
+            token = CancelToken()
+            try:
+                for _ in client.iter_read("/log.bin", window=None, cancel=token):
+                    token.cancel()
+            except TransferCancelled:
+                pass
+            client.write("/config.txt", b"urgent")
+
+        results["read_cancelled"] = measure(service, cancel_read)
+
+
+def compare(results, baseline, tolerance):
+    """Prints cases that regressed against baseline and returns how many did."""
+    regressions = 0
+    for name, base in baseline["results"].items():
+        current = results.get(name)
+        if current is None:
+            continue
+        for metric in COMPARED:
+            if current[metric] > base[metric] * (1 + tolerance) + 1e-9:
+                print("REGRESSION", name, metric, base[metric], "->", current[metric])
+                regressions += 1
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--output", help="save results as JSON to this path")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.05)
+    parser.add_argument("--max-size", type=int, default=max(FILE_SIZES))
+    parser.add_argument("--max-entries", type=int, default=max(DIRECTORY_SIZES))
+    parser.add_argument("--connection-interval", type=float, default=0.015)
+    parser.add_argument("--mtu", type=int, default=247)
+    parser.add_argument("--packets-per-event", type=int, default=4)
+    parser.add_argument(
+        "--disk", action="store_true", help="serve the file cases from a temporary directory"
+    )
+    args = parser.parse_args()
+
+    link_args = {
+        "connection_interval": args.connection_interval,
+        "mtu": args.mtu,
+        "packets_per_event": args.packets_per_event,
+    }
+    results = {}
+    if args.disk:
+        with tempfile.TemporaryDirectory() as root:
+            file_cases(link_args, results, args.max_size, root)
+    else:
+        file_cases(link_args, results, args.max_size)
+    listdir_cases(link_args, results, args.max_entries)
+    metadata_cases(link_args, results)
+
+    print(
+        "{:<24}{:>12}{:>14}{:>12}{:>10}{:>10}".format(
+            "case", "seconds", "B/s", "round trips", "packets", "cpu ms"
+        )
+    )
+    for name, result in results.items():
+        rate = result.get("bytes_per_second")
+        print(
+            "{:<24}{:>12.4f}{:>14}{:>12}{:>10}{:>10.2f}".format(
+                name,
+                result["seconds"],
+                "" if rate is None else f"{rate:.0f}",
+                result["round_trips"],
+                result["packets"],
+                result["cpu_time"] * 1000,
+            )
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"link": link_args, "results": results}, f, indent=2)
+            f.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("link") != link_args:
+            print("baseline was measured with a different link:", baseline.get("link"))
+            sys.exit(2)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+        print("no regressions against", args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Times the CPU cost of chunk checksums on the client and shows corrupt chunks being sent again.
+Runs without a radio on a host.
+
+The client is fed canned server packets for a read and a write, with and without a CRC32 after
+each chunk, so that only its own work is timed. The overhead column is the extra time that
+checking or adding the CRC32 takes.
+
+The file is then read and written over a loopback link that flips bits in some packets. Both
+must arrive intact, with the corrupt chunks sent again.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from binascii import crc32
+
+from adafruit_ble_file_transfer import CHUNK_SIZE, FileTransferClient, FileTransferService, codec
+from adafruit_ble_file_transfer.link import EmulatedLink
+from adafruit_ble_file_transfer.loopback import LoopbackService
+from adafruit_ble_file_transfer.replay import ReplayService, ReplayTransport
+from adafruit_ble_file_transfer.server import CHUNK_SIZE as SERVER_CHUNK_SIZE
+from adafruit_ble_file_transfer.server import FileTransferServer
+from adafruit_ble_file_transfer.transport import Transport
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--size", type=int, default=1_000_000, help="bytes in the file")
+parser.add_argument("--packet-length", type=int, default=244)
+parser.add_argument("--repeat", type=int, default=3, help="runs to take the fastest of")
+parser.add_argument("--corruption", type=float, default=0.002, help="chance a packet is damaged")
+args = parser.parse_args()
+
+
+def split(message):
+    length = args.packet_length
+    return [message[i : i + length] for i in range(0, len(message), length)]
+
+
+def read_replies(contents, checksums):
+    """Returns the packets a server sends for a read of contents in CHUNK_SIZE chunks."""
+    header = bytearray(codec.READ_DATA_HEADER.size)
+    packets = []
+    for offset in range(0, len(contents), CHUNK_SIZE):
+        data = contents[offset : offset + CHUNK_SIZE]
+        codec.encode_read_data_into(
+            header, FileTransferService.OK, offset, len(contents), len(data)
+        )
+        trailer = crc32(data).to_bytes(4, "little") if checksums else b""
+        packets.extend(split(bytes(header) + data + trailer))
+    return packets
+
+
+def write_replies(contents, checksums):
+    """Returns the WRITE_PACING packets a server sends for a write of contents. They are the
+    same with checksums."""
+    length = len(contents)
+    reply = bytearray(codec.WRITE_PACING_HEADER.size)
+    packets = []
+    for offset in range(0, length, SERVER_CHUNK_SIZE):
+        free_space = min(SERVER_CHUNK_SIZE, length - offset)
+        codec.encode_write_pacing_into(reply, FileTransferService.OK, offset, 0, free_space)
+        packets.append(bytes(reply))
+    codec.encode_write_pacing_into(reply, FileTransferService.OK, length, 0, 0)
+    packets.append(bytes(reply))
+    return packets
+
+
+def fastest(packets, checksums, operation):
+    best = None
+    result = None
+    for _ in range(args.repeat):
+        transport = ReplayTransport(packets, args.packet_length)
+        client = FileTransferClient(ReplayService(9), transport=transport, checksums=checksums)
+        start = time.perf_counter()
+        result = operation(client)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+class CorruptingTransport(Transport):
+    """Flips a bit in the last byte of some full length packets in both directions. Shorter
+    packets are left alone since they carry the protocol headers a checksum doesn't cover."""
+
+    def __init__(self, transport):
+        self._transport = transport
+        self._random = random.Random(0)
+        self.corrupted = 0
+
+    incoming_packet_length = property(lambda self: self._transport.incoming_packet_length)
+    outgoing_packet_length = property(lambda self: self._transport.outgoing_packet_length)
+    buffer_size = property(lambda self: self._transport.buffer_size)
+
+    def _damage(self, length, full_length):
+        if length == full_length and self._random.random() < args.corruption:
+            self.corrupted += 1
+            return True
+        return False
+
+    def readinto(self, buffer):
+        length = self._transport.readinto(buffer)
+        if self._damage(length, self.incoming_packet_length):
+            buffer[length - 1] ^= 0x10
+        return length
+
+    def write(self, packet):
+        if self._damage(len(packet), self.outgoing_packet_length):
+            packet = bytearray(packet)
+            packet[-1] ^= 0x10
+        return self._transport.write(packet)
+
+
+contents = os.urandom(args.size)
+ok = True
+
+start = time.perf_counter()
+crc32(contents)
+crc_time = time.perf_counter() - start
+print(f"{args.size} bytes, {args.packet_length} byte packets")
+print(f"crc32 alone: {args.size / crc_time / 1_000_000:.0f} MB/s")
+print(f"{'operation':<10}{'plain ms':>12}{'crc ms':>12}{'overhead':>10}")
+for name, replies, operation in (
+    ("read", read_replies, lambda client: client.read("/file.bin")),
+    ("write", write_replies, lambda client: client.write("/file.bin", contents)),
+):
+    plain, plain_result = fastest(replies(contents, False), False, operation)
+    checked, checked_result = fastest(replies(contents, True), True, operation)
+    if name == "read" and (plain_result != contents or checked_result != contents):
+        print("read back different contents")
+        ok = False
+    print(
+        f"{name:<10}{plain * 1000:>12.2f}{checked * 1000:>12.2f}"
+        f"{(checked - plain) / plain * 100:>9.1f}%"
+    )
+
+server = FileTransferServer()
+with LoopbackService(server, link=EmulatedLink(mtu=args.packet_length + 3)) as service:
+    transport = CorruptingTransport(service.raw)
+    client = FileTransferClient(service, transport=transport, checksums=True)
+    client.write("/file.bin", contents)
+    if client.read("/file.bin", window=None) != contents:
+        print("read back different contents over the damaged link")
+        ok = False
+    print(
+        f"damaged link: {transport.corrupted} packets damaged, "
+        f"{client.chunks_resent} chunks sent again"
+    )
+
+if not ok:
+    sys.exit(1)
@@ -0,0 +1,322 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Checks the message codec and times it. Runs on CircuitPython or a host.
+
+Every message is round tripped with edge values and then with random values, and compared byte
+for byte with ``struct.pack`` of the layout documented in the README. Random packets are decoded
+to make sure any bytes of the right length are accepted. Values sent after a header, such as the
+hashes of HASHES and the CRC32 of a chunk, are checked the same way, and so are the flags of the
+commands that take them. The service's command and status constants must match the codec's.
+
+Then the headers sent for every chunk of a read and a write are packed and unpacked with format
+strings, with the encode functions and with the layouts' ``pack_into`` that the client and server
+use for them, so that a slower path shows up.
+"""
+
+import random
+import struct
+import sys
+import time
+
+from adafruit_ble_file_transfer import FileTransferService, codec
+
+try:
+    ticks = time.perf_counter
+except AttributeError:
+    ticks = time.monotonic
+
+ITERATIONS = 20_000
+FUZZ_ROUNDS = 500
+
+# name: (layout from the README, encoder, decoder, command, fields after the command)
+MESSAGES = {
+    "READ": ("<BxHII", codec.encode_read_into, codec.decode_read_from, codec.READ, "HII"),
+    "READ_DATA": (
+        "<BBxxIII",
+        codec.encode_read_data_into,
+        codec.decode_read_data_from,
+        codec.READ_DATA,
+        "BIII",
+    ),
+    "READ_PACING": (
+        "<BBxxII",
+        codec.encode_read_pacing_into,
+        codec.decode_read_pacing_from,
+        codec.READ_PACING,
+        "BII",
+    ),
+    "WRITE": ("<BxHIQI", codec.encode_write_into, codec.decode_write_from, codec.WRITE, "HIQI"),
+    "WRITE_PACING": (
+        "<BBxxIQI",
+        codec.encode_write_pacing_into,
+        codec.decode_write_pacing_from,
+        codec.WRITE_PACING,
+        "BIQI",
+    ),
+    "WRITE_DATA": (
+        "<BBxxII",
+        codec.encode_write_data_into,
+        codec.decode_write_data_from,
+        codec.WRITE_DATA,
+        "BII",
+    ),
+    "DELETE": ("<BxH", codec.encode_delete_into, codec.decode_delete_from, codec.DELETE, "H"),
+    "DELETE_STATUS": (
+        "<BB",
+        codec.encode_delete_status_into,
+        codec.decode_delete_status_from,
+        codec.DELETE_STATUS,
+        "B",
+    ),
+    "MKDIR": ("<BxHxxxxQ", codec.encode_mkdir_into, codec.decode_mkdir_from, codec.MKDIR, "HQ"),
+    "MKDIR_STATUS": (
+        "<BBxxxxxxQ",
+        codec.encode_mkdir_status_into,
+        codec.decode_mkdir_status_from,
+        codec.MKDIR_STATUS,
+        "BQ",
+    ),
+    "LISTDIR": ("<BxH", codec.encode_listdir_into, codec.decode_listdir_from, codec.LISTDIR, "H"),
+    "LISTDIR_ENTRY": (
+        "<BBHIIIQI",
+        codec.encode_listdir_entry_into,
+        codec.decode_listdir_entry_from,
+        codec.LISTDIR_ENTRY,
+        "BHIIIQI",
+    ),
+    "LISTDIR_PAGE": (
+        "<BxHII",
+        codec.encode_listdir_page_into,
+        codec.decode_listdir_page_from,
+        codec.LISTDIR_PAGE,
+        "HII",
+    ),
+    "MOVE": ("<BxHH", codec.encode_move_into, codec.decode_move_from, codec.MOVE, "HH"),
+    "MOVE_STATUS": (
+        "<BB",
+        codec.encode_move_status_into,
+        codec.decode_move_status_from,
+        codec.MOVE_STATUS,
+        "B",
+    ),
+    "TAG": ("<BxH", codec.encode_tag_into, codec.decode_tag_from, codec.TAG, "H"),
+    "TAG_REPLY": (
+        "<BBH",
+        codec.encode_tag_reply_into,
+        codec.decode_tag_reply_from,
+        codec.TAG_REPLY,
+        "BH",
+    ),
+    "ABORT": ("<Bxxxxxxxxxxx", codec.encode_abort_into, codec.decode_abort_from, codec.ABORT, ""),
+    "ABORT_STATUS": (
+        "<BB",
+        codec.encode_abort_status_into,
+        codec.decode_abort_status_from,
+        codec.ABORT_STATUS,
+        "B",
+    ),
+    "HASH": ("<BxHI", codec.encode_hash_into, codec.decode_hash_from, codec.HASH, "HI"),
+    "HASHES": (
+        "<BBxxII",
+        codec.encode_hashes_into,
+        codec.decode_hashes_from,
+        codec.HASHES,
+        "BII",
+    ),
+    "PATCH": (
+        "<BxHIQII",
+        codec.encode_patch_into,
+        codec.decode_patch_from,
+        codec.PATCH,
+        "HIQII",
+    ),
+}
+
+# name: (layout from the README, layout in the codec) for values sent after a header.
+LAYOUTS = {
+    "BLOCK_HASH": ("<I", codec.BLOCK_HASH),
+    "CHUNK_CRC": ("<I", codec.CHUNK_CRC),
+}
+
+# Messages whose padding byte after the command carries flags.
+FLAGGED = ("READ", "WRITE", "PATCH")
+
+LIMITS = {"B": 0xFF, "H": 0xFFFF, "I": 0xFFFF_FFFF, "Q": 0xFFFF_FFFF_FFFF_FFFF}
+
+
+def round_trip(name, values):
+    """Returns an error message or None if values survive encoding and match the README."""
+    fmt, encode, decode, command, _ = MESSAGES[name]
+    expected = struct.pack(fmt, command, *values)
+    # Leave junk before and after the header to check the offset and size are respected.
+    buffer = bytearray(b"\xaa" * (len(expected) + 6))
+    size = encode(buffer, *values, offset=3)
+    if size != len(expected) or bytes(buffer[3 : 3 + size]) != expected:
+        return f"{name} encoded {values} as {bytes(buffer[3 : 3 + size])} not {expected}"
+    if buffer[:3] != b"\xaa" * 3 or buffer[3 + size :] != b"\xaa" * 3:
+        return f"{name} wrote outside its header"
+    decoded = tuple(decode(buffer, 3))
+    if decoded != (command,) + tuple(values):
+        return f"{name} decoded {decoded} from {values}"
+    return None
+
+
+def check(rng):
+    """Returns the number of failed checks."""
+    failures = 0
+    for name, (fmt, _, decode, _, fields) in MESSAGES.items():
+        cases = [
+            tuple(0 for _ in fields),
+            tuple(LIMITS[field] for field in fields),
+        ]
+        for _ in range(FUZZ_ROUNDS):
+            cases.append(tuple(rng.randint(0, LIMITS[field]) for field in fields))
+        for values in cases:
+            error = round_trip(name, values)
+            if error:
+                print(error)
+                failures += 1
+                break
+
+        # Any bytes of the right length decode to what struct sees.
+        size = struct.calcsize(fmt)
+        for _ in range(FUZZ_ROUNDS):
+            packet = bytes(rng.getrandbits(8) for _ in range(size))
+            if tuple(decode(packet)) != struct.unpack_from(fmt, packet):
+                print(name, "decoded", packet, "differently from struct")
+                failures += 1
+                break
+        print(name, "ok")
+    return failures
+
+
+def check_layouts(rng):
+    """Returns the number of layouts without a header that don't pack and unpack like the
+    README."""
+    failures = 0
+    for name, (fmt, layout) in LAYOUTS.items():
+        fields = fmt[1:]
+        cases = [tuple(LIMITS[field] for field in fields)]
+        for _ in range(FUZZ_ROUNDS):
+            cases.append(tuple(rng.randint(0, LIMITS[field]) for field in fields))
+        for values in cases:
+            expected = struct.pack(fmt, *values)
+            buffer = bytearray(b"\xaa" * (len(expected) + 6))
+            layout.pack_into(buffer, 3, *values)
+            if bytes(buffer[3 : 3 + layout.size]) != expected:
+                print(name, "packed", values, "as", bytes(buffer[3 : 3 + layout.size]))
+                failures += 1
+                break
+            if buffer[:3] != b"\xaa" * 3 or buffer[3 + layout.size :] != b"\xaa" * 3:
+                print(name, "wrote outside its layout")
+                failures += 1
+                break
+            if tuple(layout.unpack_from(buffer, 3)) != values:
+                print(name, "unpacked", tuple(layout.unpack_from(buffer, 3)), "from", values)
+                failures += 1
+                break
+        else:
+            print(name, "ok")
+    return failures
+
+
+def check_flags(rng):
+    """Returns the number of flagged messages whose flags don't land in the byte after the
+    command or change the other fields."""
+    failures = 0
+    for name in FLAGGED:
+        fmt, encode, decode, command, fields = MESSAGES[name]
+        # The README's layout with the padding byte read as the flags.
+        flagged = "<BB" + fmt[3:]
+        for flags in (0, codec.CHECKSUM, 0xFF):
+            values = tuple(rng.randint(0, LIMITS[field]) for field in fields)
+            expected = struct.pack(flagged, command, flags, *values)
+            buffer = bytearray(b"\xaa" * (len(expected) + 6))
+            size = encode(buffer, *values, offset=3, flags=flags)
+            if bytes(buffer[3 : 3 + size]) != expected:
+                print(name, "encoded flags", flags, "as", bytes(buffer[3 : 3 + size]))
+                failures += 1
+                break
+            if codec.decode_flags_from(buffer, 3) != flags:
+                print(name, "decoded flags", codec.decode_flags_from(buffer, 3), "not", flags)
+                failures += 1
+                break
+            if tuple(decode(buffer, 3)) != (command,) + values:
+                print(name, "decoded", tuple(decode(buffer, 3)), "with flags", flags)
+                failures += 1
+                break
+        else:
+            print(name, "flags ok")
+    return failures
+
+
+def check_constants():
+    """Returns the number of service constants that differ from the codec's."""
+    failures = 0
+    for name in dir(FileTransferService):
+        if name.isupper() and getattr(FileTransferService, name) != getattr(codec, name):
+            print("FileTransferService." + name, "differs from the codec")
+            failures += 1
+    return failures
+
+
+def format_strings(buffer):
+    """The per-chunk headers of a read and a write with format strings parsed on each call."""
+    struct.pack_into("<BBxxIII", buffer, 0, codec.READ_DATA, codec.OK, 490, 100_000, 490)
+    struct.unpack_from("<BBxxIII", buffer)
+    struct.pack_into("<BBxxII", buffer, 0, codec.READ_PACING, codec.OK, 980, 490)
+    struct.unpack_from("<BBxxII", buffer)
+    struct.pack_into("<BBxxIQI", buffer, 0, codec.WRITE_PACING, codec.OK, 490, 0, 490)
+    struct.unpack_from("<BBxxIQI", buffer)
+    struct.pack_into("<BBxxII", buffer, 0, codec.WRITE_DATA, codec.OK, 490, 490)
+    struct.unpack_from("<BBxxII", buffer)
+
+
+def encoders(buffer):
+    """The same headers with the codec's encode and decode functions."""
+    codec.encode_read_data_into(buffer, codec.OK, 490, 100_000, 490)
+    codec.decode_read_data_from(buffer)
+    codec.encode_read_pacing_into(buffer, codec.OK, 980, 490)
+    codec.decode_read_pacing_from(buffer)
+    codec.encode_write_pacing_into(buffer, codec.OK, 490, 0, 490)
+    codec.decode_write_pacing_from(buffer)
+    codec.encode_write_data_into(buffer, codec.OK, 490, 490)
+    codec.decode_write_data_from(buffer)
+
+
+def layouts(buffer):
+    """The same headers packed with the layouts, as the client and server send them."""
+    codec.READ_DATA_HEADER.pack_into(buffer, 0, codec.READ_DATA, codec.OK, 490, 100_000, 490)
+    codec.decode_read_data_from(buffer)
+    codec.PACING_HEADER.pack_into(buffer, 0, codec.READ_PACING, codec.OK, 980, 490)
+    codec.decode_read_pacing_from(buffer)
+    codec.WRITE_PACING_HEADER.pack_into(buffer, 0, codec.WRITE_PACING, codec.OK, 490, 0, 490)
+    codec.decode_write_pacing_from(buffer)
+    codec.PACING_HEADER.pack_into(buffer, 0, codec.WRITE_DATA, codec.OK, 490, 490)
+    codec.decode_write_data_from(buffer)
+
+
+def benchmark(name, function):
+    buffer = bytearray(32)
+    start = ticks()
+    for _ in range(ITERATIONS):
+        function(buffer)
+    elapsed = ticks() - start
+    print(f"{name:<16}{elapsed * 1_000_000 / ITERATIONS:>8.2f} us per round")
+    return elapsed
+
+
+random.seed(0)
+failed = check(random) + check_layouts(random) + check_flags(random) + check_constants()
+if failed:
+    print(failed, "codec checks failed")
+    sys.exit(1)
+print("codec ok")
+
+baseline = benchmark("format strings", format_strings)
+encoded = benchmark("encoders", encoders)
+packed = benchmark("layouts", layouts)
+print(f"encoders take {encoded / baseline:.0%} and layouts {packed / baseline:.0%} of the time")
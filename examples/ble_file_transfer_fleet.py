@@ -0,0 +1,58 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Pushes files to a fleet of simulated devices and reads a log back from each. Runs on a host
+without a radio.
+
+Every device is a `FileTransferServer` behind a loopback link. One of them is missing the log so
+the run shows a per-device failure next to the successes. With real boards, pass
+``ble.connections`` to `Fleet` instead.
+"""
+
+import argparse
+import asyncio
+import os
+
+from adafruit_ble_file_transfer.fleet import Fleet, Plan
+from adafruit_ble_file_transfer.loopback import LoopbackService
+from adafruit_ble_file_transfer.server import FileTransferServer
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--devices", type=int, default=8)
+parser.add_argument("--workers", type=int, default=4)
+parser.add_argument("--size", type=int, default=20_000, help="bytes in each pushed file")
+args = parser.parse_args()
+
+services = []
+for i in range(args.devices):
+    server = FileTransferServer()
+    if i != 1:
+        log = f"device {i} booted\n".encode()
+        server.storage.open_write("/log.txt", len(log)).write(log)
+    # A poll interval of 0 keeps the loopback from blocking the event loop.
+    services.append(LoopbackService(server, poll_interval=0))
+
+code = os.urandom(args.size)
+plan = Plan()
+plan.mkdir("/lib/")
+plan.write("/lib/helper.py", code)
+plan.write("/code.py", code)
+plan.read("/log.txt")
+
+result = asyncio.run(Fleet(services, workers=args.workers, timeout=10).run(plan))
+
+for i, device in enumerate(result.devices):
+    if device.ok:
+        log = str(device.results[-1], "utf-8").strip()
+        print(f"device {i}: {device.bytes} bytes in {device.elapsed:.3f}s, log {log!r}")
+    else:
+        print(f"device {i}: failed with {device.error!r} after {len(device.results)} steps")
+print(
+    f"{len(result.devices) - len(result.failures)}/{len(result.devices)} devices ok, "
+    f"{result.bytes} bytes in {result.elapsed:.3f}s ({result.throughput / 1000:.1f} kB/s)"
+)
+
+for service in services:
+    service.close()
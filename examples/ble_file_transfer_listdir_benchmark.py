@@ -0,0 +1,159 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Times how fast the client decodes a directory listing and how much memory it holds. Runs
+without a radio on a host.
+
+The client is fed canned LISTDIR_ENTRY packets for a directory of many entries so that only its
+decoding is measured. Replies are sent in three layouts. "per entry" starts each entry in a new
+packet, as servers that write each entry on its own do. "server" packs entries as
+FileTransferServer does: a name may continue into the next packet but a header never does.
+"split" packs them back to back so that headers are split between packets too, which the
+protocol allows. Long names span several packets in every layout.
+
+listdir and iterlistdir must both return every entry. The time to decode each entry grows with
+the length of its name, since the name is copied and decoded, but packing entries shouldn't make
+it slower than one entry per packet. Times are the fastest of ``--repeat`` runs. iterlistdir
+should hold a few KiB at its peak however long the listing is, while listdir holds all of it.
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+
+from adafruit_ble_file_transfer import (
+    DirectoryEntry,
+    FileTransferClient,
+    FileTransferService,
+    codec,
+)
+from adafruit_ble_file_transfer.replay import ReplayService, ReplayTransport
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--entries", type=int, default=10_000)
+parser.add_argument("--packet-length", type=int, default=244)
+parser.add_argument("--repeat", type=int, default=3, help="runs to take the fastest of")
+args = parser.parse_args()
+
+
+def directory(count, name_length):
+    entries = []
+    for i in range(count):
+        name = f"log{i:08}.txt"
+        name += "x" * max(0, name_length - len(name))
+        entries.append(DirectoryEntry(name, i, 0, i * 1_000_000_000))
+    return entries
+
+
+def replies(entries, layout):
+    """Returns the packets a server would send to list entries in the given layout."""
+    header = bytearray(codec.LISTDIR_ENTRY_HEADER.size)
+    total = len(entries)
+    messages = []
+    for i, (name, size, flags, modification_time) in enumerate(entries):
+        encoded = name.encode()
+        codec.encode_listdir_entry_into(
+            header, FileTransferService.OK, len(encoded), i, total, flags, modification_time, size
+        )
+        messages.append(bytes(header) + encoded)
+    codec.encode_listdir_entry_into(header, FileTransferService.OK, 0, total, total, 0, 0, 0)
+    messages.append(bytes(header))
+    length = args.packet_length
+    if layout == "split":
+        messages = [b"".join(messages)]
+    elif layout == "server":
+        # Start a new packet for each header that wouldn't fit in the one being filled.
+        packed = []
+        pending = b""
+        for message in messages:
+            if pending and len(pending) + len(header) > length:
+                packed.append(pending)
+                pending = b""
+            pending += message
+            while len(pending) >= length:
+                packed.append(pending[:length])
+                pending = pending[length:]
+        packed.append(pending)
+        return [packet for packet in packed if packet]
+    return [m[i : i + length] for m in messages for i in range(0, len(m), length)]
+
+
+def listdir(client):
+    return client.listdir("/logs/")
+
+
+def iterlistdir(client):
+    entries = client.iterlistdir("/logs/")
+    first = next(entries)
+    first_time = time.perf_counter()
+    return [first, *entries], first_time
+
+
+def timed(packets, operation):
+    """Returns the result, time taken and start time of the fastest of the runs of operation."""
+    best = None
+    for _ in range(args.repeat):
+        client = FileTransferClient(
+            ReplayService(7), transport=ReplayTransport(packets, args.packet_length)
+        )
+        start = time.perf_counter()
+        result = operation(client)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[1]:
+            best = (result, elapsed, start)
+    return best
+
+
+def peak_memory(packets, operation):
+    client = FileTransferClient(
+        ReplayService(7), transport=ReplayTransport(packets, args.packet_length)
+    )
+    tracemalloc.start()
+    operation(client)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def count_entries(client):
+    count = 0
+    for _ in client.iterlistdir("/logs/"):
+        count += 1
+    return count
+
+
+def run(name_length, layout):
+    expected = directory(args.entries, name_length)
+    packets = replies(expected, layout)
+    listed, list_time, _ = timed(packets, listdir)
+    (streamed, first_time), stream_time, start = timed(packets, iterlistdir)
+    list_peak = peak_memory(packets, listdir)
+    # Entries that are dropped as they arrive, so only what iterlistdir itself holds counts.
+    stream_peak = peak_memory(packets, count_entries)
+    if listed != expected or streamed != expected:
+        print("wrong entries for", name_length, "byte names")
+        return False
+    print(
+        f"{name_length:>6} {layout:<10}{len(packets):>8}"
+        f"{list_time * 1_000_000 / args.entries:>12.2f}"
+        f"{stream_time * 1_000_000 / args.entries:>12.2f}"
+        f"{(first_time - start) * 1_000_000:>12.1f}"
+        f"{list_peak / 1024:>12.0f}{stream_peak / 1024:>12.0f}"
+    )
+    return True
+
+
+print(f"{args.entries} entries, {args.packet_length} byte packets")
+print(
+    f"{'name':>6} {'layout':<10}{'packets':>8}{'listdir us':>12}{'iter us':>12}"
+    f"{'first us':>12}{'list KiB':>12}{'iter KiB':>12}"
+)
+ok = True
+for name_length in (12, 64, 1000):
+    for layout in ("per entry", "server", "split"):
+        ok = run(name_length, layout) and ok
+if not ok:
+    sys.exit(1)
@@ -0,0 +1,147 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Checks that cached listings stay correct when batches change the directories they list. Runs on a
+host.
+
+Random batches of mkdirs, deletes, moves and listdirs, several often in one directory, are run
+through a client with a ListingCache, directly and from threads, and every cached listing must
+match listing the directory again.
+"""
+
+import argparse
+import contextlib
+import io
+import random
+import sys
+import threading
+
+from adafruit_ble_file_transfer import FileTransferClient
+from adafruit_ble_file_transfer.cache import ListingCache
+from adafruit_ble_file_transfer.loopback import LoopbackService
+from adafruit_ble_file_transfer.server import FileTransferServer
+from adafruit_ble_file_transfer.threaded_client import ThreadedFileTransferClient
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--batches", type=int, default=300)
+args = parser.parse_args()
+
+DIRECTORIES = ("/", "/a/", "/b/")
+NAMES = ("x", "y", "z")
+
+
+def random_path(rng):
+    return rng.choice(DIRECTORIES) + rng.choice(NAMES)
+
+
+def random_batch(rng):
+    operations = []
+    for _ in range(rng.randint(1, 6)):
+        name = rng.choice(("mkdir", "delete", "delete", "move", "move", "listdir"))
+        if name == "mkdir":
+            operations.append((name, random_path(rng) + "/"))
+        elif name == "delete":
+            operations.append((name, random_path(rng)))
+        elif name == "move":
+            operations.append((name, random_path(rng), random_path(rng)))
+        else:
+            operations.append((name, rng.choice(DIRECTORIES)))
+    return operations
+
+
+def names(entries):
+    return sorted(entry.path for entry in entries)
+
+
+def fill(client):
+    for directory in DIRECTORIES:
+        for name in NAMES:
+            try:
+                client.write(directory + name, b"x")
+            except RuntimeError:
+                # A directory has been moved to the path.
+                pass
+        client.listdir(directory)
+
+
+def stale(client):
+    for directory in DIRECTORIES:
+        cached = names(client.listdir(directory))
+        listed = names(client.listdir(directory, refresh=True))
+        if cached != listed:
+            return f"{directory} cached as {cached} but holds {listed}"
+    return None
+
+
+def check_batches(rng, service):
+    client = FileTransferClient(service, cache=ListingCache())
+    fill(client)
+    for i in range(args.batches):
+        operations = random_batch(rng)
+        batch = client.batch()
+        for operation in operations:
+            getattr(batch, operation[0])(*operation[1:])
+        batch.run()
+        problem = stale(client)
+        if problem:
+            return f"batch {i} {operations}: {problem}"
+        if rng.random() < 0.2:
+            fill(client)
+    return None
+
+
+def held(release):
+    # Keeps the worker busy until release is set so that what is queued meanwhile runs together.
+    release.wait()
+    yield b"x"
+
+
+def threaded_stale(threaded):
+    for directory in DIRECTORIES:
+        cached = names(threaded.listdir(directory).result())
+        listed = names(threaded.listdir(directory, refresh=True).result())
+        if cached != listed:
+            return f"{directory} cached as {cached} but holds {listed}"
+    return None
+
+
+def check_threads(rng, service):
+    with ThreadedFileTransferClient(service, cache=ListingCache()) as threaded:
+        for i in range(args.batches):
+            if i % 5 == 0:
+                futures = [
+                    threaded.write(directory + name, b"x")
+                    for directory in DIRECTORIES
+                    for name in NAMES
+                ]
+                futures += [threaded.listdir(directory) for directory in DIRECTORIES]
+                for future in futures:
+                    future.exception()
+            operations = random_batch(rng)
+            release = threading.Event()
+            futures = [threaded.write_from("/held", held(release), 1), threaded.listdir("/")]
+            futures += [getattr(threaded, operation[0])(*operation[1:]) for operation in operations]
+            futures += [threaded.listdir("/"), threaded.listdir("/")]
+            release.set()
+            for future in futures:
+                future.exception()
+            if futures[-1].result() is futures[-2].result():
+                return f"batch {i}: coalesced listings share a list"
+            problem = threaded_stale(threaded)
+            if problem:
+                return f"batch {i} {operations}: {problem}"
+    return None
+
+
+rng = random.Random(0)
+for check in (check_batches, check_threads):
+    with LoopbackService(FileTransferServer()) as loopback:
+        # Many of the random commands fail on purpose so hide what the server prints about them.
+        with contextlib.redirect_stdout(io.StringIO()):
+            problem = check(rng, loopback)
+    if problem:
+        print(problem)
+        sys.exit(1)
+print("listing cache ok")
@@ -0,0 +1,143 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Checks the packetizer that splits replies into packets and times it against joining the header
+and payload first. Runs on CircuitPython or a host.
+
+Random headers and payloads, including empty ones and ones that span many packets, are written
+or appended one at a time with a range of packet lengths. The packets must match splitting the
+joined bytes.
+
+The timing sends a tagged READ_DATA reply, a short header and a long payload. Joining them is a
+single copy that CPython makes quickly, so the packetizer can be slower there. What it saves is
+the allocation of a reply-sized buffer for every reply, which is what fragments a
+microcontroller's heap.
+"""
+
+import random
+import sys
+import time
+
+from adafruit_ble_file_transfer.transport import Packetizer, Transport
+
+try:
+    ticks = time.perf_counter
+except AttributeError:
+    ticks = time.monotonic
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+ROUNDS = 2_000
+ITERATIONS = 2_000
+
+
+class RecordingTransport(Transport):
+    """Keeps a copy of every packet written."""
+
+    def __init__(self, packet_length):
+        self.packet_length = packet_length
+        self.packets = []
+
+    @property
+    def outgoing_packet_length(self):
+        return self.packet_length
+
+    def write(self, packet):
+        if len(packet) > self.packet_length:
+            raise ValueError("Packet too long")
+        self.packets.append(bytes(packet))
+        return len(packet)
+
+
+class NullTransport(RecordingTransport):
+    """Drops packets so only the packetizer is timed."""
+
+    def write(self, packet):
+        return len(packet)
+
+
+def expected_packets(parts, packet_length):
+    joined = b"".join(bytes(part) for part in parts)
+    if not joined:
+        return []
+    return [joined[i : i + packet_length] for i in range(0, len(joined), packet_length)]
+
+
+def check(rng):
+    """Returns the number of failed checks."""
+    failures = 0
+    for _ in range(ROUNDS):
+        packet_length = rng.choice((1, 2, 3, 20, 27, 244, 512))
+        parts = []
+        for _ in range(rng.randint(1, 4)):
+            size = rng.choice((0, 1, packet_length - 1, packet_length, packet_length + 1))
+            size = max(0, size) if rng.random() < 0.5 else rng.randint(0, 5 * packet_length)
+            parts.append(bytearray(rng.getrandbits(8) for _ in range(size)))
+        transport = RecordingTransport(packet_length)
+        packetizer = Packetizer(transport)
+        appended = rng.random() < 0.5
+        if appended:
+            for part in parts:
+                packetizer.append(part)
+            packetizer.flush()
+        else:
+            packetizer.write(*parts)
+        expected = expected_packets(parts, packet_length)
+        # A lone empty part is still sent, like writing it directly would.
+        if not expected and len(parts) == 1 and not appended:
+            expected = [b""]
+        if transport.packets != expected:
+            print("packet length", packet_length, "parts", [len(part) for part in parts])
+            print("  sent", [len(p) for p in transport.packets])
+            print("  want", [len(p) for p in expected])
+            failures += 1
+            if failures > 5:
+                break
+    return failures
+
+
+def benchmark(name, function):
+    header = bytearray(16)
+    payload = memoryview(bytearray(2_000))
+    transport = NullTransport(244)
+    packetizer = Packetizer(transport)
+    start = ticks()
+    for _ in range(ITERATIONS):
+        function(packetizer, transport, header, payload)
+    elapsed = ticks() - start
+    allocated = ""
+    if tracemalloc is not None:
+        tracemalloc.start()
+        function(packetizer, transport, header, payload)
+        allocated = f"{tracemalloc.get_traced_memory()[1]:>8} bytes allocated at peak"
+        tracemalloc.stop()
+    print(f"{name:<16}{elapsed * 1_000_000 / ITERATIONS:>8.2f} us per reply{allocated}")
+    return elapsed
+
+
+def joined(_, transport, header, payload):
+    """Joins the header and payload and then splits them."""
+    reply = memoryview(header + payload)
+    for start in range(0, len(reply), 244):
+        transport.write(reply[start : start + 244])
+
+
+def packetized(packetizer, _, header, payload):
+    packetizer.write(header, payload)
+
+
+random.seed(0)
+failed = check(random)
+if failed:
+    print(failed, "packetizer checks failed")
+    sys.exit(1)
+print("packetizer ok")
+
+baseline = benchmark("joined", joined)
+split = benchmark("packetizer", packetized)
+print(f"packetizer takes {split / baseline:.0%} of the time")
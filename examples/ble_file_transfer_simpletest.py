@@ -16,6 +16,7 @@ from adafruit_ble.advertising.standard import (
 )
 
 import adafruit_ble_file_transfer
+from adafruit_ble_file_transfer.progress import ProgressLog
 
 
 def _write(client, filename, contents, *, offset=0):
@@ -46,6 +47,8 @@ def _read(client, filename, *, offset=0):
 ble = BLERadio()
 
 peer_address = None
+# Shared by the client of each connection so a transfer cut short by a disconnect resumes.
+progress = ProgressLog()
 
 
 def wait_for_reconnect():
@@ -59,7 +62,7 @@ def wait_for_reconnect():
         print(".", end="")
         new_connection.pair()
     new_service = new_connection[adafruit_ble_file_transfer.FileTransferService]
-    new_client = adafruit_ble_file_transfer.FileTransferClient(new_service)
+    new_client = adafruit_ble_file_transfer.FileTransferClient(new_service, progress=progress)
     print(".", end="")
     time.sleep(2)
     print("done")
@@ -80,7 +83,7 @@ while True:
                 print("paired")
                 print()
                 service = connection[adafruit_ble_file_transfer.FileTransferService]
-                client = adafruit_ble_file_transfer.FileTransferClient(service)
+                client = adafruit_ble_file_transfer.FileTransferClient(service, progress=progress)
 
                 print("Testing write")
                 client = _write(client, "/hello.txt", b"Hello world")
@@ -0,0 +1,123 @@
+# SPDX-FileCopyrightText: Copyright (c) 2021 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Checks that MemoryStorage behaves like OSStorage and times a large MemoryStorage directory. Runs
+on a host.
+
+The same random mkdirs, writes, deletes and moves are applied to both backends and every result
+and listing must match, apart from modification times which the local filesystem sets itself.
+"""
+
+import argparse
+import random
+import sys
+import tempfile
+import time
+
+from adafruit_ble_file_transfer.storage import MemoryStorage, OSStorage
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--operations", type=int, default=3_000)
+parser.add_argument("--entries", type=int, default=5_000, help="entries in the timed directory")
+args = parser.parse_args()
+
+NAMES = ("a", "b", "c", "d")
+
+
+def random_path(rng):
+    return "/" + "/".join(rng.choice(NAMES) for _ in range(rng.randint(1, 3)))
+
+
+def write(storage, path, contents):
+    file = storage.open_write(path, len(contents))
+    if file is None:
+        return None
+    file.write(contents)
+    file.close()
+    storage.set_modification_time(path, 0)
+    return True
+
+
+def read(storage, path):
+    opened = storage.open_read(path)
+    if opened is None:
+        return None
+    file, length = opened
+    contents = bytearray(length)
+    file.readinto(contents)
+    file.close()
+    return bytes(contents)
+
+
+def listing(storage, path):
+    entries = storage.listdir(path)
+    if entries is None:
+        return None
+    return [(name, flags, size) for name, flags, _, size in entries]
+
+
+def step(storage, operation):
+    name, path, other, contents = operation
+    if name == "mkdir":
+        return storage.mkdir(path, 0)
+    if name == "write":
+        return write(storage, path, contents)
+    if name == "delete":
+        return storage.delete(path)
+    if name == "move":
+        return storage.move(path, other)
+    if name == "read":
+        return read(storage, path)
+    return listing(storage, path)
+
+
+def check(rng, root):
+    memory = MemoryStorage()
+    local = OSStorage(root)
+    for i in range(args.operations):
+        operation = (
+            rng.choice(("mkdir", "write", "delete", "move", "read", "listdir", "listdir")),
+            random_path(rng),
+            random_path(rng),
+            bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 20))),
+        )
+        expected = step(local, operation)
+        result = step(memory, operation)
+        if result != expected:
+            print(f"operation {i} {operation[:3]}: {result!r} != {expected!r}")
+            return False
+    return True
+
+
+def timed(label, function, count):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28}{elapsed * 1_000_000 / count:>8.2f} us each")
+
+
+def benchmark(count):
+    storage = MemoryStorage()
+    storage.mkdir("/big", 0)
+    names = [f"/big/{i:08x}" for i in random.Random(1).sample(range(1 << 30), count)]
+    timed(f"create {count} files", lambda: [storage.open_write(name, 4) for name in names], count)
+    timed("listdir", lambda: [storage.listdir("/big") for _ in range(100)], 100)
+
+    def change_and_list():
+        for name in names[:100]:
+            storage.set_modification_time(name, 1)
+            storage.listdir("/big")
+
+    timed("listdir after a change", change_and_list, 100)
+    timed("move within directory", lambda: [storage.move(n, n + "x") for n in names], count)
+    timed("delete", lambda: [storage.delete(n + "x") for n in names], count)
+
+
+rng = random.Random(0)
+with tempfile.TemporaryDirectory() as temporary:
+    if not check(rng, temporary):
+        sys.exit(1)
+print("storage ok")
+benchmark(args.entries)